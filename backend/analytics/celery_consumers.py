@@ -1,13 +1,23 @@
-from celery import Celery
 from celery import bootsteps
-from kombu import Consumer, Exchange, Queue
-import sys, json
+from celery.worker.control import control_command, ok
+from kombu import Consumer, Producer
+import sys, logging, time
+from collections import Counter, defaultdict
 
-from analytics.models import Token, Client, Session
-from analytics.serializers import SessionStartEventSerializer, SessionEndEventSerializer, BussinessEventSerializer, ErrorEventSerializer, ProgeressionEventSerializer, QualityEventSerializer, ResourceEventSerializer
 from analytics.services.QueueCollection import QueueCollection
-from analytics.services.Utilities import send_update_to_group
-from django.utils.dateparse import parse_datetime
+from analytics.services.ChannelAcks import ChannelAcks
+from analytics.services.EventBatcher import EventBatcher
+from analytics.services.EventEnvelope import is_envelope, rejected_envelope, unpack_envelope
+from analytics.services.EventHandlers import EVENT_HANDLERS
+from analytics.services.EventSchemas import EventValidationError
+from analytics.services.FailurePolicy import FailurePolicy
+from analytics.services import IngestMetrics as metrics
+from analytics.services.IngestMetrics import log_event
+from analytics.services.LiveAggregates import live_kpis
+from analytics.services.Sharding import owns
+from analytics.services.StagingWriter import event_writer
+from django.conf import settings
+from django.db import transaction
 
 def get_queue_name(fullname):
     return fullname.split('.')[2]
@@ -18,308 +28,295 @@ def is_running_under_celery():
 def is_running_under_uvicorn():
     return 'uvicorn' in sys.argv[0] or any('uvicorn' in arg for arg in sys.argv)
 
+queue_collection = QueueCollection(load=is_running_under_celery())
 if is_running_under_celery():
-    queue_collection = QueueCollection()
     queues = queue_collection.queues
-    print(queue_collection.queues)
+    log_event(logging.INFO, "queues loaded", queues=len(queue_collection.queues), sampled=False)
+
+
+def persisting_writer():
+    """event_writer() recording its writes in the ingest metrics and the live KPI partials."""
+    return live_kpis.recorded(metrics.timed_writer(event_writer()))
+
+
+def batch_settings(event_type):
+    return {**settings.INGEST_BATCH_DEFAULTS, **settings.INGEST_BATCH_OVERRIDES.get(event_type, {})}
+
+
+class IngestionStep(bootsteps.ConsumerStep):
+    """
+    Consumes every event queue on one channel with a single kombu Consumer and
+    dispatches each message on its queue-name suffix to the registered
+    EventHandler. With INGEST_BATCH_ENABLED each event type gets its own
+    EventBatcher; all of them settle through the channel's ChannelAcks.
+    Events that fail go through the FailurePolicy (delayed retries, then the
+    token's dead-letter queue); without a channel they are just rejected.
+
+    Queues are added and cancelled at runtime (ingest_add_queue and
+    ingest_remove_queue control commands, periodic reconcile against the
+    Queue table) on the same channel, so deliveries that are still pending
+    in a batcher are settled normally after their queue is cancelled.
+
+    With INGEST_SHARD_COUNT > 1 the step only consumes the queues of the
+    products that hash to INGEST_SHARD_INDEX (see services/Sharding.py).
+
+    A delivery is attributed to its queue by the consumer tag it arrived on,
+    not by its routing key, so producers may publish through any exchange or
+    binding that routes to the event queues.
+    """
+    name = 'IngestionStep'
+    handlers = EVENT_HANDLERS
+
+    def __init__(self, parent, queue_collection=queue_collection, **kwargs):
+        super().__init__(parent, **kwargs)
+        self.queue_collection = queue_collection
+        self.acks = ChannelAcks()
+        self.batchers = {}
+        self.flush_timer = None
+        self.reconcile_timer = None
+        self.live_timer = None
+        self.consumed = set()
+        self.queue_tags = {}
+        self.failures = None
+        self.stats = defaultdict(Counter)
 
-class StartSessionEvent(bootsteps.ConsumerStep):
-    name = 'StartSessionEvent' 
     def get_consumers(self, channel):
-        filtered_queues = queue_collection.get_queues(lambda q: get_queue_name(q.name) == 'start_session')
+        # delivery tags restart on every new channel
+        self.acks = ChannelAcks()
+        self.failures = FailurePolicy(Producer(channel), self.acks)
+        if settings.INGEST_BATCH_ENABLED:
+            self.batchers = {}
+            for event_type in self.handlers:
+                config = batch_settings(event_type)
+                self.batchers[event_type] = EventBatcher(event_type, config['size'], config['interval_ms'], writer=persisting_writer(), acks=self.acks, failed=self.fail)
+        filtered_queues = self.queue_collection.get_queues(lambda q: self.wants(q.name))
+        self.consumed = {queue.name for queue in filtered_queues}
+        # consumer tags restart with the new Consumer
+        self.queue_tags = {}
+        # on_message hands over the raw body; handlers decode it once by content type
         return [Consumer(channel,
                          queues=filtered_queues,
-                         callbacks=[self.handle_message],
-                         accept=['json'])]
-
-    def handle_message(self, body, message):
-        try:
-            print(f'Received Start Session message: {body}')
-            data = json.loads(body)
-
-            session_id = data.get('session')
-            if not session_id:
-                print("Session ID not provided in message.")
-                message.ack()
-                return
-
-            client_obj = Client.objects.get(id=data["client"])
-            token_obj = client_obj.token
-            product_obj = token_obj.Product
-
-            session_obj = Session.objects.create(
-                id=session_id,
-                token=token_obj,
-                client=client_obj,
-                start_time=data["time"],
-                platform=data["platform"],
-            )
-
-            print(f"Session created with ID: {session_obj.id}")
-
-
-            data['session'] = session_obj.id
-
-            data['product'] = product_obj.id
-
-            serializer = SessionStartEventSerializer(data=data)
-            if serializer.is_valid():
-                serializer.save()
-                print(f"Start Session Event: {body} digested")
-            else:
-                print("serializer is not valid")
-                print(serializer.errors)
-
-            message.ack()
-        except Exception as e:
-            print(f"error occurred for message {body}: {e}")
-
-class EndSessionEvent(bootsteps.ConsumerStep):
-    name = 'EndSessionEvent'
-    def get_consumers(self, channel):
-        filtered_queues = queue_collection.get_queues(lambda q: get_queue_name(q.name) == 'end_session')
-        return [Consumer(channel,
-                         queues=filtered_queues,
-                         callbacks=[self.handle_message],
-                         accept=['json'])]
-
-    def handle_message(self, body, message):
-        try:
-            print(f'Received End Session message: {body}')
-            data = json.loads(body)
-
-            session_id = data["session"]
-            end_time = parse_datetime(data["time"])
-
-            if not session_id or not end_time:
-                raise ValueError("Missing required fields: 'session_id' or 'end_time'.")
-
-            try:
-                session = Session.objects.get(id=session_id)
-            except Session.DoesNotExist:
-                raise ValueError(f"Session with id '{session_id}' not found.")
-            
-            session.end_time = end_time
-            session.save()
-            print(f"Session {session_id} end_time updated to {end_time}")
-
-            serializer = SessionEndEventSerializer(data=data)
-            if serializer.is_valid():
-                serializer.save()
-            else:
-                print("serializer is not valid")
-                print(serializer.errors)
-
-            print(f"End Session Event: {body} digested")
-            message.ack()
-
-        except Exception as e:
-            print(f"Error occurred for message {body}: {e}")
-
-
-class BussinessEventAction(bootsteps.ConsumerStep):
-    name = 'BussinessEventAction' 
-    def get_consumers(self, channel):
-        filtered_queues = queue_collection.get_queues(lambda q: get_queue_name(q.name) == 'business_event')
-        return [Consumer(channel,
-                         queues=filtered_queues,
-                         callbacks=[self.handle_message],
-                         accept=['json'])]
-
-    def handle_message(self, body, message):
+                         on_message=lambda message: self.handle_message(message.body, message),
+                         accept=['json', 'msgpack'])]
+
+    def start(self, c):
+        super().start(c)
+        metrics.start_metrics_server()
+        if self.batchers:
+            interval = min(batcher.interval for batcher in self.batchers.values())
+            self.flush_timer = c.timer.call_repeatedly(interval, self.flush_due)
+        self.reconcile_timer = c.timer.call_repeatedly(settings.INGEST_QUEUE_RECONCILE_INTERVAL, self.reconcile)
+        if settings.LIVE_KPI_INTERVAL:
+            self.live_timer = c.timer.call_repeatedly(settings.LIVE_KPI_INTERVAL, live_kpis.flush)
+
+    def stop(self, c):
+        self.flush_pending()
+        super().stop(c)
+
+    def shutdown(self, c):
+        self.flush_pending()
+        super().shutdown(c)
+
+    def flush_due(self):
+        for batcher in self.batchers.values():
+            batcher.flush_due()
+
+    def flush_pending(self):
+        if self.reconcile_timer is not None:
+            self.reconcile_timer.cancel()
+            self.reconcile_timer = None
+        if self.flush_timer is not None:
+            self.flush_timer.cancel()
+            self.flush_timer = None
+        for batcher in self.batchers.values():
+            batcher.flush()
+        if self.live_timer is not None:
+            self.live_timer.cancel()
+            self.live_timer = None
+            live_kpis.flush()
+
+    @property
+    def consumer(self):
+        return self.consumers[0] if self.consumers else None
+
+    def wants(self, queue_name):
+        parts = queue_name.split('.')
+        if len(parts) < 3 or parts[2] not in self.handlers:
+            return False
+        return owns(self.queue_collection.product_of(queue_name)) if settings.INGEST_SHARD_COUNT > 1 else True
+
+    def add_queue(self, queue_name, product_id=None):
+        queue = self.queue_collection.add(queue_name, product_id)
+        if self.consumer is None or not self.wants(queue_name) or queue_name in self.consumed:
+            return False
+        self.consumer.add_queue(queue)
+        self.consumer.consume()
+        self.consumed.add(queue_name)
+        log_event(logging.INFO, "consuming", queue=queue_name, sampled=False)
+        return True
+
+    def remove_queue(self, queue_name):
+        self.queue_collection.remove(queue_name)
+        if self.consumer is None or queue_name not in self.consumed:
+            return False
+        self.consumed.discard(queue_name)
+        # deliveries already received stay tracked and are settled as usual;
+        # anything the broker sends after the cancel is requeued by amqp
+        self.consumer.cancel_by_queue(queue_name)
+        log_event(logging.INFO, "stopped consuming", queue=queue_name, sampled=False)
+        return True
+
+    def reconcile(self):
         try:
-            print(f'Received Bussiness Event message: {body}')
-            data = json.loads(body)
-
-            session_id = data["session"]
-
-            if not session_id:
-                raise ValueError("Missing required field: 'session_id'.")
-
-            session = None
-            try:
-                session = Session.objects.get(id=session_id)
-            except Session.DoesNotExist:
-                raise ValueError(f"Session with id '{session_id}' not found.")
-
-            product_obj = session.token.Product
-            data['product'] = product_obj.id
-
-            serializer = BussinessEventSerializer(data=data)
-            if serializer.is_valid():
-                serializer.save()
-            else:
-                print("serializer is not valid")
-                print(serializer.errors)
-
-            print(f"Bussiness Event: {body} digested")
-            message.ack()
+            self.queue_collection.refresh()
         except Exception as e:
-            print(f"error occurred for message {body}: {e}")
-
-
-class ErrorEventAction(bootsteps.ConsumerStep):
-    name = 'ErrorEventAction' 
-    def get_consumers(self, channel):
-        filtered_queues = queue_collection.get_queues(lambda q: get_queue_name(q.name) == 'error_event')
-        return [Consumer(channel,
-                         queues=filtered_queues,
-                         callbacks=[self.handle_message],
-                         accept=['json'])]
+            log_event(logging.WARNING, "could not reload queues", error=str(e))
+            return
+        wanted = {queue.name for queue in self.queue_collection.get_queues(lambda q: self.wants(q.name))}
+        current = set(self.consumed) if self.consumer is not None else set()
+        for queue_name in sorted(wanted - current):
+            self.add_queue(queue_name)
+        for queue_name in sorted(current - wanted):
+            self.remove_queue(queue_name)
+
+    def queue_of(self, message):
+        """Name of the queue `message` was delivered from."""
+        tag = message.delivery_info.get('consumer_tag')
+        queue_name = self.queue_tags.get(tag)
+        if queue_name is None and tag is not None and self.consumer is not None:
+            # kombu keeps the tag each queue was consumed with, by queue name
+            self.queue_tags = {active: name for name, active in getattr(self.consumer, '_active_tags', {}).items()}
+            queue_name = self.queue_tags.get(tag)
+        return queue_name or message.delivery_info['routing_key']
+
+    def fail(self, message, error, retry=True):
+        queue_name = self.queue_of(message)
+        metrics.failed(get_queue_name(queue_name), self.queue_collection.products.get(queue_name), 'error' if retry else 'invalid')
+        if self.failures is None:
+            self.acks.reject(message)
+            return
+        self.failures.failed(message, error, retry=retry, queue_name=queue_name)
+
+    def writer_for(self, event_type, message):
+        batcher = self.batchers.get(event_type)
+        if batcher is not None:
+            return lambda record: batcher.add(record, message)
+
+        def write(record):
+            persisting_writer()(event_type, [record])
+            self.acks.ack(message)
+        return write
 
     def handle_message(self, body, message):
+        self.acks.track(message)
+        queue_name = self.queue_of(message)
+        event_type = get_queue_name(queue_name)
+        handler = self.handlers.get(event_type)
+        if handler is None:
+            log_event(logging.WARNING, "no handler", queue=queue_name)
+            self.acks.reject(message)
+            return
+
+        self.stats[event_type]['received'] += 1
+        product_id = self.queue_collection.products.get(queue_name)
+        metrics.received(event_type, product_id)
+        started = time.perf_counter()
         try:
-            print(f'Received Error Event message: {body}')
-            data = json.loads(body)
-
-            session_id = data["session"]
+            self.process(handler, event_type, body, message)
+        finally:
+            metrics.handled(event_type, product_id, time.perf_counter() - started)
 
-            if not session_id:
-                raise ValueError("Missing required field: 'session_id'.")
-
-            session = None
-            try:
-                session = Session.objects.get(id=session_id)
-            except Session.DoesNotExist:
-                raise ValueError(f"Session with id '{session_id}' not found.")
-
-            product_obj = session.token.Product
-            data['product'] = product_obj.id
-
-
-            serializer = ErrorEventSerializer(data=data)
-            if serializer.is_valid():
-                serializer.save()
-            else:
-                print("serializer is not valid")
-                print(serializer.errors)
-
-            print(f"Error Event: {body} digested")
-            message.ack()
-        except Exception as e:
-            print(f"error occurred for message {body}: {e}")
-
-
-class ProgeressionEventAction(bootsteps.ConsumerStep):
-    name = 'ProgeressionEventAction' 
-    def get_consumers(self, channel):
-        filtered_queues = queue_collection.get_queues(lambda q: get_queue_name(q.name) == 'progression_event')
-        return [Consumer(channel,
-                         queues=filtered_queues,
-                         callbacks=[self.handle_message],
-                         accept=['json'])]
-
-    def handle_message(self, body, message):
+    def process(self, handler, event_type, body, message):
+        stats = self.stats[event_type]
+        log_event(logging.DEBUG, "received", event_type=event_type, body=body)
         try:
-            print(f'Received Progeression Event message: {body}')
-            data = json.loads(body)
-
-            session_id = data["session"]
-
-            if not session_id:
-                raise ValueError("Missing required field: 'session_id'.")
-
-            session = None
-            try:
-                session = Session.objects.get(id=session_id)
-            except Session.DoesNotExist:
-                raise ValueError(f"Session with id '{session_id}' not found.")
-
-            product_obj = session.token.Product
-            data['product'] = product_obj.id
-
-            serializer = ProgeressionEventSerializer(data=data)
-            if serializer.is_valid():
-                serializer.save()
-            else:
-                print("serializer is not valid")
-                print(serializer.errors)
-
-            print(f"Progeression Event: {body} digested")
-            message.ack()
-        except Exception as e:
-            print(f"error occurred for message {body}: {e}")
-
-
-class QualityEventAction(bootsteps.ConsumerStep):
-    name = 'QualityEventAction' 
-    def get_consumers(self, channel):
-        filtered_queues = queue_collection.get_queues(lambda q: get_queue_name(q.name) == 'quality_event')
-        return [Consumer(channel,
-                         queues=filtered_queues,
-                         callbacks=[self.handle_message],
-                         accept=['json'])]
+            data = handler.decode(body, message.content_type, message.content_encoding)
+        except ValueError as e:
+            stats['invalid'] += 1
+            log_event(logging.WARNING, "undecodable message", event_type=event_type, error=str(e), body=body[:200])
+            self.fail(message, e, retry=False)
+            return
 
-    def handle_message(self, body, message):
         try:
-            print(f'Received Quality Event message: {body}')
-            data = json.loads(body)
-
-            session_id = data["session"]
-
-            if not session_id:
-                raise ValueError("Missing required field: 'session_id'.")
-
-            session = None
-            try:
-                session = Session.objects.get(id=session_id)
-            except Session.DoesNotExist:
-                raise ValueError(f"Session with id '{session_id}' not found.")
-
-            product_obj = session.token.Product
-            data['product'] = product_obj.id
-
-            serializer = QualityEventSerializer(data=data)
-            if serializer.is_valid():
-                serializer.save()
-            else:
-                print("serializer is not valid")
-                print(serializer.errors)
-
-            print(f"Quality Event: {body} digested")
-            message.ack()
+            if is_envelope(data):
+                self.handle_envelope(data, event_type, message)
+                return
+            record = handler.validate(data)
+            handler.persist(record, self.writer_for(event_type, message))
+        except EventValidationError as e:
+            stats['invalid'] += 1
+            log_event(logging.INFO, "invalid event", event_type=event_type, errors=e.errors)
+            self.fail(message, e.errors, retry=False)
+            return
         except Exception as e:
-            print(f"error occurred for message {body}: {e}")
-
-
-class ResourceEventAction(bootsteps.ConsumerStep):
-    name = 'ResourceEventAction' 
-    def get_consumers(self, channel):
-        filtered_queues = queue_collection.get_queues(lambda q: get_queue_name(q.name) == 'resource_event')
-        return [Consumer(channel,
-                         queues=filtered_queues,
-                         callbacks=[self.handle_message],
-                         accept=['json'])]
-
-    def handle_message(self, body, message):
-        try:
-            print(f'Received Resource Event message: {body}')
-            data = json.loads(body)
-
-            session_id = data["session"]
-
-            if not session_id:
-                raise ValueError("Missing required field: 'session_id'.")
-
-            session = None
+            stats['failed'] += 1
+            log_event(logging.WARNING, "event failed", event_type=event_type, error=str(e), body=body[:200])
+            self.fail(message, e)
+            return
+        stats['accepted'] += 1
+        log_event(logging.DEBUG, "digested", event_type=event_type, session=record.get('session'))
+
+    def handle_envelope(self, data, queue_type, message):
+        """
+        Writes the valid entries of a batch envelope in one transaction and acks
+        the message once; rejected entries go to the dead-letter queue. See
+        services/EventEnvelope.py for the failure rules.
+        """
+        self.stats[queue_type]['envelopes'] += 1
+        entries, invalid = unpack_envelope(data, queue_type, self.handlers)
+        groups = {}
+        for index, event_type, entry in entries:
             try:
-                session = Session.objects.get(id=session_id)
-            except Session.DoesNotExist:
-                raise ValueError(f"Session with id '{session_id}' not found.")
-
-            product_obj = session.token.Product
-            data['product'] = product_obj.id
-
-            serializer = ResourceEventSerializer(data=data)
-            if serializer.is_valid():
-                serializer.save()
-            else:
-                print("serializer is not valid")
-                print(serializer.errors)
-
-            print(f"Resource Event: {body} digested")
-            message.ack()
-        except Exception as e:
-            print(f"error occurred for message {body}: {e}")
-
-
+                record = self.handlers[event_type].validate(entry)
+            except EventValidationError as e:
+                invalid.append((index, e.errors))
+                continue
+            groups.setdefault(event_type, []).append(record)
+
+        if groups:
+            self.write_groups(groups)
+
+        for event_type, records in groups.items():
+            self.stats[event_type]['accepted'] += len(records)
+        if invalid:
+            self.stats[queue_type]['invalid'] += len(invalid)
+            metrics.failed(queue_type, self.queue_collection.products.get(self.queue_of(message)), 'invalid', len(invalid))
+            log_event(logging.INFO, "envelope entries rejected", event_type=queue_type, rejected=len(invalid), events=len(data['events']))
+            if self.failures is not None:
+                rejected = rejected_envelope(data, invalid)
+                self.failures.quarantine_part(message, rejected, rejected['errors'], queue_name=self.queue_of(message))
+        self.acks.ack(message)
+
+    def write_groups(self, groups):
+        """Persists {event type: [records]} in one transaction."""
+        with transaction.atomic():
+            for event_type, records in groups.items():
+                rows = []
+                for record in records:
+                    self.handlers[event_type].persist(record, rows.append)
+                persisting_writer()(event_type, rows)
+
+
+def ingestion_step(consumer):
+    for step in consumer.steps:
+        if isinstance(step, IngestionStep):
+            return step
+    return None
+
+
+@control_command(args=[('queue_name', str), ('product_id', int)], signature='<queue_name> [product_id]')
+def ingest_add_queue(state, queue_name, product_id=None):
+    """Start consuming a newly provisioned event queue."""
+    step = ingestion_step(state.consumer)
+    if step is not None:
+        state.consumer.call_soon(step.add_queue, queue_name, product_id)
+    return ok(f'adding {queue_name}')
+
+
+@control_command(args=[('queue_name', str)], signature='<queue_name>')
+def ingest_remove_queue(state, queue_name):
+    """Stop consuming a deleted event queue."""
+    step = ingestion_step(state.consumer)
+    if step is not None:
+        state.consumer.call_soon(step.remove_queue, queue_name)
+    return ok(f'removing {queue_name}')
@@ -1,59 +1,29 @@
 import asyncio
 import json
+import time
 import uuid
 from asgiref.sync import sync_to_async, async_to_sync
+from channels.exceptions import StopConsumer
 from channels.generic.http import AsyncHttpConsumer
 from channels.layers import get_channel_layer
 from datetime import datetime, timezone
 from datetime import timedelta
 from urllib.parse import parse_qs
 from django.utils.dateparse import parse_datetime
-from django.db.models import Min, Max
+from django.conf import settings
 from django.utils.timezone import make_aware
+from django.utils.dateparse import parse_date
 
 
-from analytics.models import Token, Session, GameEventHourlyCount, DailyActiveUsers, AverageFPS, AverageMemoryUsage, AverageSessionDuration, TotalRevenuePerCurrency, ARPPU, LevelCompletionRate, AverageTriesPerLevel, NetResourceFlow, ResourceSinkRatio, CrashRate, TopErrorTypes
+from analytics.services.ActiveUsers import active_user_series
+from analytics.services.Percentiles import percentile_series
+from analytics.services.KPIStreams import KPI_STREAMS, kpi_rows, recent_rows, row_key, stream_window
+from analytics.services.SSEHub import ChangedPoll, kpi_hub
+from analytics.services.LiveAggregates import LIVE_KPIS, bucket_start, live_group, merge_partial
+from analytics.models import Token
 
 
 
-async def get_running_avg_sessions(token, bucket_seconds=3600):
-    ended_sessions = Session.objects.filter(end_time__isnull=False, token=token).order_by('end_time')
-    ended_sessions_exsists_task = sync_to_async(ended_sessions.exists)()
-    if not (await ended_sessions_exsists_task):
-        return []
-
-    start_time_task = sync_to_async(ended_sessions.first)()
-    end_time_task = sync_to_async(ended_sessions.last)()
-    start_time = (await start_time_task).start_time
-    end_time = (await end_time_task).end_time
-
-    list_sessions_task = sync_to_async(list)(ended_sessions)
-    bucket = timedelta(seconds=bucket_seconds)
-    current_time = start_time
-    result = []
-    cumulative_duration = timedelta()
-    count = 0
-    session_index = 0
-    sessions = await list_sessions_task
-
-    while current_time <= end_time:
-        while session_index < len(sessions) and sessions[session_index].end_time <= current_time:
-            session = sessions[session_index]
-            cumulative_duration += session.duration
-            count += 1
-            session_index += 1
-
-        avg_duration = cumulative_duration.total_seconds() / count if count else 0
-
-        result.append({
-            "timestamp": current_time.isoformat(),
-            "value": avg_duration
-        })
-
-        current_time += bucket
-
-    return result
-
 class KPI_Monitor(AsyncHttpConsumer):
     async def handle(self, body):
         await self.send_headers(headers=[
@@ -106,207 +76,78 @@ class KPI_Monitor(AsyncHttpConsumer):
         await self.send_body(f"data: {message}\n\n".encode(), more_body=True)
 
 
-class GameEventSSEConsumer(AsyncHttpConsumer):
-    async def handle(self, body):
-        query_string = self.scope.get('query_string', b'').decode()
-        params = dict(pair.split('=') for pair in query_string.split('&') if '=' in pair)
-
-        product_id = params.get('product_id')
-        start_time = params.get('start_time') 
-        end_time = params.get('end_time')
-        update_interval = float(params.get('update_interval', 5))
-
-        if not product_id:
-            await self.send_response(400, b'product_id parameter is required')
-            return
-
-        def parse_dt(dt_str):
-            if not dt_str:
-                return None
-            dt = parse_datetime(dt_str)
-
-            if dt and not dt.tzinfo:
-                dt = make_aware(dt)
-            return dt
-
-        start_dt = parse_dt(start_time)
-        end_dt = parse_dt(end_time)
-
-        if start_dt is None:
-            min_bucket = await sync_to_async(
-                lambda: GameEventHourlyCount.objects.aggregate(Min('bucket'))
-            )()
-
-            start_dt = min_bucket['bucket__min']
-        if end_dt is None:
-            max_bucket = await sync_to_async(
-                lambda: GameEventHourlyCount.objects.aggregate(Max('bucket'))
-            )()
-
-            end_dt = max_bucket['bucket__max']
+class StreamingHttpConsumer(AsyncHttpConsumer):
+    # AsyncHttpConsumer ends the consumer (disconnect() and StopConsumer) as soon
+    # as handle() returns. A stream sets `streaming` in handle() instead; the
+    # consumer then keeps dispatching channel layer messages until the client's
+    # http.disconnect, which runs disconnect(). handle() must not block, or
+    # neither would be dispatched.
+    streaming = False
 
-        if start_dt is None or end_dt is None:
-            await self.send_response(404, b'No data available')
+    async def http_request(self, message):
+        if "body" in message:
+            self.body.append(message["body"])
+        if message.get("more_body"):
             return
-
-        try:
-            product_id = int(product_id)
-        except ValueError:
-            await self.send_response(400, b'Invalid product_id')
-            return
-
-        @sync_to_async
-        def get_queryset():
-            return list(GameEventHourlyCount.objects.filter(
-            product_id=product_id,
-            bucket__gte=start_dt,
-            bucket__lte=end_dt).order_by('bucket'))
-
-
-
-        qs = await get_queryset()
-
-        headers = [
-            (b"Cache-Control", b"no-cache"),
-            (b"Content-Type", b"text/event-stream"),
-            (b"Transfer-Encoding", b"chunked"),
-            (b'Access-Control-Allow-Origin', b'http://localhost:5173'),
-            (b'Access-Control-Allow-Credentials', b'true')
-        ]
-        await self.send_headers(headers=headers)
-
-        async def send_sse(data_dict):
-            msg = f"data: {json.dumps(data_dict)}\n\n"
-            await self.send_body(msg.encode(), more_body=True)
-
-        initial_data = []
-        for event in qs:
-            initial_data.append({
-                "bucket": event.bucket.isoformat(),
-                "product_id": event.product_id,
-                "event_count": event.event_count,
-            })
-
         try:
-            await send_sse(initial_data)
-        except Exception:
-            return
-
-        last_sent_time = end_dt
-        last_sent_event_count = None
-
-        while True:
-            await asyncio.sleep(update_interval)
-
-            # Include the last_sent_time to detect updates to that row
-            new_events_qs = await sync_to_async(lambda: GameEventHourlyCount.objects.filter(
-                product_id=product_id,
-                bucket__gte=last_sent_time
-            ).order_by('bucket'))()
-
-            new_events = await sync_to_async(list)(new_events_qs)
-
-            if not new_events:
-                continue
-
-            # If the first event is the last bucket again, check if it was updated
-            first_event = new_events[0]
-            if first_event.bucket == last_sent_time:
-                if first_event.event_count != last_sent_event_count:
-                    # Re-send updated last row
-                    try:
-                        await send_sse({
-                            "bucket": first_event.bucket.isoformat(),
-                            "product_id": first_event.product_id,
-                            "event_count": first_event.event_count,
-                        })
-                    except Exception:
-                        return  # Client disconnected
-                    last_sent_event_count = first_event.event_count
-
-                # Skip to the rest of the new events (if any)
-                remaining_events = new_events[1:]
-            else:
-                remaining_events = new_events
-
-            for event in remaining_events:
-                try:
-                    await send_sse({
-                        "bucket": event.bucket.isoformat(),
-                        "product_id": event.product_id,
-                        "event_count": event.event_count,
-                    })
-                except Exception:
-                    return  # Client disconnected
-
-                # Update tracker with latest
-                last_sent_time = event.bucket
-                last_sent_event_count = event.event_count
-
-class DailyActiveUsersConsumer(AsyncHttpConsumer):
+            await self.handle(b"".join(self.body))
+        except BaseException:
+            await self.disconnect()
+            raise
+        if not self.streaming:
+            await self.disconnect()
+            raise StopConsumer()
+
+
+class HubStreamConsumer(StreamingHttpConsumer):
+    # Streams updates from the shared per-process pollers of services/SSEHub.py:
+    # handle() sends the initial data and calls stream_from_hub, which forwards
+    # the hub's frames from a task until the client disconnects
+    subscription = None
+    forwarder = None
+
+    async def stream_from_hub(self, key, make_poll, interval):
+        self.subscription = kpi_hub.subscribe(key, make_poll, interval)
+        self.forwarder = asyncio.create_task(self.forward_frames(self.subscription))
+        self.streaming = True
+
+    async def forward_frames(self, subscription):
+        async for frame in subscription:
+            await self.send_body(frame, more_body=True)
+
+    async def disconnect(self):
+        if self.forwarder is not None:
+            self.forwarder.cancel()
+            self.forwarder = None
+        if self.subscription is not None:
+            kpi_hub.unsubscribe(self.subscription)
+            self.subscription = None
+
+
+class KPIStreamConsumer(HubStreamConsumer):
+    # Any aggregate of KPI_STREAMS (services/KPIStreams.py), named by the route:
+    # the rows of the requested window, then, if it is open, the changed recent
+    # rows from the product's shared poller
     async def handle(self, body):
         query_string = self.scope.get('query_string', b'').decode()
         params = dict(pair.split('=') for pair in query_string.split('&') if '=' in pair)
 
+        kpi = self.scope['url_route']['kwargs']['kpi']
+        stream = KPI_STREAMS[kpi]
         product_id = params.get('product_id')
-        start_time = params.get('start_time') 
-        end_time = params.get('end_time')
         update_interval = float(params.get('update_interval', 5))
 
         if not product_id:
             await self.send_response(400, b'product_id parameter is required')
             return
 
-        def parse_dt(dt_str):
-            if not dt_str:
-                return None
-            dt = parse_datetime(dt_str)
-
-            if dt and not dt.tzinfo:
-                dt = make_aware(dt)
-            return dt
-
-        start_dt = parse_dt(start_time)
-        if  not start_dt :
-            end_dt=None
-        else:
-            end_dt=start_dt+timedelta(days=1)
-        print(start_dt)
-        print(end_dt)
-
-        if start_dt is None:
-            min_bucket = await sync_to_async(
-                lambda: DailyActiveUsers.objects.aggregate(Min('bucket'))
-            )()
-
-            start_dt = min_bucket['bucket__min']
-        if end_dt is None:
-            max_bucket = await sync_to_async(
-                lambda: DailyActiveUsers.objects.aggregate(Max('bucket'))
-            )()
-
-            end_dt = max_bucket['bucket__max']
-
-        if start_dt is None or end_dt is None:
-            await self.send_response(404, b'No data available')
-            return
-
         try:
             product_id = int(product_id)
+            start_dt, end_dt, live = stream_window(params.get('start_time'), params.get('end_time'), datetime.now(timezone.utc))
         except ValueError:
-            await self.send_response(400, b'Invalid product_id')
+            await self.send_response(400, b'Invalid product_id, start_time or end_time')
             return
-
-        @sync_to_async
-        def get_queryset():
-            return list(DailyActiveUsers.objects.filter(
-            product_id=product_id,
-            bucket__gte=start_dt,
-            bucket__lte=end_dt).order_by('bucket'))
-
-
-
-        qs = await get_queryset()
+        rows = await sync_to_async(kpi_rows)(stream, product_id, start_dt, end_dt)
 
         headers = [
             (b"Cache-Control", b"no-cache"),
@@ -316,140 +157,38 @@ class DailyActiveUsersConsumer(AsyncHttpConsumer):
             (b'Access-Control-Allow-Credentials', b'true')
         ]
         await self.send_headers(headers=headers)
-
-        async def send_sse(data_dict):
-            msg = f"data: {json.dumps(data_dict)}\n\n"
-            await self.send_body(msg.encode(), more_body=True)
-
-        initial_data = []
-        for event in qs:
-            initial_data.append({
-                "bucket": event.bucket.isoformat(),
-                "product_id": event.product_id,
-                "event_count": event.active_users,
-            })
-
-        try:
-            await send_sse(initial_data)
-        except Exception:
+        await self.send_body(f"data: {json.dumps(rows)}\n\n".encode(), more_body=live)
+        if not live:
             return
 
-        last_sent_time = end_dt
-        last_sent_event_count = None
-
-        while True:
-            await asyncio.sleep(update_interval)
-
-            # Include the last_sent_time to detect updates to that row
-            new_events_qs = await sync_to_async(lambda: DailyActiveUsers.objects.filter(
-                product_id=product_id,
-                bucket__gte=last_sent_time
-            ).order_by('bucket'))()
-
-            new_events = await sync_to_async(list)(new_events_qs)
-
-            if not new_events:
-                continue
-
-            # If the first event is the last bucket again, check if it was updated
-            first_event = new_events[0]
-            if first_event.bucket == last_sent_time:
-                if first_event.active_users != last_sent_event_count:
-                    # Re-send updated last row
-                    try:
-                        await send_sse({
-                            "bucket": first_event.bucket.isoformat(),
-                            "product_id": first_event.product_id,
-                            "event_count": first_event.active_users,
-                        })
-                    except Exception:
-                        return  # Client disconnected
-                    last_sent_event_count = first_event.active_users
-
-                # Skip to the rest of the new events (if any)
-                remaining_events = new_events[1:]
-            else:
-                remaining_events = new_events
-
-            for event in remaining_events:
-                try:
-                    await send_sse({
-                        "bucket": event.bucket.isoformat(),
-                        "product_id": event.product_id,
-                        "event_count": event.active_users,
-                    })
-                except Exception:
-                    return  # Client disconnected
+        def recent():
+            return recent_rows(stream, product_id, datetime.now(timezone.utc))
+        await self.stream_from_hub((kpi, product_id), lambda: ChangedPoll(recent, row_key(stream)), update_interval)
 
-                # Update tracker with latest
-                last_sent_time = event.bucket
-                last_sent_event_count = event.active_users
 
-class AverageFPSConsumer(AsyncHttpConsumer):
+class ActiveUsersConsumer(HubStreamConsumer):
+    # DAU, WAU, MAU and stickiness per day from the active user sketches; after the
+    # initial series, today's point is re-sent whenever it changes
     async def handle(self, body):
         query_string = self.scope.get('query_string', b'').decode()
         params = dict(pair.split('=') for pair in query_string.split('&') if '=' in pair)
 
         product_id = params.get('product_id')
-        start_time = params.get('start_time') 
-        end_time = params.get('end_time')
-        update_interval = float(params.get('update_interval', 5))
+        update_interval = float(params.get('update_interval', 60))
 
         if not product_id:
             await self.send_response(400, b'product_id parameter is required')
             return
 
-        def parse_dt(dt_str):
-            if not dt_str:
-                return None
-            dt = parse_datetime(dt_str)
-
-            if dt and not dt.tzinfo:
-                dt = make_aware(dt)
-            return dt
-
-        start_dt = parse_dt(start_time)
-        if  not start_dt :
-            end_dt=None
-        else:
-            end_dt=start_dt+timedelta(days=1)
-        print(start_dt)
-        print(end_dt)
-
-        if start_dt is None:
-            min_bucket = await sync_to_async(
-                lambda: AverageFPS.objects.aggregate(Min('bucket'))
-            )()
-
-            start_dt = min_bucket['bucket__min']
-        if end_dt is None:
-            max_bucket = await sync_to_async(
-                lambda: AverageFPS.objects.aggregate(Max('bucket'))
-            )()
-
-            end_dt = max_bucket['bucket__max']
-
-        if start_dt is None or end_dt is None:
-            await self.send_response(404, b'No data available')
-            return
-
         try:
             product_id = int(product_id)
+            end_day = parse_date(params.get('end_time', '')[:10]) or datetime.now(timezone.utc).date()
+            start_day = parse_date(params.get('start_time', '')[:10]) or end_day - timedelta(days=29)
+            series = await sync_to_async(active_user_series)(product_id, start_day, end_day)
         except ValueError:
-            await self.send_response(400, b'Invalid product_id')
+            await self.send_response(400, b'Invalid product_id, start_time or end_time')
             return
 
-        @sync_to_async
-        def get_queryset():
-            return list(AverageFPS.objects.filter(
-            product_id=product_id,
-            bucket__gte=start_dt,
-            bucket__lte=end_dt).order_by('bucket'))
-
-
-
-        qs = await get_queryset()
-
         headers = [
             (b"Cache-Control", b"no-cache"),
             (b"Content-Type", b"text/event-stream"),
@@ -463,137 +202,48 @@ class AverageFPSConsumer(AsyncHttpConsumer):
             msg = f"data: {json.dumps(data_dict)}\n\n"
             await self.send_body(msg.encode(), more_body=True)
 
-        initial_data = []
-        for event in qs:
-            initial_data.append({
-                "bucket": event.bucket.isoformat(),
-                "product_id": event.product_id,
-                "event_count": event.average_fps,
-            })
-            
-        print(len(initial_data))
-
         try:
-            await send_sse(initial_data)
+            await send_sse(series)
         except Exception:
             return
 
-        last_sent_time = end_dt
-        last_sent_event_count = None
-
-        while True:
-            await asyncio.sleep(update_interval)
-
-            # Include the last_sent_time to detect updates to that row
-            new_events_qs = await sync_to_async(lambda: AverageFPS.objects.filter(
-                product_id=product_id,
-                bucket__gte=last_sent_time
-            ).order_by('bucket'))()
-
-            new_events = await sync_to_async(list)(new_events_qs)
-
-            if not new_events:
-                continue
-
-            # If the first event is the last bucket again, check if it was updated
-            first_event = new_events[0]
-            if first_event.bucket == last_sent_time:
-                if first_event.average_fps != last_sent_event_count:
-                    # Re-send updated last row
-                    try:
-                        await send_sse({
-                            "bucket": first_event.bucket.isoformat(),
-                            "product_id": first_event.product_id,
-                            "event_count": first_event.average_fps,
-                        })
-                    except Exception:
-                        return  # Client disconnected
-                    last_sent_event_count = first_event.average_fps
-
-                # Skip to the rest of the new events (if any)
-                remaining_events = new_events[1:]
-            else:
-                remaining_events = new_events
+        if params.get('end_time') and end_day < datetime.now(timezone.utc).date():
+            return
 
-            for event in remaining_events:
-                try:
-                    await send_sse({
-                        "bucket": event.bucket.isoformat(),
-                        "product_id": event.product_id,
-                        "event_count": event.average_fps,
-                    })
-                except Exception:
-                    return  # Client disconnected
+        def today():
+            day = datetime.now(timezone.utc).date()
+            return active_user_series(product_id, day, day)
+        await self.stream_from_hub(('ActiveUsers', product_id), lambda: ChangedPoll(today, 'day'), update_interval)
 
-                # Update tracker with latest
-                last_sent_time = event.bucket
-                last_sent_event_count = event.average_fps
+class PercentilesConsumer(HubStreamConsumer):
+    # p50/p90/p95/p99 of `metric` per hour or day from the quantile sketches; after
+    # the initial series, the points of the current step are re-sent when they change
+    metric = None
 
-class AverageMemoryUsageConsumer(AsyncHttpConsumer):
     async def handle(self, body):
         query_string = self.scope.get('query_string', b'').decode()
         params = dict(pair.split('=') for pair in query_string.split('&') if '=' in pair)
 
         product_id = params.get('product_id')
-        start_time = params.get('start_time') 
-        end_time = params.get('end_time')
-        update_interval = float(params.get('update_interval', 5))
+        step = params.get('step', 'hour')
+        update_interval = float(params.get('update_interval', 60))
 
         if not product_id:
             await self.send_response(400, b'product_id parameter is required')
             return
 
-        def parse_dt(dt_str):
-            if not dt_str:
-                return None
-            dt = parse_datetime(dt_str)
-
-            if dt and not dt.tzinfo:
-                dt = make_aware(dt)
-            return dt
-
-        start_dt = parse_dt(start_time)
-        if  not start_dt :
-            end_dt=None
-        else:
-            end_dt=start_dt+timedelta(days=1)
-        print(start_dt)
-        print(end_dt)
-
-        if start_dt is None:
-            min_bucket = await sync_to_async(
-                lambda: AverageMemoryUsage.objects.aggregate(Min('bucket'))
-            )()
-
-            start_dt = min_bucket['bucket__min']
-        if end_dt is None:
-            max_bucket = await sync_to_async(
-                lambda: AverageMemoryUsage.objects.aggregate(Max('bucket'))
-            )()
-
-            end_dt = max_bucket['bucket__max']
-
-        if start_dt is None or end_dt is None:
-            await self.send_response(404, b'No data available')
-            return
+        start_dt = parse_datetime(params.get('start_time', ''))
+        if start_dt and not start_dt.tzinfo:
+            start_dt = make_aware(start_dt)
+        start_dt = start_dt or datetime.now(timezone.utc) - timedelta(days=1)
 
         try:
             product_id = int(product_id)
+            series = await sync_to_async(percentile_series)(self.metric, product_id, start_dt, datetime.now(timezone.utc), step)
         except ValueError:
-            await self.send_response(400, b'Invalid product_id')
+            await self.send_response(400, b'Invalid product_id, start_time or step')
             return
 
-        @sync_to_async
-        def get_queryset():
-            return list(AverageMemoryUsage.objects.filter(
-            product_id=product_id,
-            bucket__gte=start_dt,
-            bucket__lte=end_dt).order_by('bucket'))
-
-
-
-        qs = await get_queryset()
-
         headers = [
             (b"Cache-Control", b"no-cache"),
             (b"Content-Type", b"text/event-stream"),
@@ -607,226 +257,54 @@ class AverageMemoryUsageConsumer(AsyncHttpConsumer):
             msg = f"data: {json.dumps(data_dict)}\n\n"
             await self.send_body(msg.encode(), more_body=True)
 
-        initial_data = []
-        for event in qs:
-            initial_data.append({
-                "bucket": event.bucket.isoformat(),
-                "product_id": event.product_id,
-                "event_count": event.average_memory_usage,
-            })
-
         try:
-            await send_sse(initial_data)
+            await send_sse(series)
         except Exception:
             return
 
-        last_sent_time = end_dt
-        last_sent_event_count = None
-
-        while True:
-            await asyncio.sleep(update_interval)
-
-            # Include the last_sent_time to detect updates to that row
-            new_events_qs = await sync_to_async(lambda: AverageMemoryUsage.objects.filter(
-                product_id=product_id,
-                bucket__gte=last_sent_time
-            ).order_by('bucket'))()
-
-            new_events = await sync_to_async(list)(new_events_qs)
-
-            if not new_events:
-                continue
+        step_length = timedelta(days=1) if step == 'day' else timedelta(hours=1)
 
-            # If the first event is the last bucket again, check if it was updated
-            first_event = new_events[0]
-            if first_event.bucket == last_sent_time:
-                if first_event.average_memory_usage != last_sent_event_count:
-                    # Re-send updated last row
-                    try:
-                        await send_sse({
-                            "bucket": first_event.bucket.isoformat(),
-                            "product_id": first_event.product_id,
-                            "event_count": first_event.average_memory_usage,
-                        })
-                    except Exception:
-                        return  # Client disconnected
-                    last_sent_event_count = first_event.average_memory_usage
+        def recent():
+            now = datetime.now(timezone.utc)
+            return percentile_series(self.metric, product_id, now - 2 * step_length, now, step)
+        await self.stream_from_hub((self.metric, product_id, step), lambda: ChangedPoll(recent), update_interval)
 
-                # Skip to the rest of the new events (if any)
-                remaining_events = new_events[1:]
-            else:
-                remaining_events = new_events
+class FPSPercentilesConsumer(PercentilesConsumer):
+    metric = 'fps'
 
-            for event in remaining_events:
-                try:
-                    await send_sse({
-                        "bucket": event.bucket.isoformat(),
-                        "product_id": event.product_id,
-                        "event_count": event.average_memory_usage,
-                    })
-                except Exception:
-                    return  # Client disconnected
 
-                # Update tracker with latest
-                last_sent_time = event.bucket
-                last_sent_event_count = event.average_memory_usage
+class MemoryUsagePercentilesConsumer(PercentilesConsumer):
+    metric = 'memory_usage'
 
 
-class AverageSessionDurationConsumer(AsyncHttpConsumer):
+class LiveKPIConsumer(StreamingHttpConsumer):
+    # A KPI of LIVE_KPIS from its continuous aggregate, then updated every few
+    # seconds with the deltas the ingestion workers publish to live.<kpi>.<product>
+    # (services/LiveAggregates.py); the aggregate is re-read every LIVE_KPI_RESYNC
     async def handle(self, body):
         query_string = self.scope.get('query_string', b'').decode()
         params = dict(pair.split('=') for pair in query_string.split('&') if '=' in pair)
 
-        product_id = params.get('product_id')
-        start_time = params.get('start_time') 
-        end_time = params.get('end_time')
-        update_interval = float(params.get('update_interval', 5))
-
-        if not product_id:
-            await self.send_response(400, b'product_id parameter is required')
-            return
-
-        def parse_dt(dt_str):
-            if not dt_str:
-                return None
-            dt = parse_datetime(dt_str)
-
-            if dt and not dt.tzinfo:
-                dt = make_aware(dt)
-            return dt
-
-        start_dt = parse_dt(start_time)
-        if  not start_dt :
-            end_dt=None
-        else:
-            end_dt=start_dt+timedelta(days=1)
-        print(start_dt)
-        print(end_dt)
-
-        if start_dt is None:
-            min_bucket = await sync_to_async(
-                lambda: AverageSessionDuration.objects.aggregate(Min('bucket'))
-            )()
-
-            start_dt = min_bucket['bucket__min']
-        if end_dt is None:
-            max_bucket = await sync_to_async(
-                lambda: AverageSessionDuration.objects.aggregate(Max('bucket'))
-            )()
-
-            end_dt = max_bucket['bucket__max']
-
-        if start_dt is None or end_dt is None:
-            await self.send_response(404, b'No data available')
+        self.kpi_name = self.scope['url_route']['kwargs']['kpi']
+        self.kpi = LIVE_KPIS.get(self.kpi_name)
+        if self.kpi is None:
+            await self.send_response(404, b'Unknown KPI')
             return
-
         try:
-            product_id = int(product_id)
+            self.product_id = int(params.get('product_id', ''))
         except ValueError:
-            await self.send_response(400, b'Invalid product_id')
-            return
-
-        @sync_to_async
-        def get_queryset():
-            return list(AverageSessionDuration.objects.filter(
-            product_id=product_id,
-            bucket__gte=start_dt,
-            bucket__lte=end_dt).order_by('bucket'))
-
-
-
-        qs = await get_queryset()
-
-        headers = [
-            (b"Cache-Control", b"no-cache"),
-            (b"Content-Type", b"text/event-stream"),
-            (b"Transfer-Encoding", b"chunked"),
-            (b'Access-Control-Allow-Origin', b'http://localhost:5173'),
-            (b'Access-Control-Allow-Credentials', b'true')
-        ]
-        await self.send_headers(headers=headers)
-
-        async def send_sse(data_dict):
-            msg = f"data: {json.dumps(data_dict)}\n\n"
-            await self.send_body(msg.encode(), more_body=True)
-
-        initial_data = []
-        for event in qs:
-            initial_data.append({
-                "bucket": event.bucket.isoformat(),
-                "product_id": event.product_id,
-                "event_count": event.average_session_duration,
-            })
-
-        try:
-            await send_sse(initial_data)
-        except Exception:
-            return
-        
-class TotalRevenuePerCurrencyConsumer(AsyncHttpConsumer):
-    async def handle(self, body):
-        query_string = self.scope.get('query_string', b'').decode()
-        params = dict(pair.split('=') for pair in query_string.split('&') if '=' in pair)
-
-        product_id = params.get('product_id')
-        start_time = params.get('start_time') 
-        end_time = params.get('end_time')
-        update_interval = float(params.get('update_interval', 5))
-
-        if not product_id:
             await self.send_response(400, b'product_id parameter is required')
             return
 
-        def parse_dt(dt_str):
-            if not dt_str:
-                return None
-            dt = parse_datetime(dt_str)
-
-            if dt and not dt.tzinfo:
-                dt = make_aware(dt)
-            return dt
-
-        start_dt = parse_dt(start_time)
-        if  not start_dt :
-            end_dt=None
-        else:
-            end_dt=start_dt+timedelta(days=1)
-        print(start_dt)
-        print(end_dt)
-
-        if start_dt is None:
-            min_bucket = await sync_to_async(
-                lambda: TotalRevenuePerCurrency.objects.aggregate(Min('bucket'))
-            )()
-
-            start_dt = min_bucket['bucket__min']
-        if end_dt is None:
-            max_bucket = await sync_to_async(
-                lambda: TotalRevenuePerCurrency.objects.aggregate(Max('bucket'))
-            )()
-
-            end_dt = max_bucket['bucket__max']
-
-        if start_dt is None or end_dt is None:
-            await self.send_response(404, b'No data available')
-            return
-
-        try:
-            product_id = int(product_id)
-        except ValueError:
-            await self.send_response(400, b'Invalid product_id')
-            return
+        start_dt = parse_datetime(params.get('start_time', ''))
+        if start_dt and not start_dt.tzinfo:
+            start_dt = make_aware(start_dt)
+        start_dt = start_dt or datetime.now(timezone.utc) - timedelta(seconds=self.kpi.bucket * 24)
 
-        @sync_to_async
-        def get_queryset():
-            return list(TotalRevenuePerCurrency.objects.filter(
-            product_id=product_id,
-            bucket__gte=start_dt,
-            bucket__lte=end_dt).order_by('bucket'))
-
-
-
-        qs = await get_queryset()
+        self.group = live_group(self.kpi_name, self.product_id)
+        self.partials = {}
+        await self.channel_layer.group_add(self.group, self.channel_name)
+        await self.read_history(start_dt)
 
         headers = [
             (b"Cache-Control", b"no-cache"),
@@ -836,646 +314,40 @@ class TotalRevenuePerCurrencyConsumer(AsyncHttpConsumer):
             (b'Access-Control-Allow-Credentials', b'true')
         ]
         await self.send_headers(headers=headers)
+        await self.send_points(sorted(self.partials))
+        # the response stays open, send_sse_message streams the deltas
+        self.streaming = True
+
+    async def read_history(self, start_dt):
+        synced_at = time.time()
+        history = await sync_to_async(self.kpi.history)(self.product_id, start_dt)
+        self.synced_at = synced_at
+        # source -> `until` of its last delta counted on top of the aggregate
+        self.counted = {}
+        self.partials.update(history)
+
+    async def send_points(self, buckets):
+        points = [{**self.kpi.point(bucket, self.partials[bucket]), "product_id": self.product_id} for bucket in buckets]
+        await self.send_body(f"data: {json.dumps(points)}\n\n".encode(), more_body=True)
 
-        async def send_sse(data_dict):
-            msg = f"data: {json.dumps(data_dict)}\n\n"
-            await self.send_body(msg.encode(), more_body=True)
-
-        initial_data = []
-        for event in qs:
-            initial_data.append({
-                "bucket": event.bucket.isoformat(),
-                "product_id": event.product_id,
-                "currency": event.currency,
-                "event_count": event.total_amount,
-            })
-
-        try:
-            await send_sse(initial_data)
-        except Exception:
-            return
-        
-class ARPPUConsumer(AsyncHttpConsumer):
-    async def handle(self, body):
-        query_string = self.scope.get('query_string', b'').decode()
-        params = dict(pair.split('=') for pair in query_string.split('&') if '=' in pair)
-
-        product_id = params.get('product_id')
-        start_time = params.get('start_time') 
-        end_time = params.get('end_time')
-        update_interval = float(params.get('update_interval', 5))
-
-        if not product_id:
-            await self.send_response(400, b'product_id parameter is required')
-            return
-
-        def parse_dt(dt_str):
-            if not dt_str:
-                return None
-            dt = parse_datetime(dt_str)
-            
-
-            if dt and not dt.tzinfo:
-                dt = make_aware(dt)
-            return dt
-
-        start_dt = parse_dt(start_time)
-        if  not start_dt :
-            end_dt=None
+    async def send_sse_message(self, event):
+        if time.time() - self.synced_at > settings.LIVE_KPI_RESYNC:
+            await self.read_history(bucket_start(datetime.now(timezone.utc), self.kpi.bucket) - timedelta(seconds=self.kpi.bucket))
+        message = json.loads(event["text"])
+        counted = self.counted.get(message.get("source"), self.synced_at)
+        if message["until"] <= counted:
+            return  # in the aggregate already
+        buckets = sorted({entry["bucket"] for entry in message["buckets"]})
+        if message["since"] < counted:
+            # partly in the aggregate: read its buckets again, they hold all of it now
+            history = await sync_to_async(self.kpi.history)(self.product_id, parse_datetime(buckets[0]))
+            self.partials.update({bucket: history.get(bucket, {}) for bucket in buckets})
         else:
-            end_dt=start_dt+timedelta(days=1)
-        print(start_dt)
-        print(end_dt)
-        if start_dt is None:
-            min_bucket = await sync_to_async(
-                lambda: ARPPU.objects.aggregate(Min('bucket'))
-            )()
-
-            start_dt = min_bucket['bucket__min']
-        if end_dt is None:
-            max_bucket = await sync_to_async(
-                lambda: ARPPU.objects.aggregate(Max('bucket'))
-            )()
-
-            end_dt = max_bucket['bucket__max']
-
-        if start_dt is None or end_dt is None:
-            await self.send_response(404, b'No data available')
-            return
-
-        try:
-            product_id = int(product_id)
-        except ValueError:
-            await self.send_response(400, b'Invalid product_id')
-            return
-
-        @sync_to_async
-        def get_queryset():
-            return list(ARPPU.objects.filter(
-            product_id=product_id,
-            bucket__gte=start_dt,
-            bucket__lte=end_dt).order_by('bucket'))
-
-
-
-        qs = await get_queryset()
-
-        headers = [
-            (b"Cache-Control", b"no-cache"),
-            (b"Content-Type", b"text/event-stream"),
-            (b"Transfer-Encoding", b"chunked"),
-            (b'Access-Control-Allow-Origin', b'http://localhost:5173'),
-            (b'Access-Control-Allow-Credentials', b'true')
-        ]
-        await self.send_headers(headers=headers)
-
-        async def send_sse(data_dict):
-            msg = f"data: {json.dumps(data_dict)}\n\n"
-            await self.send_body(msg.encode(), more_body=True)
-
-        initial_data = []
-        for event in qs:
-            initial_data.append({
-                "bucket": event.bucket.isoformat(),
-                "product_id": event.product_id,
-                "event_count": event.arppu,
-            })
-
-        try:
-            await send_sse(initial_data)
-        except Exception:
-            return
-        
-"""class LevelCompletionRateConsumer(AsyncHttpConsumer):
-    async def handle(self, body):
-        query_string = self.scope.get('query_string', b'').decode()
-        params = dict(pair.split('=') for pair in query_string.split('&') if '=' in pair)
-
-        product_id = params.get('product_id')
-        start_time = params.get('start_time') 
-        end_time = params.get('end_time')
-        update_interval = float(params.get('update_interval', 5))
-
-        if not product_id:
-            await self.send_response(400, b'product_id parameter is required')
-            return
-
-        def parse_dt(dt_str):
-            if not dt_str:
-                return None
-            dt = parse_datetime(dt_str)
-
-            if dt and not dt.tzinfo:
-                dt = make_aware(dt)
-            return dt
-
-        start_dt = parse_dt(start_time)
-        if  not start_dt :
-            end_dt=None
-        else:
-            end_dt=start_dt+timedelta(days=1)
-        print(start_dt)
-        print(end_dt)
-
-        if start_dt is None:
-            min_bucket = await sync_to_async(
-                lambda: LevelCompletionRate.objects.aggregate(Min('bucket'))
-            )()
-
-            start_dt = min_bucket['bucket__min']
-        if end_dt is None:
-            max_bucket = await sync_to_async(
-                lambda: LevelCompletionRate.objects.aggregate(Max('bucket'))
-            )()
-
-            end_dt = max_bucket['bucket__max']
-
-        if start_dt is None or end_dt is None:
-            await self.send_response(404, b'No data available')
-            return
-
-        try:
-            product_id = int(product_id)
-        except ValueError:
-            await self.send_response(400, b'Invalid product_id')
-            return
-
-        @sync_to_async
-        def get_queryset():
-            return list(LevelCompletionRate.objects.filter(
-            product_id=product_id,
-            bucket__gte=start_dt,
-            bucket__lte=end_dt).order_by('bucket'))
-
-
-
-        qs = await get_queryset()
-
-        headers = [
-            (b"Cache-Control", b"no-cache"),
-            (b"Content-Type", b"text/event-stream"),
-            (b"Transfer-Encoding", b"chunked"),
-            (b'Access-Control-Allow-Origin', b'http://localhost:5173'),
-            (b'Access-Control-Allow-Credentials', b'true')
-        ]
-        await self.send_headers(headers=headers)
-
-        async def send_sse(data_dict):
-            msg = f"data: {json.dumps(data_dict)}\n\n"
-            await self.send_body(msg.encode(), more_body=True)
-
-        initial_data = []
-        for event in qs:
-            initial_data.append({
-                "bucket": event.bucket.isoformat(),
-                "product_id": event.product_id,
-                "progression01": event.progression01,
-                "completion_rate": event.completion_rate,
-            })
-
-        try:
-            await send_sse(initial_data)
-        except Exception:
-            return
-"""   
-"""   
-class AverageTriesPerLevelConsumer(AsyncHttpConsumer):
-    async def handle(self, body):
-        query_string = self.scope.get('query_string', b'').decode()
-        params = dict(pair.split('=') for pair in query_string.split('&') if '=' in pair)
-
-        product_id = params.get('product_id')
-        start_time = params.get('start_time') 
-        end_time = params.get('end_time')
-        update_interval = float(params.get('update_interval', 5))
-
-        if not product_id:
-            await self.send_response(400, b'product_id parameter is required')
-            return
-
-        def parse_dt(dt_str):
-            if not dt_str:
-                return None
-            dt = parse_datetime(dt_str)
-
-            if dt and not dt.tzinfo:
-                dt = make_aware(dt)
-            return dt
-
-        start_dt = parse_dt(start_time)
-        end_dt = parse_dt(end_time)
-
-        if start_dt is None:
-            min_bucket = await sync_to_async(
-                lambda: AverageTriesPerLevel.objects.aggregate(Min('bucket'))
-            )()
-
-            start_dt = min_bucket['bucket__min']
-        if end_dt is None:
-            max_bucket = await sync_to_async(
-                lambda: AverageTriesPerLevel.objects.aggregate(Max('bucket'))
-            )()
-
-            end_dt = max_bucket['bucket__max']
-
-        if start_dt is None or end_dt is None:
-            await self.send_response(404, b'No data available')
-            return
-
-        try:
-            product_id = int(product_id)
-        except ValueError:
-            await self.send_response(400, b'Invalid product_id')
-            return
-
-        @sync_to_async
-        def get_queryset():
-            return list(AverageTriesPerLevel.objects.filter(
-            product_id=product_id,
-            bucket__gte=start_dt,
-            bucket__lte=end_dt).order_by('bucket'))
-
-
-
-        qs = await get_queryset()
-
-        headers = [
-            (b"Cache-Control", b"no-cache"),
-            (b"Content-Type", b"text/event-stream"),
-            (b"Transfer-Encoding", b"chunked"),
-            (b'Access-Control-Allow-Origin', b'http://localhost:5173'),
-            (b'Access-Control-Allow-Credentials', b'true')
-        ]
-        await self.send_headers(headers=headers)
-
-        async def send_sse(data_dict):
-            msg = f"data: {json.dumps(data_dict)}\n\n"
-            await self.send_body(msg.encode(), more_body=True)
-
-        initial_data = []
-        for event in qs:
-            initial_data.append({
-                "bucket": event.bucket.isoformat(),
-                "product_id": event.product_id,
-                "progression01": event.progression01,
-                "avg_tries": event.avg_tries,
-            })
-
-        try:
-            await send_sse(initial_data)
-        except Exception:
-            return
-"""      
-"""
-class NetResourceFlowConsumer(AsyncHttpConsumer):
-    async def handle(self, body):
-        query_string = self.scope.get('query_string', b'').decode()
-        params = dict(pair.split('=') for pair in query_string.split('&') if '=' in pair)
-
-        product_id = params.get('product_id')
-        start_time = params.get('start_time') 
-        end_time = params.get('end_time')
-        update_interval = float(params.get('update_interval', 5))
-
-        if not product_id:
-            await self.send_response(400, b'product_id parameter is required')
-            return
-
-        def parse_dt(dt_str):
-            if not dt_str:
-                return None
-            dt = parse_datetime(dt_str)
-
-            if dt and not dt.tzinfo:
-                dt = make_aware(dt)
-            return dt
-
-        start_dt = parse_dt(start_time)
-        end_dt = parse_dt(end_time)
-
-        if start_dt is None:
-            min_bucket = await sync_to_async(
-                lambda: NetResourceFlow.objects.aggregate(Min('bucket'))
-            )()
-
-            start_dt = min_bucket['bucket__min']
-        if end_dt is None:
-            max_bucket = await sync_to_async(
-                lambda: NetResourceFlow.objects.aggregate(Max('bucket'))
-            )()
-
-            end_dt = max_bucket['bucket__max']
-
-        if start_dt is None or end_dt is None:
-            await self.send_response(404, b'No data available')
-            return
-
-        try:
-            product_id = int(product_id)
-        except ValueError:
-            await self.send_response(400, b'Invalid product_id')
-            return
-
-        @sync_to_async
-        def get_queryset():
-            return list(NetResourceFlow.objects.filter(
-            product_id=product_id,
-            bucket__gte=start_dt,
-            bucket__lte=end_dt).order_by('bucket'))
-
-
-
-        qs = await get_queryset()
-
-        headers = [
-            (b"Cache-Control", b"no-cache"),
-            (b"Content-Type", b"text/event-stream"),
-            (b"Transfer-Encoding", b"chunked"),
-            (b'Access-Control-Allow-Origin', b'http://localhost:5173'),
-            (b'Access-Control-Allow-Credentials', b'true')
-        ]
-        await self.send_headers(headers=headers)
-
-        async def send_sse(data_dict):
-            msg = f"data: {json.dumps(data_dict)}\n\n"
-            await self.send_body(msg.encode(), more_body=True)
-
-        initial_data = []
-        for event in qs:
-            initial_data.append({
-                "bucket": event.bucket.isoformat(),
-                "product_id": event.product_id,
-                "itemType": event.itemType,
-                "net_flow": event.net_flow,
-            })
-
-        try:
-            await send_sse(initial_data)
-        except Exception:
-            return
-"""       
-class CrashRateConsumer(AsyncHttpConsumer):
-    async def handle(self, body):
-        query_string = self.scope.get('query_string', b'').decode()
-        params = dict(pair.split('=') for pair in query_string.split('&') if '=' in pair)
-
-        product_id = params.get('product_id')
-        start_time = params.get('start_time') 
-        end_time = params.get('end_time')
-        update_interval = float(params.get('update_interval', 5))
-
-        if not product_id:
-            await self.send_response(400, b'product_id parameter is required')
-            return
-
-        def parse_dt(dt_str):
-            if not dt_str:
-                return None
-            dt = parse_datetime(dt_str)
-
-            if dt and not dt.tzinfo:
-                dt = make_aware(dt)
-            return dt
-
-        start_dt = parse_dt(start_time)
-        if  not start_dt :
-            end_dt=None
-        else:
-            end_dt=start_dt+timedelta(days=1)
-        print(start_dt)
-        print(end_dt)
-
-        if start_dt is None:
-            min_bucket = await sync_to_async(
-                lambda: CrashRate.objects.aggregate(Min('bucket'))
-            )()
-
-            start_dt = min_bucket['bucket__min']
-        if end_dt is None:
-            max_bucket = await sync_to_async(
-                lambda: CrashRate.objects.aggregate(Max('bucket'))
-            )()
-
-            end_dt = max_bucket['bucket__max']
-
-        if start_dt is None or end_dt is None:
-            await self.send_response(404, b'No data available')
-            return
-
-        try:
-            product_id = int(product_id)
-        except ValueError:
-            await self.send_response(400, b'Invalid product_id')
-            return
-
-        @sync_to_async
-        def get_queryset():
-            return list(CrashRate.objects.filter(
-            product_id=product_id,
-            bucket__gte=start_dt,
-            bucket__lte=end_dt).order_by('bucket'))
-
-
-
-        qs = await get_queryset()
-
-        headers = [
-            (b"Cache-Control", b"no-cache"),
-            (b"Content-Type", b"text/event-stream"),
-            (b"Transfer-Encoding", b"chunked"),
-            (b'Access-Control-Allow-Origin', b'http://localhost:5173'),
-            (b'Access-Control-Allow-Credentials', b'true')
-        ]
-        await self.send_headers(headers=headers)
-
-        async def send_sse(data_dict):
-            msg = f"data: {json.dumps(data_dict)}\n\n"
-            await self.send_body(msg.encode(), more_body=True)
-
-        initial_data = []
-        for event in qs:
-            initial_data.append({
-                "bucket": event.bucket.isoformat(),
-                "product_id": event.product_id,
-                "event_count": event.crash_ratio,
-            })
-
-        try:
-            await send_sse(initial_data)
-        except Exception:
-            return
-"""       
-class ResourceSinkRatioConsumer(AsyncHttpConsumer):
-    async def handle(self, body):
-        query_string = self.scope.get('query_string', b'').decode()
-        params = dict(pair.split('=') for pair in query_string.split('&') if '=' in pair)
-
-        product_id = params.get('product_id')
-        start_time = params.get('start_time') 
-        end_time = params.get('end_time')
-        update_interval = float(params.get('update_interval', 5))
-
-        if not product_id:
-            await self.send_response(400, b'product_id parameter is required')
-            return
-
-        def parse_dt(dt_str):
-            if not dt_str:
-                return None
-            dt = parse_datetime(dt_str)
-
-            if dt and not dt.tzinfo:
-                dt = make_aware(dt)
-            return dt
-
-        start_dt = parse_dt(start_time)
-        end_dt = parse_dt(end_time)
-
-        if start_dt is None:
-            min_bucket = await sync_to_async(
-                lambda: ResourceSinkRatio.objects.aggregate(Min('bucket'))
-            )()
-
-            start_dt = min_bucket['bucket__min']
-        if end_dt is None:
-            max_bucket = await sync_to_async(
-                lambda: ResourceSinkRatio.objects.aggregate(Max('bucket'))
-            )()
-
-            end_dt = max_bucket['bucket__max']
-
-        if start_dt is None or end_dt is None:
-            await self.send_response(404, b'No data available')
-            return
-
-        try:
-            product_id = int(product_id)
-        except ValueError:
-            await self.send_response(400, b'Invalid product_id')
-            return
-
-        @sync_to_async
-        def get_queryset():
-            return list(ResourceSinkRatio.objects.filter(
-            product_id=product_id,
-            bucket__gte=start_dt,
-            bucket__lte=end_dt).order_by('bucket'))
-
-
-
-        qs = await get_queryset()
-
-        headers = [
-            (b"Cache-Control", b"no-cache"),
-            (b"Content-Type", b"text/event-stream"),
-            (b"Transfer-Encoding", b"chunked"),
-            (b'Access-Control-Allow-Origin', b'http://localhost:5173'),
-            (b'Access-Control-Allow-Credentials', b'true')
-        ]
-        await self.send_headers(headers=headers)
-
-        async def send_sse(data_dict):
-            msg = f"data: {json.dumps(data_dict)}\n\n"
-            await self.send_body(msg.encode(), more_body=True)
-
-        initial_data = []
-        for event in qs:
-            initial_data.append({
-                "bucket": event.bucket.isoformat(),
-                "product_id": event.product_id,
-                "itemType": event.itemType,
-                "sink_rate": event.sink_rate,
-            })
-
-        try:
-            await send_sse(initial_data)
-        except Exception:
-            return
-        
-class TopErrorTypesConsumer(AsyncHttpConsumer):
-    async def handle(self, body):
-        query_string = self.scope.get('query_string', b'').decode()
-        params = dict(pair.split('=') for pair in query_string.split('&') if '=' in pair)
-
-        product_id = params.get('product_id')
-        start_time = params.get('start_time') 
-        end_time = params.get('end_time')
-        update_interval = float(params.get('update_interval', 5))
-
-        if not product_id:
-            await self.send_response(400, b'product_id parameter is required')
-            return
-
-        def parse_dt(dt_str):
-            if not dt_str:
-                return None
-            dt = parse_datetime(dt_str)
-
-            if dt and not dt.tzinfo:
-                dt = make_aware(dt)
-            return dt
-
-        start_dt = parse_dt(start_time)
-        end_dt = parse_dt(end_time)
-
-        if start_dt is None:
-            min_bucket = await sync_to_async(
-                lambda: TopErrorTypes.objects.aggregate(Min('bucket'))
-            )()
-
-            start_dt = min_bucket['bucket__min']
-        if end_dt is None:
-            max_bucket = await sync_to_async(
-                lambda: TopErrorTypes.objects.aggregate(Max('bucket'))
-            )()
-
-            end_dt = max_bucket['bucket__max']
-
-        if start_dt is None or end_dt is None:
-            await self.send_response(404, b'No data available')
-            return
-
-        try:
-            product_id = int(product_id)
-        except ValueError:
-            await self.send_response(400, b'Invalid product_id')
-            return
-
-        @sync_to_async
-        def get_queryset():
-            return list(TopErrorTypes.objects.filter(
-            product_id=product_id,
-            bucket__gte=start_dt,
-            bucket__lte=end_dt).order_by('bucket'))
-
-
-
-        qs = await get_queryset()
-
-        headers = [
-            (b"Cache-Control", b"no-cache"),
-            (b"Content-Type", b"text/event-stream"),
-            (b"Transfer-Encoding", b"chunked"),
-            (b'Access-Control-Allow-Origin', b'http://localhost:5173'),
-            (b'Access-Control-Allow-Credentials', b'true')
-        ]
-        await self.send_headers(headers=headers)
-
-        async def send_sse(data_dict):
-            msg = f"data: {json.dumps(data_dict)}\n\n"
-            await self.send_body(msg.encode(), more_body=True)
-
-        initial_data = []
-        for event in qs:
-            initial_data.append({
-                "bucket": event.bucket.isoformat(),
-                "product_id": event.product_id,
-                "message": event.message,
-                "occurrences": event.occurrences,
-            })
-
-        try:
-            await send_sse(initial_data)
-        except Exception:
-            return
-"""
\ No newline at end of file
+            for entry in message["buckets"]:
+                merge_partial(self.partials.setdefault(entry["bucket"], {}), entry["delta"], self.kpi.merge)
+        self.counted[message.get("source")] = message["until"]
+        await self.send_points(buckets)
+
+    async def disconnect(self):
+        if getattr(self, 'group', None):
+            await self.channel_layer.group_discard(self.group, self.channel_name)
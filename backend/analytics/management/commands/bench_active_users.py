@@ -0,0 +1,85 @@
+import random
+from datetime import date, timedelta
+
+from django.core.management.base import BaseCommand
+from django.db import connection
+from django.utils import timezone
+
+from analytics.services.ActiveUsers import WINDOW_DAYS, DistinctSketch, active_user_series
+
+
+class Command(BaseCommand):
+    help = (
+        "Measure the error of the sketch based DAU/WAU/MAU against exact distinct counts, on synthetic "
+        "activity (default) or on a product's events in gameevent (--product)."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('--clients', type=int, default=200_000)
+        parser.add_argument('--days', type=int, default=60)
+        parser.add_argument('--loyal', type=float, default=0.05, help="Share of clients active on most days.")
+        parser.add_argument('--seed', type=int, default=1)
+        parser.add_argument('--product', type=int, help="Compare with count(DISTINCT client_id) of this product instead.")
+
+    def handle(self, *args, **options):
+        if options['product'] is not None:
+            rows = self.product_rows(options['product'], options['days'])
+        else:
+            rows = self.synthetic_rows(options)
+
+        self.stdout.write(f"{'':<6} {'mean error':>11} {'max error':>10} {'exact (last day)':>17} {'estimate':>9}")
+        for name in WINDOW_DAYS:
+            errors = [abs(estimate[name] - exact[name]) / exact[name] for exact, estimate in rows if exact[name]]
+            exact, estimate = rows[-1]
+            self.stdout.write(
+                f"{name:<6} {sum(errors) / len(errors) * 100:10.2f}% {max(errors) * 100:9.2f}% {exact[name]:>17} {estimate[name]:>9}"
+            )
+        small = [abs(self.sketch(range(n)).estimate() - n) for n in range(1, 101)]
+        self.stdout.write(f"1-100 clients: largest absolute error {max(small):.2f}")
+
+    def sketch(self, clients):
+        sketch = DistinctSketch()
+        for client in clients:
+            sketch.add(client)
+        return sketch
+
+    def synthetic_rows(self, options):
+        """[(exact, estimate)] per day after the first 30, for loyal clients active on 80% of days and casual ones on 3%."""
+        rng = random.Random(options['seed'])
+        loyal = range(int(options['clients'] * options['loyal']))
+        casual = range(len(loyal), options['clients'])
+        actives, sketches = [], []
+        for _ in range(options['days']):
+            active = {client for client in loyal if rng.random() < 0.8}
+            active.update(rng.sample(casual, int(len(casual) * 0.03)))
+            actives.append(active)
+            sketches.append(self.sketch(active))
+
+        rows = []
+        for day in range(WINDOW_DAYS['mau'] - 1, options['days']):
+            exact, estimate = {}, {}
+            for name, days in WINDOW_DAYS.items():
+                exact[name] = len(set().union(*actives[day - days + 1:day + 1]))
+                estimate[name] = round(DistinctSketch.union(sketches[day - days + 1:day + 1]).estimate())
+            rows.append((exact, estimate))
+        return rows
+
+    def product_rows(self, product_id, days):
+        last_day = timezone.now().date()
+        series = active_user_series(product_id, last_day - timedelta(days=days - 1), last_day)
+        rows = []
+        with connection.cursor() as cursor:
+            for point in series:
+                day = date.fromisoformat(point['day'])
+                exact = {}
+                for name, window in WINDOW_DAYS.items():
+                    cursor.execute(
+                        """
+                        SELECT count(DISTINCT client_id) FROM gameevent
+                        WHERE product_id = %s AND time >= %s::date AND time < %s::date
+                        """,
+                        [product_id, day - timedelta(days=window - 1), day + timedelta(days=1)]
+                    )
+                    exact[name] = cursor.fetchone()[0]
+                rows.append((exact, point))
+        return rows
@@ -0,0 +1,177 @@
+import importlib
+import re
+import time
+
+from django.core.management.base import BaseCommand
+from django.db import connection
+
+from analytics.migrations._continuous_aggregates import aggregate_definitions
+
+layout = importlib.import_module('analytics.migrations.0020_EventTypeHypertables')
+
+# event type table -> SQL for its own columns, from the per-table sequence number n
+SYNTHETIC_COLUMNS = {
+    'bussinessevent': ["'shop'", "'item' || n % 20", "'sku' || n % 200", "(1 + random() * 99)::int", "(ARRAY['USD', 'EUR', 'GEM'])[1 + n % 3]"],
+    'errorevent': ["'error ' || n % 40", "(ARRAY['Info', 'Debug', 'Warning', 'Error', 'Critical'])[1 + n % 5]"],
+    'progeressionevent': ["(ARRAY['Start', 'Complete', 'Fail'])[1 + n % 3]", "'level' || n % 50", "''", "''", "random()"],
+    'qualityevent': ["30 + random() * 90", "256 + random() * 3840"],
+    'resourceevent': ["(ARRAY['Source', 'Sink'])[1 + n % 2]", "(ARRAY['gold', 'gems', 'wood'])[1 + n % 3]", "'res' || n % 10", "(1 + random() * 99)::int", "'gold'"],
+}
+
+# every aggregate that read a subtype table before migration 0020
+AGGREGATES = [
+    'averageFPS', 'averageMemoryUsage', 'totalRevenuePerCurrency', 'aRPPU', 'levelCompletionRate',
+    'averageTriesPerLevel', 'netResourceFlow', 'resourceSinkRatio', 'crashRate', 'topErrorTypes',
+]
+BEFORE, AFTER = '0019_ClientBigIntIds', '0020_EventTypeHypertables'
+
+CREATED_VIEW = re.compile(r'CREATE (MATERIALIZED )?VIEW (\w+)')
+
+
+class Command(BaseCommand):
+    help = (
+        "Compare continuous aggregate refresh time on the join-based subtype tables (before migration 0020) "
+        "and the per event type hypertables (after), on synthetic data in bench_* tables."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('--events', type=int, default=1_000_000)
+        parser.add_argument('--increment', type=int, default=50_000, help="Events added in the last hour before the incremental refresh.")
+        parser.add_argument('--days', type=int, default=7)
+        parser.add_argument('--products', type=int, default=20)
+        parser.add_argument('--clients', type=int, default=20_000)
+        parser.add_argument('--aggregate', action='append', choices=AGGREGATES, help="Benchmark only these aggregates (repeatable).")
+
+    def handle(self, *args, **options):
+        aggregates = options['aggregate'] or AGGREGATES
+        layouts = {
+            'join': self.definitions(BEFORE, aggregates, 'join'),
+            'hypertable': self.definitions(AFTER, aggregates, 'hypertable'),
+        }
+        try:
+            self.create_tables()
+            self.insert_events(1, options['events'], f"now() - interval '{options['days']} days' * (1 - i::float / {options['events']})", options)
+            full = {name: self.create_views(views) for name, views in layouts.items()}
+            self.insert_events(options['events'] + 1, options['increment'], "now() - interval '1 hour' * random()", options)
+            incremental = {name: self.refresh_views(views) for name, views in layouts.items()}
+        finally:
+            self.drop(layouts)
+
+        self.stdout.write(f"{'aggregate':<24} {'full join':>10} {'full hyper':>10} {'incr join':>10} {'incr hyper':>10}  (ms)")
+        for aggregate in aggregates:
+            self.stdout.write(
+                f"{aggregate:<24} {full['join'][aggregate] * 1000:10.0f} {full['hypertable'][aggregate] * 1000:10.0f} "
+                f"{incremental['join'][aggregate] * 1000:10.0f} {incremental['hypertable'][aggregate] * 1000:10.0f}"
+            )
+        for name in ('join', 'hypertable'):
+            self.stdout.write(f"total {name:<18} full {sum(full[name].values()):8.2f} s  incremental {sum(incremental[name].values()):8.2f} s")
+
+    def definitions(self, until, aggregates, prefix):
+        """aggregate -> [(view name, is materialized, create sql)] on the bench_* tables, views named bench_<prefix>_*."""
+        renames = {'gameevent': 'bench_gameevent'}
+        for table in SYNTHETIC_COLUMNS:
+            renames[table] = f'bench_{table}'
+            renames[f'analytics_{table}'] = f'bench_analytics_{table}'
+        definitions = {}
+        for name, statements, _ in aggregate_definitions(until):
+            if name not in aggregates:
+                continue
+            creates = [sql for sql in statements if sql.lstrip().startswith('CREATE')]
+            for sql in creates:
+                renames.update({view: f'bench_{prefix}_{view}' for _, view in CREATED_VIEW.findall(sql)})
+            definitions[name] = creates
+        pattern = re.compile(r'\b(' + '|'.join(map(re.escape, renames)) + r')\b')
+        return {
+            name: [
+                (renames[view], bool(materialized), pattern.sub(lambda match: renames[match.group(1)], sql))
+                for sql in creates
+                for materialized, view in CREATED_VIEW.findall(sql)
+            ]
+            for name, creates in definitions.items()
+        }
+
+    def create_tables(self):
+        with connection.cursor() as cursor:
+            cursor.execute(
+                """
+                CREATE TABLE bench_gameevent (id BIGINT, time TIMESTAMPTZ NOT NULL, client_id BIGINT, session_id BIGINT, product_id BIGINT);
+                SELECT create_hypertable('bench_gameevent', 'time', 'product_id', number_partitions => 32);
+                """
+            )
+            for table in SYNTHETIC_COLUMNS:
+                columns = layout.event_columns[table]
+                cursor.execute(
+                    f"""
+                    CREATE TABLE bench_analytics_{table} (
+                        id BIGINT GENERATED BY DEFAULT AS IDENTITY PRIMARY KEY, game_event BIGINT NOT NULL, {columns}
+                    );
+                    CREATE TABLE bench_{table} (
+                        game_event BIGINT NOT NULL, time TIMESTAMPTZ NOT NULL, client_id BIGINT, session_id BIGINT, product_id BIGINT, {columns}
+                    );
+                    SELECT create_hypertable('bench_{table}', 'time', 'product_id', number_partitions => 32);
+                    """
+                )
+
+    def insert_events(self, first_id, count, time_sql, options):
+        """Adds `count` events to bench_gameevent, spread over the event types, in both layouts."""
+        last_id = first_id + count - 1
+        with connection.cursor() as cursor:
+            cursor.execute(
+                f"""
+                INSERT INTO bench_gameevent (id, time, client_id, session_id, product_id)
+                SELECT i, {time_sql}, 1 + (i * 7919) % {options['clients']}, 1 + (i * 104729) % ({options['clients']} * 4), 1 + i % {options['products']}
+                FROM generate_series({first_id}, {last_id}) i
+                """
+            )
+            for index, (table, expressions) in enumerate(SYNTHETIC_COLUMNS.items()):
+                names = layout.column_names(layout.event_columns[table])
+                cursor.execute(
+                    f"""
+                    INSERT INTO bench_analytics_{table} (game_event{names})
+                    SELECT id, {', '.join(expressions)}
+                    FROM (SELECT id, id / {len(SYNTHETIC_COLUMNS)} AS n FROM bench_gameevent WHERE id BETWEEN {first_id} AND {last_id} AND id % {len(SYNTHETIC_COLUMNS)} = {index}) e
+                    """
+                )
+                cursor.execute(
+                    f"""
+                    INSERT INTO bench_{table} (game_event, time, client_id, session_id, product_id{names})
+                    SELECT ge.id, ge.time, ge.client_id, ge.session_id, ge.product_id{names.replace(', "', ', x."')}
+                    FROM bench_analytics_{table} x JOIN bench_gameevent ge ON ge.id = x.game_event
+                    WHERE x.game_event BETWEEN {first_id} AND {last_id}
+                    """
+                )
+            cursor.execute("ANALYZE bench_gameevent")
+            for table in SYNTHETIC_COLUMNS:
+                cursor.execute(f"ANALYZE bench_analytics_{table}; ANALYZE bench_{table}")
+
+    def create_views(self, views):
+        # creating a continuous aggregate materializes all existing data
+        timings = {}
+        with connection.cursor() as cursor:
+            for name, statements in views.items():
+                started = time.perf_counter()
+                for _, _, sql in statements:
+                    cursor.execute(sql)
+                timings[name] = time.perf_counter() - started
+        return timings
+
+    def refresh_views(self, views):
+        timings = {}
+        with connection.cursor() as cursor:
+            for name, statements in views.items():
+                started = time.perf_counter()
+                for view, materialized, _ in statements:
+                    if materialized:
+                        cursor.execute("CALL refresh_continuous_aggregate(%s, now() - interval '2 hours', NULL)", [view])
+                timings[name] = time.perf_counter() - started
+        return timings
+
+    def drop(self, layouts):
+        with connection.cursor() as cursor:
+            for views in layouts.values():
+                for statements in views.values():
+                    for view, materialized, _ in reversed(statements):
+                        cursor.execute(f"DROP {'MATERIALIZED VIEW' if materialized else 'VIEW'} IF EXISTS {view}")
+            for table in SYNTHETIC_COLUMNS:
+                cursor.execute(f"DROP TABLE IF EXISTS bench_{table}; DROP TABLE IF EXISTS bench_analytics_{table}")
+            cursor.execute("DROP TABLE IF EXISTS bench_gameevent")
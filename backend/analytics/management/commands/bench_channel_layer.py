@@ -0,0 +1,103 @@
+import asyncio
+import multiprocessing
+import statistics
+import time
+
+from asgiref.sync import async_to_sync
+from channels.layers import channel_layers
+from django.core.management.base import BaseCommand
+
+GROUP = 'bench.channel_layer'
+
+
+def receive(ready, results, messages, idle):
+    """Receiver process: joins GROUP and reports (latencies, first and last arrival) of what it got."""
+
+    async def run():
+        layer = channel_layers.make_backend('default')
+        channel = await layer.new_channel()
+        await layer.group_add(GROUP, channel)
+        ready.put(True)
+        latencies, arrivals = [], []
+        try:
+            while len(latencies) < messages:
+                message = await asyncio.wait_for(layer.receive(channel), idle)
+                arrived = time.time()
+                latencies.append(arrived - message['sent'])
+                arrivals.append(arrived)
+        except asyncio.TimeoutError:
+            pass
+        finally:
+            await layer.group_discard(GROUP, channel)
+            await layer.flush()
+        return latencies, arrivals
+
+    results.put(asyncio.run(run()))
+
+
+class Command(BaseCommand):
+    help = (
+        "Send group messages from this process to receivers in other processes over the configured channel "
+        "layer and report send throughput, delivery latency and lost messages."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('--receivers', type=int, default=4, help="Receiving processes, each with one channel in the group.")
+        parser.add_argument('--messages', type=int, default=5000)
+        parser.add_argument('--size', type=int, default=200, help="Bytes of padding per message; above ~7800 they go through the side table.")
+        parser.add_argument('--concurrency', type=int, default=64, help="group_send calls in flight at once.")
+        parser.add_argument('--sync', action='store_true', help="Send one message per async_to_sync call, as send_update_to_group does.")
+        parser.add_argument('--idle', type=float, default=5.0, help="Seconds a receiver waits for a message before giving up.")
+
+    def handle(self, *args, **options):
+        context = multiprocessing.get_context('fork')
+        ready, results = context.Queue(), context.Queue()
+        receivers = [
+            context.Process(target=receive, args=(ready, results, options['messages'], options['idle']))
+            for _ in range(options['receivers'])
+        ]
+        for receiver in receivers:
+            receiver.start()
+        for _ in receivers:
+            ready.get()
+
+        layer = channel_layers.make_backend('default')
+        padding = 'x' * options['size']
+        started = time.perf_counter()
+        if options['sync']:
+            for sequence in range(options['messages']):
+                async_to_sync(layer.group_send)(GROUP, self.message(sequence, padding))
+        else:
+            async_to_sync(self.send_all)(layer, options['messages'], options['concurrency'], padding)
+        elapsed = time.perf_counter() - started
+
+        reports = [results.get() for _ in receivers]
+        for receiver in receivers:
+            receiver.join()
+
+        latencies = sorted(latency for received, _ in reports for latency in received)
+        expected = options['messages'] * len(receivers)
+        self.stdout.write(f"sent     {options['messages']} messages of {options['size']} bytes in {elapsed:.2f}s, {options['messages'] / elapsed:.0f}/s")
+        self.stdout.write(f"received {len(latencies)} of {expected}, lost {expected - len(latencies)}")
+        for index, (received, arrivals) in enumerate(reports):
+            if len(arrivals) > 1:
+                self.stdout.write(f"receiver {index}: {len(received) / (arrivals[-1] - arrivals[0]):.0f} messages/s")
+        if len(latencies) > 1:
+            quantiles = statistics.quantiles(latencies, n=100)
+            self.stdout.write(
+                f"latency  p50 {quantiles[49] * 1000:.1f} ms  p95 {quantiles[94] * 1000:.1f} ms  "
+                f"p99 {quantiles[98] * 1000:.1f} ms  max {latencies[-1] * 1000:.1f} ms"
+            )
+
+    async def send_all(self, layer, messages, concurrency, padding):
+        pending = iter(range(messages))
+
+        async def sender():
+            for sequence in pending:
+                await layer.group_send(GROUP, self.message(sequence, padding))
+
+        await asyncio.gather(*(sender() for _ in range(concurrency)))
+        await layer.flush()
+
+    def message(self, sequence, padding):
+        return {'type': 'send.sse.message', 'text': padding, 'sequence': sequence, 'sent': time.time()}
@@ -0,0 +1,98 @@
+import statistics
+import time
+
+from django.core.management.base import BaseCommand
+from django.db import connection
+
+# Queries the dashboards and aggregates run, against one synthetic product (1)
+QUERIES = {
+    'last hour, one product': "SELECT count(*) FROM bench_chunks WHERE product_id = 1 AND time > %(end)s - interval '1 hour'",
+    'hourly week, one product': (
+        "SELECT time_bucket('1 hour', time), count(*) FROM bench_chunks "
+        "WHERE product_id = 1 AND time > %(end)s - interval '7 days' GROUP BY 1"
+    ),
+    'daily users, all products': (
+        "SELECT product_id, count(DISTINCT client_id) FROM bench_chunks "
+        "WHERE time > %(end)s - interval '1 day' GROUP BY 1"
+    ),
+}
+
+
+class Command(BaseCommand):
+    help = "Insert synthetic events into a gameevent-shaped hypertable with different chunk intervals and space partitions, and time inserts and queries."
+
+    def add_arguments(self, parser):
+        parser.add_argument('--rows', type=int, default=2_000_000)
+        parser.add_argument('--days', type=int, default=14)
+        parser.add_argument('--products', type=int, default=50)
+        parser.add_argument('--batch', type=int, default=5000, help="Rows per INSERT, in time order like the ingestion workers.")
+        parser.add_argument('--intervals', default='1 hour,6 hours,1 day,7 days')
+        parser.add_argument('--partitions', default='1,8,32')
+        parser.add_argument('--repeat', type=int, default=5, help="Runs of every query, the median is reported.")
+
+    def handle(self, *args, **options):
+        self.stdout.write(f"{'interval':<10} {'parts':>5} {'chunks':>7} {'avg MB':>8} {'rows/s':>10}  " + '  '.join(f'{name:>26}' for name in QUERIES) + "  (ms)")
+        for interval in options['intervals'].split(','):
+            for partitions in map(int, options['partitions'].split(',')):
+                try:
+                    self.create(interval.strip(), partitions)
+                    rate, end = self.insert(options)
+                    chunks, average = self.chunks()
+                    timings = [self.query(sql, end, options['repeat']) for sql in QUERIES.values()]
+                finally:
+                    with connection.cursor() as cursor:
+                        cursor.execute("DROP TABLE IF EXISTS bench_chunks")
+                self.stdout.write(
+                    f"{interval.strip():<10} {partitions:>5} {chunks:>7} {average / 2**20:>8.1f} {rate:>10.0f}  "
+                    + '  '.join(f'{timing * 1000:>26.1f}' for timing in timings)
+                )
+
+    def create(self, interval, partitions):
+        with connection.cursor() as cursor:
+            cursor.execute(
+                "CREATE TABLE bench_chunks (id BIGINT, time TIMESTAMPTZ NOT NULL, client_id BIGINT, session_id BIGINT, product_id BIGINT, client_event_id UUID)"
+            )
+            if partitions > 1:
+                cursor.execute(
+                    "SELECT create_hypertable('bench_chunks', 'time', 'product_id', number_partitions => %s, chunk_time_interval => %s::interval)",
+                    [partitions, interval]
+                )
+            else:
+                cursor.execute("SELECT create_hypertable('bench_chunks', 'time', chunk_time_interval => %s::interval)", [interval])
+                cursor.execute("CREATE INDEX ON bench_chunks (product_id, time DESC)")
+            cursor.execute("CREATE UNIQUE INDEX ON bench_chunks (client_event_id, time, product_id) WHERE client_event_id IS NOT NULL")
+
+    def insert(self, options):
+        rows, batch = options['rows'], options['batch']
+        seconds_per_row = options['days'] * 86400 / rows
+        started = time.perf_counter()
+        with connection.cursor() as cursor:
+            cursor.execute("SELECT now()")
+            end = cursor.fetchone()[0]
+            for first in range(0, rows, batch):
+                cursor.execute(
+                    """
+                    INSERT INTO bench_chunks (id, time, client_id, session_id, product_id, client_event_id)
+                    SELECT i, %s - make_interval(secs => (%s - i) * %s), 1 + (i * 7919) %% 100000, 1 + (i * 104729) %% 400000,
+                           1 + (i * 31) %% %s, gen_random_uuid()
+                    FROM generate_series(%s, %s) i
+                    """,
+                    [end, rows, seconds_per_row, options['products'], first, min(first + batch, rows) - 1]
+                )
+            cursor.execute("ANALYZE bench_chunks")
+        return rows / (time.perf_counter() - started), end
+
+    def chunks(self):
+        with connection.cursor() as cursor:
+            cursor.execute("SELECT count(*), COALESCE(avg(total_bytes), 0) FROM chunks_detailed_size('bench_chunks')")
+            return cursor.fetchone()
+
+    def query(self, sql, end, repeat):
+        timings = []
+        with connection.cursor() as cursor:
+            for _ in range(repeat):
+                started = time.perf_counter()
+                cursor.execute(sql, {'end': end})
+                cursor.fetchall()
+                timings.append(time.perf_counter() - started)
+        return statistics.median(timings)
@@ -0,0 +1,53 @@
+import time
+from datetime import datetime, timedelta, timezone
+
+from django.core.management.base import BaseCommand
+
+from analytics.management.commands.bench_event_schemas import SAMPLE_PAYLOADS
+from analytics.services.EventCodec import decode_event, encode_event
+from analytics.services.EventSchemas import EVENT_SCHEMAS
+
+CODECS = {
+    'json': ('application/json', False),
+    'msgpack': ('application/msgpack', False),
+    'msgpack+zstd': ('application/msgpack', True),
+}
+
+
+class Command(BaseCommand):
+    help = "Compare bytes on the wire and decode cost per event of JSON, MessagePack and MessagePack+zstd bodies."
+
+    def add_arguments(self, parser):
+        parser.add_argument('--count', type=int, default=20000)
+
+    def handle(self, *args, **options):
+        count = options['count']
+        start = datetime.now(timezone.utc)
+        self.stdout.write(f"{'event type':<18} {'codec':<13} {'bytes':>6} {'decode us':>10} {'decode+validate us':>19}")
+        for event_type, payload in SAMPLE_PAYLOADS.items():
+            events = [
+                {'client': 123456789, 'session': 987654321012, 'time': start + timedelta(milliseconds=i), **payload}
+                for i in range(count)
+            ]
+            for codec, (content_type, compress) in CODECS.items():
+                if content_type == 'application/json':
+                    # the SDKs send ISO-8601 strings in JSON
+                    messages = [encode_event({**event, 'time': event['time'].isoformat()}, content_type, compress) for event in events]
+                else:
+                    messages = [encode_event(event, content_type, compress) for event in events]
+                size = sum(len(body) for body, _ in messages) / count
+
+                started = time.perf_counter()
+                for body, encoding in messages:
+                    decode_event(body, content_type, encoding)
+                decode = (time.perf_counter() - started) / count
+
+                schema = EVENT_SCHEMAS[event_type]
+                started = time.perf_counter()
+                for body, encoding in messages:
+                    data = decode_event(body, content_type, encoding)
+                    data['product'] = 1
+                    schema.validate(data)
+                validate = (time.perf_counter() - started) / count
+
+                self.stdout.write(f"{event_type:<18} {codec:<13} {size:>6.0f} {decode * 1e6:>10.2f} {validate * 1e6:>19.2f}")
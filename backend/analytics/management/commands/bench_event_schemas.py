@@ -0,0 +1,69 @@
+import time
+from datetime import datetime, timedelta, timezone
+
+from django.core.management.base import BaseCommand
+
+from analytics.management.commands.bench_ingest import PAYLOADS
+from analytics.serializers import SessionStartEventSerializer, SessionEndEventSerializer, BussinessEventSerializer, ErrorEventSerializer, ProgeressionEventSerializer, QualityEventSerializer, ResourceEventSerializer
+from analytics.services.EventSchemas import EVENT_SCHEMAS
+
+SAMPLE_PAYLOADS = {
+    'start_session': {'platform': 'android'},
+    'end_session': {},
+    **PAYLOADS,
+}
+
+SERIALIZERS = {
+    'start_session': SessionStartEventSerializer,
+    'end_session': SessionEndEventSerializer,
+    'business_event': BussinessEventSerializer,
+    'error_event': ErrorEventSerializer,
+    'progression_event': ProgeressionEventSerializer,
+    'quality_event': QualityEventSerializer,
+    'resource_event': ResourceEventSerializer,
+}
+
+
+class Command(BaseCommand):
+    help = "Measure validated events per second of the ingest schemas for each event type."
+
+    def add_arguments(self, parser):
+        parser.add_argument('--count', type=int, default=50000)
+        parser.add_argument('--compare-serializers', action='store_true',
+                            help="also run the DRF serializers (needs client/session/product ids that exist in the database)")
+        parser.add_argument('--client', type=int, default=1)
+        parser.add_argument('--session', type=int, default=1)
+        parser.add_argument('--product', type=int, default=1)
+
+    def handle(self, *args, **options):
+        count = options['count']
+        start = datetime.now(timezone.utc)
+        header = f"{'event type':<20}{'schema ev/s':>14}"
+        if options['compare_serializers']:
+            header += f"{'serializer ev/s':>18}{'speedup':>10}"
+        self.stdout.write(header)
+
+        for event_type, schema in EVENT_SCHEMAS.items():
+            payloads = []
+            for i in range(count):
+                data = {'client': options['client'], 'session': options['session'], 'product': options['product'],
+                        'time': (start + timedelta(milliseconds=i)).isoformat()}
+                data.update(SAMPLE_PAYLOADS[event_type])
+                payloads.append(data)
+
+            started = time.perf_counter()
+            for data in payloads:
+                schema.validate(data)
+            schema_rate = count / (time.perf_counter() - started)
+            line = f"{event_type:<20}{schema_rate:>14.0f}"
+
+            if options['compare_serializers']:
+                serializer_class = SERIALIZERS[event_type]
+                sample = payloads[:max(1, count // 50)]
+                started = time.perf_counter()
+                for data in sample:
+                    serializer_class(data=data).is_valid()
+                serializer_rate = len(sample) / (time.perf_counter() - started)
+                line += f"{serializer_rate:>18.0f}{schema_rate / serializer_rate:>9.1f}x"
+
+            self.stdout.write(line)
@@ -0,0 +1,95 @@
+import random
+import statistics
+import threading
+import time
+import uuid
+
+from django.core.management.base import BaseCommand
+from django.db import connection
+from rest_framework.test import APIRequestFactory
+
+from analytics.models import Client, CustomUser, Product, Token
+from analytics.services.HandshakeCache import handshake_cache
+from analytics.views import TokenView
+
+
+class ProbingTokenView(TokenView):
+    """The handshake as it was: random ids from 1..100000, checked one by one."""
+
+    def create_client(self, token_obj):
+        for _ in range(10):
+            random_id = random.randint(1, 100000)
+            if not Client.objects.filter(id=random_id).exists():
+                break
+        else:
+            raise ValueError("Could not generate a unique client ID.")
+        return Client.objects.create(id=random_id, token=token_obj)
+
+
+class Command(BaseCommand):
+    help = "Run concurrent TokenView handshakes against the configured database and report throughput, latency and failures."
+
+    def add_arguments(self, parser):
+        parser.add_argument('--threads', type=int, default=16)
+        parser.add_argument('--count', type=int, default=200, help="Handshakes per thread.")
+        parser.add_argument('--uncached', action='store_true', help="Also run with the handshake cache emptied before every request.")
+        parser.add_argument('--probing', action='store_true', help="Also run the old random-probe allocator (uses ids 1..100000).")
+
+    def handle(self, *args, **options):
+        suffix = uuid.uuid4().hex[:12]
+        owner = CustomUser.objects.create(username=f'bench_{suffix}', email=f'bench_{suffix}@example.com', rb_username=f'bench_{suffix}', rb_password='')
+        product = Product.objects.create(name=f'bench_{suffix}', owner=owner)
+        token = Token.objects.create(name='bench', value=f'bench_{suffix}', Product=product)
+
+        runs = {'cached': (TokenView, False)}
+        if options['uncached']:
+            runs['uncached'] = (TokenView, True)
+        if options['probing']:
+            runs['random probe'] = (ProbingTokenView, True)
+        try:
+            for name, (view, uncached) in runs.items():
+                self.report(name, *self.run(view.as_view(), token.value, options['threads'], options['count'], uncached))
+        finally:
+            # clients go with the token
+            owner.delete()
+
+    def run(self, view, token_value, threads, count, uncached):
+        factory = APIRequestFactory()
+        latencies, failures = [], []
+        lock = threading.Lock()
+        barrier = threading.Barrier(threads)
+
+        def handshakes():
+            mine, failed = [], 0
+            barrier.wait()
+            try:
+                for _ in range(count):
+                    request = factory.get('/api/token/', HTTP_AUTHORIZATION=token_value)
+                    if uncached:
+                        handshake_cache.clear()
+                    started = time.perf_counter()
+                    response = view(request)
+                    mine.append(time.perf_counter() - started)
+                    # id collisions between racing handshakes come back as 500s
+                    if response.status_code != 200:
+                        failed += 1
+            finally:
+                connection.close()
+            with lock:
+                latencies.extend(mine)
+                failures.append(failed)
+
+        workers = [threading.Thread(target=handshakes) for _ in range(threads)]
+        started = time.perf_counter()
+        for worker in workers:
+            worker.start()
+        for worker in workers:
+            worker.join()
+        return time.perf_counter() - started, latencies, sum(failures)
+
+    def report(self, name, elapsed, latencies, failures):
+        quantiles = statistics.quantiles(latencies, n=100)
+        self.stdout.write(
+            f"{name:<16} {len(latencies) / elapsed:8.1f} handshakes/s  "
+            f"p50 {quantiles[49] * 1000:6.1f} ms  p99 {quantiles[98] * 1000:6.1f} ms  failed {failures}"
+        )
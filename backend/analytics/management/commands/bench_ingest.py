@@ -0,0 +1,129 @@
+import json
+import time
+import uuid
+from datetime import datetime, timedelta, timezone
+
+from django.core.management.base import BaseCommand
+from django.db import transaction
+
+from analytics.celery_consumers import IngestionStep, batch_settings
+from analytics.models import CustomUser, Product, Token, Client, Session
+from analytics.services.EventBatcher import EventBatcher
+from analytics.services.IdAllocator import client_ids
+from analytics.services.StagingWriter import merge_staged_events, write_staged_events
+
+PAYLOADS = {
+    'business_event': {'cartType': 'shop', 'itemType': 'gems', 'itemId': 'gem_pack_1', 'amount': 499, 'currency': 'USD'},
+    'error_event': {'message': 'NullReferenceException in Update()', 'severity': 'Error'},
+    'progression_event': {'progressionStatus': 'Complete', 'progression01': 'world_1', 'progression02': 'level_3', 'progression03': 'stage_2', 'value': 1200.0},
+    'quality_event': {'FPS': 58.5, 'memoryUsage': 812.25},
+    'resource_event': {'flowType': 'Sink', 'itemType': 'coins', 'itemId': 'coin', 'amount': 25, 'resourceCurrency': 'gold'},
+}
+
+
+def create_fixtures():
+    suffix = uuid.uuid4().hex[:12]
+    owner = CustomUser.objects.create(username=f'bench_{suffix}', email=f'bench_{suffix}@example.com', rb_username=f'bench_{suffix}', rb_password='')
+    product = Product.objects.create(name=f'bench_{suffix}', owner=owner)
+    token = Token.objects.create(name='bench', value=f'bench_{suffix}', Product=product)
+    client = Client.objects.create(id=client_ids.next(), token=token)
+    return Session.objects.create(client=client, token=token, start_time=datetime.now(timezone.utc), platform='pc')
+
+
+def build_bodies(event_type, session, count, duplicate_ratio=0.0):
+    """
+    JSON bodies of `count` events. With a duplicate_ratio the events carry event
+    ids and that fraction of them is sent a second time, as after a redelivery.
+    """
+    start = session.start_time
+    bodies = []
+    for i in range(count):
+        data = {'client': session.client_id, 'session': session.id, 'time': (start + timedelta(milliseconds=i)).isoformat()}
+        if duplicate_ratio:
+            data['event_id'] = str(uuid.uuid4())
+        data.update(PAYLOADS[event_type])
+        bodies.append(json.dumps(data))
+    if duplicate_ratio:
+        bodies += bodies[:int(count * duplicate_ratio)]
+    return bodies
+
+
+def build_envelopes(event_type, session, count, size):
+    """The events of build_bodies packed `size` per batch envelope."""
+    events = [json.loads(body) for body in build_bodies(event_type, session, count)]
+    return [
+        json.dumps({'session': session.id, 'client': session.client_id, 'events': [
+            {key: value for key, value in event.items() if key not in ('session', 'client')} for event in events[i:i + size]
+        ]})
+        for i in range(0, count, size)
+    ]
+
+
+class FakeMessage:
+    def __init__(self, delivery_tag, routing_key):
+        self.delivery_tag = delivery_tag
+        self.delivery_info = {'routing_key': routing_key}
+        self.content_type = 'application/json'
+        self.content_encoding = 'utf-8'
+
+    def ack(self, multiple=False):
+        pass
+
+    def reject(self, requeue=False):
+        pass
+
+
+class Command(BaseCommand):
+    help = "Compare ingest throughput of per-message and batched persistence against the configured database."
+
+    def add_arguments(self, parser):
+        parser.add_argument('--event-type', default='quality_event', choices=sorted(PAYLOADS))
+        parser.add_argument('--count', type=int, default=5000)
+        parser.add_argument('--batch-size', type=int, default=None)
+        parser.add_argument('--staging', action='store_true', help="Also measure COPY into the unlogged staging table and the merge that follows.")
+        parser.add_argument('--duplicate-ratio', type=float, default=0.0, help="Give events ids and redeliver this fraction of them.")
+        parser.add_argument('--envelope-size', type=int, default=0, help="Also measure batch envelopes of this many events per message.")
+
+    def handle(self, *args, **options):
+        event_type = options['event_type']
+        count = options['count']
+        batch_size = options['batch_size'] or batch_settings(event_type)['size']
+
+        # everything written by the benchmark is rolled back at the end
+        with transaction.atomic():
+            session = create_fixtures()
+            # fresh event ids for every run, otherwise later runs would only see duplicates
+            bodies = lambda: build_bodies(event_type, session, count, options['duplicate_ratio'])
+
+            per_message = self.run(event_type, bodies(), batcher=None)
+            batched = self.run(event_type, bodies(), batcher=lambda acks: EventBatcher(event_type, batch_size, interval_ms=10 ** 9, acks=acks))
+            if options['staging']:
+                staged = self.run(event_type, bodies(), batcher=lambda acks: EventBatcher(event_type, batch_size, interval_ms=10 ** 9, writer=write_staged_events, acks=acks))
+                started = time.perf_counter()
+                merge_staged_events(event_type, count)
+                merged = time.perf_counter() - started
+            if options['envelope_size']:
+                enveloped = self.run(event_type, build_envelopes(event_type, session, count, options['envelope_size']), batcher=None)
+
+            transaction.set_rollback(True)
+
+        redelivered = int(count * options['duplicate_ratio'])
+        self.stdout.write(f"{event_type}: {count} events" + (f", {redelivered} of them redelivered" if redelivered else ''))
+        self.stdout.write(f"  per-message : {count / per_message:10.1f} events/s")
+        self.stdout.write(f"  batched ({batch_size:>4}): {count / batched:10.1f} events/s ({per_message / batched:.1f}x)")
+        if options['staging']:
+            self.stdout.write(f"  staged  ({batch_size:>4}): {count / staged:10.1f} events/s ({per_message / staged:.1f}x)")
+            self.stdout.write(f"  merge         : {count / merged:10.1f} events/s")
+        if options['envelope_size']:
+            self.stdout.write(f"  envelopes ({options['envelope_size']:>2}): {count / enveloped:10.1f} events/s ({per_message / enveloped:.1f}x)")
+
+    def run(self, event_type, bodies, batcher):
+        step = IngestionStep(None)
+        if batcher is not None:
+            step.batchers = {event_type: batcher(step.acks)}
+        routing_key = f'bench.analytic.{event_type}'
+        started = time.perf_counter()
+        for tag, body in enumerate(bodies, start=1):
+            step.handle_message(body, FakeMessage(tag, routing_key))
+        step.flush_pending()
+        return time.perf_counter() - started
@@ -0,0 +1,106 @@
+import asyncio
+import time
+from collections import deque
+
+import asyncpg
+from django.conf import settings
+from django.core.management.base import BaseCommand
+from django.db import connection
+
+from analytics.celery_consumers import IngestionStep, batch_settings
+from analytics.management.commands.bench_ingest import PAYLOADS, FakeMessage, build_bodies, create_fixtures
+from analytics.services.AsyncIngest import AsyncEventStore, AsyncIngestor
+from analytics.services.EventBatcher import EventBatcher
+from analytics.services.EventWriter import EVENT_MODELS
+
+
+class MemoryMessage:
+    """aio-pika style message served by MemoryBroker."""
+
+    def __init__(self, broker, body, routing_key):
+        self.broker = broker
+        self.body = body.encode()
+        self.routing_key = routing_key
+        self.headers = {}
+        self.content_type = 'application/json'
+        self.content_encoding = 'utf-8'
+
+    async def ack(self):
+        self.broker.acked += 1
+
+    async def reject(self, requeue=False):
+        self.broker.rejected += 1
+
+
+class MemoryBroker:
+    """Local stand-in for RabbitMQ: a queue of ready messages and settle counters."""
+
+    def __init__(self, bodies, routing_key):
+        self.ready = deque(MemoryMessage(self, body, routing_key) for body in bodies)
+        self.acked = self.rejected = 0
+
+
+class Command(BaseCommand):
+    help = "Compare events/s and events per CPU second of the Celery bootstep path and the asyncio daemon over an in-memory broker."
+
+    def add_arguments(self, parser):
+        parser.add_argument('--event-type', default='quality_event', choices=sorted(PAYLOADS))
+        parser.add_argument('--count', type=int, default=20000)
+        parser.add_argument('--concurrency', type=int, default=256)
+
+    def handle(self, *args, **options):
+        event_type, count = options['event_type'], options['count']
+        session = create_fixtures()
+        bodies = build_bodies(event_type, session, count)
+        routing_key = f'bench.analytic.{event_type}'
+        try:
+            results = {
+                'bootstep (batched)': self.run_bootstep(event_type, bodies, routing_key),
+                f"asyncio ({options['concurrency']} in flight)": asyncio.run(self.run_async(bodies, routing_key, options['concurrency'])),
+            }
+        finally:
+            self.cleanup(session)
+
+        self.stdout.write(f"{event_type}: {count} events")
+        for name, (wall, cpu) in results.items():
+            self.stdout.write(f"  {name:<26}: {count / wall:10.1f} events/s {count / cpu:10.1f} events/cpu-s")
+
+    def run_bootstep(self, event_type, bodies, routing_key):
+        step = IngestionStep(None)
+        config = batch_settings(event_type)
+        step.batchers = {event_type: EventBatcher(event_type, config['size'], interval_ms=10 ** 9, acks=step.acks)}
+        wall, cpu = time.perf_counter(), time.process_time()
+        for tag, body in enumerate(bodies, start=1):
+            step.handle_message(body, FakeMessage(tag, routing_key))
+        step.flush_pending()
+        return time.perf_counter() - wall, time.process_time() - cpu
+
+    async def run_async(self, bodies, routing_key, concurrency):
+        database = settings.DATABASES['default']
+        pool = await asyncpg.create_pool(
+            host=database['HOST'], port=database['PORT'] or None, user=database['USER'],
+            password=database['PASSWORD'], database=database['NAME'],
+        )
+        broker = MemoryBroker(bodies, routing_key)
+        ingestor = AsyncIngestor(AsyncEventStore(pool), None, concurrency, batch_settings)
+        wall, cpu = time.perf_counter(), time.process_time()
+        while broker.ready:
+            await ingestor.on_message(broker.ready.popleft())
+        await ingestor.drain()
+        elapsed = time.perf_counter() - wall, time.process_time() - cpu
+        await pool.close()
+        if broker.acked != len(bodies):
+            self.stderr.write(f"asyncio path acked {broker.acked} and rejected {broker.rejected} of {len(bodies)}")
+        return elapsed
+
+    def cleanup(self, session):
+        with connection.cursor() as cursor:
+            for model, _ in EVENT_MODELS.values():
+                cursor.execute(
+                    f"DELETE FROM {connection.ops.quote_name(model._meta.db_table)} WHERE session_id = %s",
+                    [session.id]
+                )
+            cursor.execute("DELETE FROM gameevent WHERE session_id = %s", [session.id])
+        owner = session.token.Product.owner
+        session.token.Product.delete()
+        owner.delete()
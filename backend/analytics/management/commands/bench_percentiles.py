@@ -0,0 +1,56 @@
+import time
+from datetime import datetime, timedelta, timezone
+
+from django.core.management.base import BaseCommand
+from django.db import connection
+
+from analytics.services.Percentiles import QUANTILES, SKETCH_MODELS, range_sketch
+
+COLUMNS = {'fps': '"FPS"', 'memory_usage': '"memoryUsage"'}
+
+
+class Command(BaseCommand):
+    help = (
+        "Compare p50-p99 of a product's FPS or memory usage read from the quantile sketches with "
+        "percentile_cont over the raw qualityevent rows: query time and relative error, for several ranges."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('product', type=int)
+        parser.add_argument('--metric', default='fps', choices=list(SKETCH_MODELS))
+        parser.add_argument('--hours', type=int, action='append', help="Range lengths to compare (repeatable, default 24, 168 and 720).")
+        parser.add_argument('--repeat', type=int, default=5)
+
+    def handle(self, *args, **options):
+        end = datetime.now(timezone.utc).replace(minute=0, second=0, microsecond=0)
+        self.stdout.write(f"{'hours':>6} {'events':>10} {'sketch ms':>10} {'raw ms':>10}  " + ' '.join(f"{name + ' err':>8}" for name in QUANTILES))
+        for hours in options['hours'] or [24, 168, 720]:
+            start = end - timedelta(hours=hours)
+            sketch_seconds, sketch = self.timed(options['repeat'], lambda: range_sketch(options['metric'], options['product'], start, end))
+            raw_seconds, (events, exact) = self.timed(options['repeat'], lambda: self.exact(options['metric'], options['product'], start, end))
+            estimates = sketch.quantiles()
+            errors = [
+                f"{abs(estimates[name] - value) / value * 100:7.2f}%" if value and estimates[name] is not None else f"{'-':>8}"
+                for name, value in zip(QUANTILES, exact or [None] * len(QUANTILES))
+            ]
+            self.stdout.write(f"{hours:>6} {events:>10} {sketch_seconds * 1000:>10.1f} {raw_seconds * 1000:>10.1f}  " + ' '.join(errors))
+
+    def timed(self, repeat, query):
+        """(median seconds, last result) of `repeat` runs."""
+        timings = []
+        for _ in range(repeat):
+            started = time.perf_counter()
+            result = query()
+            timings.append(time.perf_counter() - started)
+        return sorted(timings)[len(timings) // 2], result
+
+    def exact(self, metric, product_id, start, end):
+        with connection.cursor() as cursor:
+            cursor.execute(
+                f"""
+                SELECT count(*), percentile_cont(%s::float8[]) WITHIN GROUP (ORDER BY {COLUMNS[metric]})
+                FROM qualityevent WHERE product_id = %s AND time >= %s AND time < %s
+                """,
+                [list(QUANTILES.values()), product_id, start, end]
+            )
+            return cursor.fetchone()
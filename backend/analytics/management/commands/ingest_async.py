@@ -0,0 +1,100 @@
+import asyncio
+import signal
+
+import aio_pika
+import asyncpg
+from django.conf import settings
+from django.core.management.base import BaseCommand
+
+from analytics.celery_consumers import batch_settings
+from analytics.services.AsyncIngest import AsyncEventStore, AsyncFailurePolicy, AsyncIngestor
+from analytics.services.EventHandlers import EVENT_HANDLERS
+from analytics.services.FailurePolicy import FailurePolicy
+from analytics.services.IngestMetrics import start_metrics_server
+from analytics.services.LiveAggregates import live_kpis
+from analytics.services.Sharding import owns
+
+
+def wanted(queue_name, product_id):
+    parts = queue_name.split('.')
+    return len(parts) > 2 and parts[2] in EVENT_HANDLERS and owns(product_id)
+
+
+class Command(BaseCommand):
+    help = "Run the event ingestion consumers on asyncio (aio-pika + asyncpg) instead of Celery bootsteps."
+
+    def add_arguments(self, parser):
+        parser.add_argument('--concurrency', type=int, default=256, help="Messages processed at the same time.")
+        parser.add_argument('--prefetch', type=int, default=None, help="AMQP prefetch, including messages waiting in batches (default 4 x concurrency).")
+        parser.add_argument('--pool-size', type=int, default=10)
+
+    def handle(self, *args, **options):
+        asyncio.run(self.serve(options['concurrency'], options['prefetch'] or 4 * options['concurrency'], options['pool_size']))
+
+    async def serve(self, concurrency, prefetch, pool_size):
+        database = settings.DATABASES['default']
+        pool = await asyncpg.create_pool(
+            host=database['HOST'], port=database['PORT'] or None, user=database['USER'],
+            password=database['PASSWORD'], database=database['NAME'], max_size=pool_size,
+        )
+        connection = await aio_pika.connect_robust(settings.CELERY_BROKER_URL)
+        channel = await connection.channel()
+        await channel.set_qos(prefetch_count=prefetch)
+
+        store = AsyncEventStore(pool)
+        ingestor = AsyncIngestor(store, AsyncFailurePolicy(channel, FailurePolicy(None, None)), concurrency, batch_settings)
+        consumers = {}
+
+        async def reconcile():
+            products = {name: product_id for name, product_id in await store.event_queues() if wanted(name, product_id)}
+            ingestor.products = products
+            queues = set(products)
+            for name in sorted(queues - set(consumers)):
+                queue = await channel.declare_queue(name, durable=True)
+                consumers[name] = (queue, await queue.consume(ingestor.on_message))
+                self.stdout.write(f"consuming from {name}")
+            for name in sorted(set(consumers) - queues):
+                queue, tag = consumers.pop(name)
+                await queue.cancel(tag)
+                self.stdout.write(f"stopped consuming from {name}")
+
+        stopping = asyncio.Event()
+        loop = asyncio.get_running_loop()
+        for sig in (signal.SIGINT, signal.SIGTERM):
+            loop.add_signal_handler(sig, stopping.set)
+
+        async def periodic(interval, job):
+            while not stopping.is_set():
+                try:
+                    await asyncio.wait_for(stopping.wait(), interval)
+                except asyncio.TimeoutError:
+                    try:
+                        await job()
+                    except Exception as e:
+                        self.stderr.write(f"{job.__name__} failed: {e}")
+
+        start_metrics_server()
+        await reconcile()
+        flush_interval = min(batcher.interval for batcher in ingestor.batchers.values())
+        jobs = [
+            asyncio.create_task(periodic(flush_interval, ingestor.flush_due)),
+            asyncio.create_task(periodic(settings.INGEST_QUEUE_RECONCILE_INTERVAL, reconcile)),
+        ]
+        if settings.LIVE_KPI_INTERVAL:
+            jobs.append(asyncio.create_task(periodic(settings.LIVE_KPI_INTERVAL, live_kpis.flush_async)))
+        self.stdout.write(f"ingesting with {concurrency} concurrent events, prefetch {prefetch}")
+        await stopping.wait()
+
+        # stop deliveries, finish what was received, then ack it all before closing
+        self.stdout.write("draining")
+        for queue, tag in consumers.values():
+            await queue.cancel(tag)
+        await asyncio.gather(*jobs)
+        await ingestor.drain()
+        if settings.LIVE_KPI_INTERVAL:
+            await live_kpis.flush_async()
+        await channel.close()
+        await connection.close()
+        await pool.close()
+        for event_type, counts in sorted(ingestor.stats.items()):
+            self.stdout.write(f"{event_type:<18} {dict(counts)}")
@@ -0,0 +1,34 @@
+from collections import Counter
+
+from django.conf import settings
+from django.core.management.base import BaseCommand
+
+from analytics.models import Queue as db_queue
+from analytics.services.Sharding import shard_for
+
+
+class Command(BaseCommand):
+    help = "Show how products and their queues are spread over the ingestion shards, and what moves when the shard count changes."
+
+    def add_arguments(self, parser):
+        parser.add_argument('--count', type=int, default=None, help="Shard count (default INGEST_SHARD_COUNT).")
+        parser.add_argument('--compare', type=int, default=None, help="Report the queues that move when going to this shard count.")
+
+    def handle(self, *args, **options):
+        count = options['count'] or settings.INGEST_SHARD_COUNT
+        queues = list(db_queue.objects.values_list('fullname', 'token__Product_id'))
+        products = {product_id for _, product_id in queues}
+
+        shard_products = Counter(shard_for(product_id, count) for product_id in products)
+        shard_queues = Counter(shard_for(product_id, count) for _, product_id in queues)
+        self.stdout.write(f"{len(products)} products, {len(queues)} queues over {count} shard(s)")
+        for shard in range(count):
+            self.stdout.write(f"  shard {shard:>3}: {shard_products[shard]:>6} products {shard_queues[shard]:>7} queues")
+
+        if options['compare']:
+            target = options['compare']
+            moved = [(name, shard_for(product_id, count), shard_for(product_id, target)) for name, product_id in queues
+                     if shard_for(product_id, count) != shard_for(product_id, target)]
+            self.stdout.write(f"{count} -> {target} shards moves {len(moved)} of {len(queues)} queues")
+            for name, source, destination in moved[:50]:
+                self.stdout.write(f"  {name}: {source} -> {destination}")
@@ -0,0 +1,25 @@
+from django.core.management.base import BaseCommand
+
+from analytics.services.StagingWriter import merge_all_staged_events, staging_backlog
+
+
+class Command(BaseCommand):
+    help = "Show the ingest staging backlog or merge staged events into the gameevent tables."
+
+    def add_arguments(self, parser):
+        parser.add_argument('action', choices=['status', 'merge'])
+        parser.add_argument('--batch-size', type=int, default=None)
+        parser.add_argument('--max-batches', type=int, default=None)
+
+    def handle(self, *args, **options):
+        if options['action'] == 'merge':
+            merged = merge_all_staged_events(options['batch_size'], options['max_batches'])
+            for event_type, rows in merged.items():
+                self.stdout.write(f"{event_type:<18} merged {rows}")
+            return
+
+        for event_type, backlog in staging_backlog().items():
+            self.stdout.write(
+                f"{event_type:<18} staged {backlog['rows']:>8}  oldest {backlog['oldest_event_time']}  "
+                f"last seq {backlog['last_merged_seq']}  merged {backlog['merged_rows']}  at {backlog['last_merged_at']}"
+            )
@@ -0,0 +1,79 @@
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+from kombu import Connection, Producer
+
+from analytics.models import Queue as db_queue
+from analytics.services.FailurePolicy import ERROR_HEADER, ORIGINAL_QUEUE_HEADER, RETRIES_HEADER, dead_letter_queue, dead_letter_queue_name
+
+
+class Command(BaseCommand):
+    help = "Inspect, replay or purge events parked in the per-token dead-letter queues."
+
+    def add_arguments(self, parser):
+        parser.add_argument('action', choices=['inspect', 'replay', 'purge'])
+        parser.add_argument('--token', type=int, help="Only the dead-letter queue of this token id.")
+        parser.add_argument('--limit', type=int, default=100, help="Messages per queue for inspect and replay.")
+        parser.add_argument('--error-contains', default=None, help="Only replay messages whose error contains this text.")
+
+    def handle(self, *args, **options):
+        queues = db_queue.objects.all()
+        if options['token'] is not None:
+            queues = queues.filter(token_id=options['token'])
+        # one dead-letter queue per token; any of its event queues names it
+        dead_letter_queues = {dead_letter_queue_name(q.fullname): q.fullname for q in queues}
+        if not dead_letter_queues:
+            raise CommandError("no event queues found")
+
+        with Connection(settings.CELERY_BROKER_URL) as connection:
+            channel = connection.channel()
+            for name in sorted(dead_letter_queues):
+                queue = dead_letter_queue(dead_letter_queues[name])(channel)
+                queue.declare()
+                getattr(self, options['action'])(queue, channel, options)
+
+    def inspect(self, queue, channel, options):
+        messages = self.fetch(queue, options['limit'])
+        self.stdout.write(f"{queue.name}: showing {len(messages)} message(s)")
+        for message in messages:
+            headers = message.headers or {}
+            self.stdout.write(
+                f"  from {headers.get(ORIGINAL_QUEUE_HEADER)} after {headers.get(RETRIES_HEADER, 0)} retries: "
+                f"{headers.get(ERROR_HEADER)}\n    {message.body[:200]!r}"
+            )
+        # put everything back, in order, for the next inspect or replay
+        channel.basic_recover(requeue=True)
+
+    def replay(self, queue, channel, options):
+        producer = Producer(channel)
+        replayed = kept = 0
+        for message in self.fetch(queue, options['limit']):
+            headers = dict(message.headers or {})
+            if options['error_contains'] and options['error_contains'] not in str(headers.get(ERROR_HEADER)):
+                kept += 1
+                continue
+            original = headers.pop(ORIGINAL_QUEUE_HEADER, None)
+            if original is None:
+                kept += 1
+                continue
+            for header in (ERROR_HEADER, RETRIES_HEADER, 'x-death'):
+                headers.pop(header, None)
+            producer.publish(
+                message.body, exchange='', routing_key=original, headers=headers,
+                content_type=message.content_type, content_encoding=message.content_encoding, delivery_mode=2,
+            )
+            message.ack()
+            replayed += 1
+        channel.basic_recover(requeue=True)
+        self.stdout.write(f"{queue.name}: replayed {replayed}, kept {kept}")
+
+    def purge(self, queue, channel, options):
+        self.stdout.write(f"{queue.name}: purged {queue.purge() or 0}")
+
+    def fetch(self, queue, limit):
+        messages = []
+        while len(messages) < limit:
+            message = queue.get(no_ack=False)
+            if message is None:
+                break
+            messages.append(message)
+        return messages
@@ -0,0 +1,74 @@
+from django.core.management.base import BaseCommand, CommandError
+
+from analytics.models import Product
+from analytics.services.TimescalePolicies import (
+    apply_policies, policy_report, retention_job, set_product_retention, verify_refresh_policies,
+)
+
+
+class Command(BaseCommand):
+    help = (
+        "Show, apply or change the compression and retention policies of the raw event hypertables, "
+        "or check that the continuous aggregate refresh jobs run on compressed chunks."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('action', nargs='?', default='show', choices=['show', 'apply', 'set-retention', 'verify'])
+        parser.add_argument('--compress-after-days', type=int, default=None, help="apply: instead of EVENT_COMPRESS_AFTER_DAYS, until the next apply.")
+        parser.add_argument('--retention-days', type=int, default=None, help="apply: instead of EVENT_RETENTION_DAYS (0 = keep), until the next apply.")
+        parser.add_argument('--product', type=int, help="set-retention: product id.")
+        parser.add_argument('--days', type=int, help="set-retention: days to keep the product's raw events, omit to use the default.")
+        parser.add_argument('--no-compress', action='store_true', help="verify: do not run the compression jobs first.")
+
+    def handle(self, *args, **options):
+        try:
+            if options['action'] == 'apply':
+                self.applied(apply_policies(options['compress_after_days'], options['retention_days']))
+            elif options['action'] == 'set-retention':
+                if options['product'] is None:
+                    raise CommandError("set-retention needs --product")
+                self.applied(set_product_retention(options['product'], options['days']))
+            elif options['action'] == 'verify':
+                self.verify(not options['no_compress'])
+                return
+        except (ValueError, Product.DoesNotExist) as e:
+            raise CommandError(str(e))
+        self.show()
+
+    def applied(self, applied):
+        self.stdout.write(
+            f"compress after {applied['compress_after_days']} days, default retention "
+            f"{applied['default_retention_days'] or 'none'}, chunks dropped after {applied['chunk_retention_days'] or 'never'}"
+        )
+
+    def show(self):
+        self.stdout.write(f"{'hypertable':<20} {'chunks':>7} {'compr.':>7} {'size MB':>10} {'ratio':>7}  range")
+        for table, stats in policy_report().items():
+            ratio = f"{stats['compression_ratio']:.1f}x" if stats['compression_ratio'] else '-'
+            self.stdout.write(
+                f"{table:<20} {stats['chunks']:>7} {stats['compressed_chunks']:>7} {(stats['total_bytes'] or 0) / 2**20:>10.1f} {ratio:>7}  "
+                f"{stats['oldest_chunk']} .. {stats['newest_chunk']}"
+            )
+            for proc_name, interval, config in stats['policies']:
+                self.stdout.write(f"    {proc_name:<34} every {interval}  {config}")
+
+        job = retention_job()
+        if job is None:
+            self.stdout.write("per-product retention job: not scheduled, run `timescale_policies apply`")
+        else:
+            interval, config, status, started = job
+            self.stdout.write(f"per-product retention job: every {interval}, default {config.get('default_days') or 'none'} days, last run {status} at {started}")
+        for product_id, name, days in Product.objects.exclude(event_retention_days=None).values_list('id', 'name', 'event_retention_days'):
+            self.stdout.write(f"    product {product_id} {name}: {days} days")
+
+    def verify(self, compress_first):
+        failed = 0
+        for result in verify_refresh_policies(compress_first):
+            status = 'ok' if result['error'] is None else f"FAILED: {result['error']}"
+            failed += result['error'] is not None
+            self.stdout.write(
+                f"{result['aggregate']:<26} on {result['hypertable']:<18} {result['compressed_chunks']:>4} compressed chunks  "
+                f"{result['seconds'] * 1000:8.0f} ms  {status}"
+            )
+        if failed:
+            raise CommandError(f"{failed} refresh jobs failed")
@@ -0,0 +1,56 @@
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connection
+
+from analytics.services.ChunkTuning import apply_chunk_settings, chunk_history, product_volumes, recommend
+from analytics.services.TimescalePolicies import event_hypertables
+
+
+def size_bytes(value):
+    with connection.cursor() as cursor:
+        cursor.execute("SELECT pg_size_bytes(%s)", [value])
+        return cursor.fetchone()[0]
+
+
+class Command(BaseCommand):
+    help = (
+        "Recommend chunk intervals and space partitions for the event hypertables from their ingest volume, "
+        "show chunk sizes over time, or apply the recommendation (or given values) to new chunks."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('action', nargs='?', default='report', choices=['report', 'apply'])
+        parser.add_argument('--table', action='append', choices=event_hypertables(), help="Only these hypertables (repeatable).")
+        parser.add_argument('--days', type=int, default=7, help="Ingest history to size chunks from.")
+        parser.add_argument('--memory', help="Memory for caching, e.g. 16GB (default: effective_cache_size).")
+        parser.add_argument('--disks', type=int, default=1, help="Disks or tablespaces the chunks are spread over.")
+        parser.add_argument('--interval', help="apply: this chunk interval instead of the recommended one, e.g. '12 hours'.")
+        parser.add_argument('--partitions', type=int, help="apply: this number of space partitions instead of the recommended one.")
+
+    def handle(self, *args, **options):
+        memory = size_bytes(options['memory']) if options['memory'] else None
+        profiles, interval, partitions, memory = recommend(options['table'], options['days'], memory, options['disks'])
+
+        self.stdout.write(f"memory for caching {memory / 2**30:.1f} GB, peak ingest over the last {options['days']} days")
+        self.stdout.write(f"{'hypertable':<20} {'rows':>12} {'size MB':>10} {'peak/h':>10} {'products':>9}  current -> recommended")
+        for profile in profiles:
+            self.stdout.write(
+                f"{profile.table:<20} {profile.rows:>12} {(profile.bytes or 0) / 2**20:>10.1f} {profile.peak_rows_per_hour:>10} {profile.products:>9}  "
+                f"{profile.interval} x {profile.partitions} -> {interval} x {partitions[profile.table]}"
+            )
+
+        if options['action'] == 'apply':
+            if options['partitions'] is not None and options['partitions'] < 1:
+                raise CommandError("--partitions has to be at least 1")
+            for profile in profiles:
+                apply_chunk_settings(profile.table, options['interval'] or interval, options['partitions'] or partitions[profile.table])
+            self.stdout.write(f"applied to new chunks: {options['interval'] or interval}, existing chunks keep their size")
+            return
+
+        table = profiles[0].table
+        self.stdout.write(f"\nbusiest products in {table}: product, events, peak/h")
+        for product_id, events, peak in product_volumes(table, options['days']):
+            self.stdout.write(f"    {product_id:>8} {events:>12} {peak:>10}")
+        for profile in profiles:
+            self.stdout.write(f"\nchunks of {profile.table} by start day: chunks, total MB, largest MB")
+            for started, chunks, total, largest in chunk_history(profile.table):
+                self.stdout.write(f"    {started:%Y-%m-%d} {chunks:>6} {total / 2**20:>10.1f} {largest / 2**20:>10.1f}")
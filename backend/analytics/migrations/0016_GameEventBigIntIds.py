@@ -0,0 +1,65 @@
+from django.db import migrations, models
+
+from ._continuous_aggregates import drop_continuous_aggregates, create_continuous_aggregates
+
+# Ingestion workers reserve blocks of ids with nextval() and fill them in
+# themselves (see services/IdAllocator.py), so the sequence steps by the block
+# size. Inserts that still rely on the column default simply use up one block.
+gameevent_bigint_ids = """
+ALTER TABLE gameevent ALTER COLUMN id TYPE BIGINT;
+ALTER SEQUENCE gameevent_id_seq AS BIGINT INCREMENT BY 1000;
+"""
+
+gameevent_integer_ids = """
+ALTER SEQUENCE gameevent_id_seq INCREMENT BY 1;
+ALTER SEQUENCE gameevent_id_seq AS INTEGER;
+ALTER TABLE gameevent ALTER COLUMN id TYPE INTEGER;
+"""
+
+
+class Migration(migrations.Migration):
+    initial = False
+    atomic = False
+
+    dependencies = [('analytics', '0015_arppu_averagefps_averagememoryusage_and_more')]
+
+    operations = [
+        *drop_continuous_aggregates(until='0016_GameEventBigIntIds'),
+        migrations.RunSQL(gameevent_bigint_ids, reverse_sql=gameevent_integer_ids),
+        migrations.AlterField(
+            model_name='sessionstartevent',
+            name='game_event',
+            field=models.BigIntegerField(),
+        ),
+        migrations.AlterField(
+            model_name='sessionendevent',
+            name='game_event',
+            field=models.BigIntegerField(),
+        ),
+        migrations.AlterField(
+            model_name='bussinessevent',
+            name='game_event',
+            field=models.BigIntegerField(),
+        ),
+        migrations.AlterField(
+            model_name='errorevent',
+            name='game_event',
+            field=models.BigIntegerField(),
+        ),
+        migrations.AlterField(
+            model_name='progeressionevent',
+            name='game_event',
+            field=models.BigIntegerField(),
+        ),
+        migrations.AlterField(
+            model_name='qualityevent',
+            name='game_event',
+            field=models.BigIntegerField(),
+        ),
+        migrations.AlterField(
+            model_name='resourceevent',
+            name='game_event',
+            field=models.BigIntegerField(),
+        ),
+        *create_continuous_aggregates(until='0016_GameEventBigIntIds'),
+    ]
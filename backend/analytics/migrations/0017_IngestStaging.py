@@ -0,0 +1,52 @@
+from django.db import migrations
+
+# Staging tables for INGEST_MODE=staging (see services/StagingWriter.py). seq
+# comes from a regular, WAL-logged sequence so it never restarts when Postgres
+# truncates the unlogged tables after a crash.
+staging_columns = {
+    'start_session': '"platform" text',
+    'end_session': None,
+    'business_event': '"cartType" text, "itemType" text, "itemId" text, "amount" integer, "currency" text',
+    'error_event': '"message" text, "severity" text',
+    'progression_event': '"progressionStatus" text, "progression01" text, "progression02" text, "progression03" text, "value" double precision',
+    'quality_event': '"FPS" double precision, "memoryUsage" double precision',
+    'resource_event': '"flowType" text, "itemType" text, "itemId" text, "amount" integer, "resourceCurrency" text',
+}
+
+staging_sequence = """
+CREATE SEQUENCE ingest_staging_seq AS BIGINT;
+CREATE TABLE ingest_merge_watermark (
+    staging_table TEXT PRIMARY KEY,
+    last_seq BIGINT NOT NULL DEFAULT 0,
+    merged_rows BIGINT NOT NULL DEFAULT 0,
+    merged_at TIMESTAMPTZ
+);
+"""
+
+
+def staging_table_sql(event_type, columns):
+    return f"""
+CREATE UNLOGGED TABLE ingest_staging_{event_type} (
+    seq BIGINT NOT NULL DEFAULT nextval('ingest_staging_seq') PRIMARY KEY,
+    id BIGINT NOT NULL,
+    time TIMESTAMPTZ NOT NULL,
+    client_id BIGINT,
+    session_id BIGINT,
+    product_id BIGINT{', ' + columns if columns else ''}
+);
+"""
+
+
+class Migration(migrations.Migration):
+    initial = False
+    atomic = False
+
+    dependencies = [('analytics', '0016_GameEventBigIntIds')]
+
+    operations = [
+        migrations.RunSQL(staging_sequence, reverse_sql="DROP TABLE ingest_merge_watermark; DROP SEQUENCE ingest_staging_seq;"),
+        *[
+            migrations.RunSQL(staging_table_sql(event_type, columns), reverse_sql=f"DROP TABLE ingest_staging_{event_type};")
+            for event_type, columns in staging_columns.items()
+        ],
+    ]
@@ -0,0 +1,36 @@
+from django.db import migrations
+
+# Client-generated event ids (see services/EventDedup.py). Unique indexes on a
+# hypertable have to include all of its partitioning columns, time and (0001)
+# product_id; a redelivered event keeps both, so (client_event_id, time,
+# product_id) still recognises it. Events without an id are not indexed. The
+# index name is EventWriter.DEDUP_INDEX.
+gameevent_event_ids = """
+ALTER TABLE gameevent ADD COLUMN client_event_id UUID;
+CREATE UNIQUE INDEX gameevent_client_event_id_time_product_id_key ON gameevent (client_event_id, time, product_id) WHERE client_event_id IS NOT NULL;
+"""
+
+drop_gameevent_event_ids = """
+DROP INDEX gameevent_client_event_id_time_product_id_key;
+ALTER TABLE gameevent DROP COLUMN client_event_id;
+"""
+
+staging_event_types = ['start_session', 'end_session', 'business_event', 'error_event', 'progression_event', 'quality_event', 'resource_event']
+
+
+class Migration(migrations.Migration):
+    initial = False
+    atomic = False
+
+    dependencies = [('analytics', '0017_IngestStaging')]
+
+    operations = [
+        migrations.RunSQL(gameevent_event_ids, reverse_sql=drop_gameevent_event_ids),
+        *[
+            migrations.RunSQL(
+                f"ALTER TABLE ingest_staging_{event_type} ADD COLUMN client_event_id UUID;",
+                reverse_sql=f"ALTER TABLE ingest_staging_{event_type} DROP COLUMN client_event_id;",
+            )
+            for event_type in staging_event_types
+        ],
+    ]
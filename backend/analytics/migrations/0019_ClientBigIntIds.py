@@ -0,0 +1,40 @@
+from django.db import migrations, models
+
+from ._continuous_aggregates import drop_continuous_aggregates, create_continuous_aggregates
+
+# Client ids used to be drawn at random from 1..100000 by the handshake. They now
+# come from a BIGINT sequence in blocks reserved by each web process (see
+# services/IdAllocator.py), starting above every id handed out so far. As with
+# gameevent_id_seq, inserts that rely on the column default use up one block.
+client_sequence = """
+CREATE SEQUENCE analytics_client_id_seq AS BIGINT INCREMENT BY 1000 OWNED BY analytics_client.id;
+SELECT setval('analytics_client_id_seq', GREATEST((SELECT max(id) FROM analytics_client), 100000) + 1, false);
+ALTER TABLE analytics_client ALTER COLUMN id SET DEFAULT nextval('analytics_client_id_seq');
+"""
+
+drop_client_sequence = """
+ALTER TABLE analytics_client ALTER COLUMN id DROP DEFAULT;
+DROP SEQUENCE analytics_client_id_seq;
+"""
+
+
+class Migration(migrations.Migration):
+    initial = False
+    atomic = False
+
+    dependencies = [('analytics', '0018_GameEventDedup')]
+
+    operations = [
+        *drop_continuous_aggregates(until='0019_ClientBigIntIds'),
+        migrations.RunSQL(
+            "ALTER TABLE gameevent ALTER COLUMN client_id TYPE BIGINT;",
+            reverse_sql="ALTER TABLE gameevent ALTER COLUMN client_id TYPE INTEGER;",
+        ),
+        migrations.AlterField(
+            model_name='client',
+            name='id',
+            field=models.BigIntegerField(primary_key=True, serialize=False),
+        ),
+        migrations.RunSQL(client_sequence, reverse_sql=drop_client_sequence),
+        *create_continuous_aggregates(until='0019_ClientBigIntIds'),
+    ]
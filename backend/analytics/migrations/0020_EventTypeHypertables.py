@@ -0,0 +1,308 @@
+from django.db import migrations, models
+import django.db.models.deletion
+
+from ._continuous_aggregates import drop_continuous_aggregates, create_continuous_aggregates
+
+# The subtype tables (analytics_qualityevent, ...) were plain tables keyed by a
+# serial id and joined to gameevent on game_event, which every aggregate over
+# them had to do. They are replaced by one hypertable per event type that
+# repeats time, client_id, session_id and product_id of the gameevent row, so
+# the aggregates below read a single hypertable. gameevent itself stays: it
+# carries the event counts, active users, dedup index and session events.
+# client/session/product are not foreign keys, gameevent already checks them
+# for the same event.
+
+# model name -> its own columns, as Django created them in the old tables
+event_columns = {
+    'sessionstartevent': '"platform" text NOT NULL',
+    'sessionendevent': None,
+    'bussinessevent': '"cartType" varchar(300) NOT NULL, "itemType" varchar(300) NOT NULL, "itemId" varchar(300) NOT NULL, "amount" integer NOT NULL, "currency" varchar(300) NOT NULL',
+    'errorevent': '"message" text NOT NULL, "severity" varchar(10) NOT NULL',
+    'progeressionevent': '"progressionStatus" varchar(300) NOT NULL, "progression01" varchar(300) NOT NULL, "progression02" varchar(300) NOT NULL, "progression03" varchar(300) NOT NULL, "value" double precision NOT NULL',
+    'qualityevent': '"FPS" double precision NOT NULL, "memoryUsage" double precision NOT NULL',
+    'resourceevent': '"flowType" varchar(300) NOT NULL, "itemType" varchar(300) NOT NULL, "itemId" varchar(300) NOT NULL, "amount" integer NOT NULL, "resourceCurrency" varchar(300) NOT NULL',
+}
+
+
+def column_names(columns):
+    return ''.join(', ' + column.split('" ')[0] + '"' for column in columns.split(', ')) if columns else ''
+
+
+def event_hypertable_sql(name, columns):
+    names = column_names(columns)
+    return f"""
+CREATE TABLE {name} (
+    game_event BIGINT NOT NULL,
+    time TIMESTAMPTZ NOT NULL,
+    client_id BIGINT,
+    session_id BIGINT,
+    product_id BIGINT{', ' + columns if columns else ''}
+);
+SELECT create_hypertable('{name}', 'time', 'product_id', number_partitions => 32);
+INSERT INTO {name} (game_event, time, client_id, session_id, product_id{names})
+SELECT ge.id, ge.time, ge.client_id, ge.session_id, ge.product_id{names.replace(', "', ', x."')}
+FROM analytics_{name} x JOIN gameevent ge ON ge.id = x.game_event
+ORDER BY ge.time;
+DROP TABLE analytics_{name};
+"""
+
+
+def subtype_table_sql(name, columns):
+    names = column_names(columns)
+    return f"""
+CREATE TABLE analytics_{name} (
+    id BIGINT GENERATED BY DEFAULT AS IDENTITY PRIMARY KEY,
+    game_event BIGINT NOT NULL{', ' + columns if columns else ''}
+);
+INSERT INTO analytics_{name} (game_event{names}) SELECT game_event{names} FROM {name} ORDER BY time;
+DROP TABLE {name};
+"""
+
+
+def event_model_state(name):
+    return [
+        migrations.AlterModelOptions(name=name, options={'managed': False}),
+        migrations.AlterModelTable(name=name, table=name),
+        migrations.RemoveField(model_name=name, name='id'),
+        migrations.AlterField(
+            model_name=name,
+            name='game_event',
+            field=models.BigIntegerField(primary_key=True, serialize=False),
+        ),
+        migrations.AddField(
+            model_name=name,
+            name='time',
+            field=models.DateTimeField(),
+            preserve_default=False,
+        ),
+        migrations.AddField(
+            model_name=name,
+            name='client',
+            field=models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='+', to='analytics.client'),
+            preserve_default=False,
+        ),
+        migrations.AddField(
+            model_name=name,
+            name='session',
+            field=models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='+', to='analytics.session'),
+            preserve_default=False,
+        ),
+        migrations.AddField(
+            model_name=name,
+            name='product',
+            field=models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='+', to='analytics.product'),
+            preserve_default=False,
+        ),
+    ]
+
+
+# Aggregates redefined on the event type hypertables (see _continuous_aggregates.py),
+# with the refresh policies and conditions of migrations 0004-0014.
+
+def refresh_policy(name):
+    return f"""
+SELECT add_continuous_aggregate_policy('{name}',
+    start_offset => INTERVAL '7 days',
+    end_offset => INTERVAL '1 hour',
+    schedule_interval => INTERVAL '15 minutes');
+"""
+
+
+def realtime(name):
+    return f"""
+ALTER MATERIALIZED VIEW {name}
+SET (timescaledb.materialized_only = false);
+"""
+
+
+averageFPS_aggregate_table = """
+CREATE MATERIALIZED VIEW averageFPS
+WITH (timescaledb.continuous) AS
+SELECT
+    time_bucket('1 hour', time) AS bucket,
+    product_id,
+    AVG("FPS") AS average_FPS
+    FROM qualityevent
+    GROUP BY product_id, bucket;
+"""
+
+averageFPS_refresh_policy = refresh_policy('averageFPS')
+averageFPS_conditions = realtime('averageFPS')
+
+averageMemoryUsage_aggregate_table = """
+CREATE MATERIALIZED VIEW averageMemoryUsage
+WITH (timescaledb.continuous) AS
+SELECT
+    time_bucket('1 hour', time) AS bucket,
+    product_id,
+    AVG("memoryUsage") AS average_memory_usage
+    FROM qualityevent
+    GROUP BY product_id, bucket;
+"""
+
+averageMemoryUsage_refresh_policy = refresh_policy('averageMemoryUsage')
+averageMemoryUsage_conditions = realtime('averageMemoryUsage')
+
+totalRevenuePerCurrency_aggregate_table = """
+CREATE MATERIALIZED VIEW totalRevenuePerCurrency
+WITH (timescaledb.continuous) AS
+SELECT
+    time_bucket('1 hour', time) AS bucket,
+    product_id,
+    currency,
+    SUM(amount) AS total_amount
+    FROM bussinessevent
+    GROUP BY product_id, currency, bucket;
+"""
+
+totalRevenuePerCurrency_refresh_policy = refresh_policy('totalRevenuePerCurrency')
+
+aRPPU_aggregate_table = """
+CREATE MATERIALIZED VIEW aRPPU
+WITH (timescaledb.continuous) AS
+SELECT
+    time_bucket('1 hour', time) AS bucket,
+    product_id,
+    SUM(amount)::float / COUNT(DISTINCT client_id) AS arppu
+    FROM bussinessevent
+    GROUP BY product_id, bucket;
+"""
+
+aRPPU_refresh_policy = refresh_policy('aRPPU')
+
+levelCompletionRate_aggregate_table = """
+CREATE MATERIALIZED VIEW levelCompletionRate
+WITH (timescaledb.continuous) AS
+SELECT
+    time_bucket('1 hour', time) AS bucket,
+    product_id,
+    progression01,
+    COUNT(*) FILTER (WHERE "progressionStatus" = 'Complete')::float /
+    COUNT(*) AS completion_rate
+    FROM progeressionevent
+    GROUP BY product_id, bucket, progression01;
+"""
+
+levelCompletionRate_refresh_policy = refresh_policy('levelCompletionRate')
+
+averageTriesPerLevel_aggregate_table = """
+CREATE MATERIALIZED VIEW averageTriesPerLevel
+WITH (timescaledb.continuous) AS
+SELECT
+    time_bucket('1 hour', time) AS bucket,
+    product_id,
+    progression01,
+    COUNT(*) FILTER (WHERE "progressionStatus" = 'Fail')::float /
+    COUNT(DISTINCT client_id) AS avg_tries
+    FROM progeressionevent
+    GROUP BY product_id, bucket, progression01;
+"""
+
+averageTriesPerLevel_refresh_policy = refresh_policy('averageTriesPerLevel')
+
+netResourceFlow_aggregate_table = """
+CREATE MATERIALIZED VIEW netResourceFlow
+WITH (timescaledb.continuous) AS
+SELECT
+    time_bucket('1 hour', time) AS bucket,
+    product_id,
+    "itemType",
+    SUM(CASE WHEN "flowType" = 'Source' THEN amount ELSE -amount END) AS net_flow
+    FROM resourceevent
+    GROUP BY product_id, bucket, "itemType";
+"""
+
+netResourceFlow_refresh_policy = refresh_policy('netResourceFlow')
+
+resourceSinkRatio_aggregate_table = """
+CREATE MATERIALIZED VIEW resourceSinkRatio
+WITH (timescaledb.continuous) AS
+SELECT
+    time_bucket('1 hour', time) AS bucket,
+    product_id,
+    "itemType",
+    SUM(CASE WHEN "flowType" = 'Sink' THEN amount ELSE 0 END)::float /
+    SUM(amount) AS sink_ratio
+    FROM resourceevent
+    GROUP BY product_id, bucket, "itemType";
+"""
+
+resourceSinkRatio_refresh_policy = refresh_policy('resourceSinkRatio')
+
+# A continuous aggregate can read only one hypertable, and the crash rate needs
+# critical errors (errorevent) per session seen (gameevent). Both are counted by
+# their own aggregate and crashRate becomes a plain view dividing the two.
+crashRate_aggregate_table = [
+    """
+CREATE MATERIALIZED VIEW criticalErrors
+WITH (timescaledb.continuous) AS
+SELECT
+    time_bucket('1 hour', time) AS bucket,
+    product_id,
+    COUNT(*) FILTER (WHERE severity = 'Critical') AS crashes
+    FROM errorevent
+    GROUP BY product_id, bucket;
+""",
+    """
+CREATE MATERIALIZED VIEW activeSessions
+WITH (timescaledb.continuous) AS
+SELECT
+    time_bucket('1 hour', time) AS bucket,
+    product_id,
+    COUNT(DISTINCT session_id) AS sessions
+    FROM gameevent
+    GROUP BY product_id, bucket;
+""",
+    """
+CREATE VIEW crashRate AS
+SELECT
+    s.bucket,
+    s.product_id,
+    COALESCE(c.crashes, 0)::float / NULLIF(s.sessions, 0) AS crash_rate
+    FROM activeSessions s
+    LEFT JOIN criticalErrors c
+    ON c.bucket = s.bucket AND c.product_id = s.product_id;
+""",
+]
+
+crashRate_refresh_policy = refresh_policy('criticalErrors') + refresh_policy('activeSessions')
+
+crashRate_drop = [
+    "DROP VIEW IF EXISTS crashRate;",
+    "DROP MATERIALIZED VIEW IF EXISTS activeSessions;",
+    "DROP MATERIALIZED VIEW IF EXISTS criticalErrors;",
+]
+
+topErrorTypes_aggregate_table = """
+CREATE MATERIALIZED VIEW topErrorTypes
+WITH (timescaledb.continuous) AS
+SELECT
+    time_bucket('1 hour', time) AS bucket,
+    product_id,
+    message,
+    COUNT(*) AS occurrences
+    FROM errorevent
+    GROUP BY product_id, bucket, message
+    ORDER BY occurrences DESC
+"""
+
+topErrorTypes_refresh_policy = refresh_policy('topErrorTypes')
+
+
+class Migration(migrations.Migration):
+    initial = False
+    atomic = False
+
+    dependencies = [('analytics', '0019_ClientBigIntIds')]
+
+    operations = [
+        *drop_continuous_aggregates(until='0019_ClientBigIntIds'),
+        *[
+            migrations.RunSQL(event_hypertable_sql(name, columns), reverse_sql=subtype_table_sql(name, columns))
+            for name, columns in event_columns.items()
+        ],
+        migrations.SeparateDatabaseAndState(
+            state_operations=[operation for name in event_columns for operation in event_model_state(name)],
+        ),
+        *create_continuous_aggregates(until='0020_EventTypeHypertables'),
+    ]
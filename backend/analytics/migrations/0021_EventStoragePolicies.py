@@ -0,0 +1,85 @@
+import django.core.validators
+from django.db import migrations, models
+
+# Native compression for the raw event hypertables: one compressed segment per
+# product, rows ordered by time, which is how the continuous aggregates read
+# them. A unique index has to be covered by the compression settings, so
+# gameevent also orders by client_event_id (migration 0018; product_id and time,
+# the other columns of that index, are the segment and the order already). The compression,
+# chunk retention and per-product retention policies themselves depend on
+# settings and are applied by `manage.py timescale_policies apply`.
+event_hypertables = [
+    'gameevent', 'sessionstartevent', 'sessionendevent', 'bussinessevent', 'errorevent',
+    'progeressionevent', 'qualityevent', 'resourceevent',
+]
+
+
+def compression_sql(table):
+    orderby = 'time DESC, client_event_id' if table == 'gameevent' else 'time DESC'
+    return f"""
+ALTER TABLE {table} SET (
+    timescaledb.compress,
+    timescaledb.compress_segmentby = 'product_id',
+    timescaledb.compress_orderby = '{orderby}'
+);
+"""
+
+
+def decompression_sql(table):
+    return f"""
+SELECT remove_compression_policy('{table}', if_exists => true);
+SELECT remove_retention_policy('{table}', if_exists => true);
+SELECT decompress_chunk(chunk, true) FROM show_chunks('{table}') chunk;
+ALTER TABLE {table} SET (timescaledb.compress = false);
+"""
+
+
+# Job body for per-product retention, scheduled by timescale_policies with
+# config {"hypertables": [...], "default_days": N}. Deletes the raw events of each
+# product older than its event_retention_days (default_days when unset, 0 =
+# keep), committing after every hypertable; compressed chunks are deleted from
+# in place. The aggregates are not touched.
+retention_procedure = """
+CREATE OR REPLACE PROCEDURE analytics_delete_expired_events(job_id INT, config JSONB)
+LANGUAGE plpgsql AS $$
+DECLARE
+    default_days INT := NULLIF((config->>'default_days')::INT, 0);
+    hypertable TEXT;
+BEGIN
+    FOR hypertable IN SELECT jsonb_array_elements_text(config->'hypertables') LOOP
+        EXECUTE format(
+            'DELETE FROM %I e USING analytics_product p
+             WHERE e.product_id = p.id
+             AND e.time < now() - make_interval(days => COALESCE(p.event_retention_days, $1))',
+            hypertable
+        ) USING default_days;
+        COMMIT;
+    END LOOP;
+END
+$$;
+"""
+
+drop_retention_procedure = """
+SELECT delete_job(job_id) FROM timescaledb_information.jobs WHERE proc_name = 'analytics_delete_expired_events';
+DROP PROCEDURE analytics_delete_expired_events(INT, JSONB);
+"""
+
+
+class Migration(migrations.Migration):
+    initial = False
+    atomic = False
+
+    dependencies = [('analytics', '0020_EventTypeHypertables')]
+
+    operations = [
+        migrations.AddField(
+            model_name='product',
+            name='event_retention_days',
+            field=models.PositiveIntegerField(blank=True, null=True, validators=[django.core.validators.MinValueValidator(8)]),
+        ),
+        *[
+            migrations.RunSQL(compression_sql(table), reverse_sql=decompression_sql(table))
+            for table in event_hypertables
+        ],
+        migrations.RunSQL(retention_procedure, reverse_sql=drop_retention_procedure),
+    ]
@@ -0,0 +1,61 @@
+import django.db.models.deletion
+from django.db import migrations, models
+
+# HyperLogLog sketches of the active clients per product and day. The first 64
+# bits of md5(client_id) pick one of 1024 registers (top 10 bits) and a rank,
+# the position of the first 1 in the remaining 54 bits (55 when they are all 0);
+# each register keeps the highest rank seen. Merging two sketches takes the max
+# per register, so days roll up into weeks and months, which count(DISTINCT) in
+# dailActiveUsers cannot. services/ActiveUsers.py hashes the same way, merges
+# and estimates.
+client_hash = "('x' || substr(md5(client_id::text), 1, 16))::bit(64)"
+
+activeUserSketch_aggregate_table = f"""
+CREATE MATERIALIZED VIEW activeUserSketch
+WITH (timescaledb.continuous) AS
+SELECT
+    time_bucket('1 day', time) AS bucket,
+    product_id,
+    substring({client_hash} FROM 1 FOR 10)::int AS register,
+    max(COALESCE(NULLIF(position(B'1' IN substring({client_hash} FROM 11)), 0), 55)) AS rank
+    FROM gameevent
+    GROUP BY product_id, bucket, register;
+"""
+
+activeUserSketch_refresh_policy = """
+SELECT add_continuous_aggregate_policy('activeUserSketch',
+    start_offset => INTERVAL '7 days',
+    end_offset => INTERVAL '1 hour',
+    schedule_interval => INTERVAL '15 minutes');
+"""
+
+activeUserSketch_conditions = """
+ALTER MATERIALIZED VIEW activeUserSketch
+SET (timescaledb.materialized_only = false);
+"""
+
+
+class Migration(migrations.Migration):
+    initial = False
+    atomic = False
+
+    dependencies = [('analytics', '0021_EventStoragePolicies')]
+
+    operations = [
+        migrations.RunSQL(activeUserSketch_aggregate_table, reverse_sql="DROP MATERIALIZED VIEW activeUserSketch;"),
+        migrations.RunSQL(activeUserSketch_refresh_policy),
+        migrations.RunSQL(activeUserSketch_conditions),
+        migrations.CreateModel(
+            name='ActiveUserSketch',
+            fields=[
+                ('bucket', models.DateTimeField(primary_key=True, serialize=False)),
+                ('product', models.ForeignKey(db_column='product_id', on_delete=django.db.models.deletion.DO_NOTHING, to='analytics.product')),
+                ('register', models.IntegerField()),
+                ('rank', models.IntegerField()),
+            ],
+            options={
+                'db_table': 'activeusersketch',
+                'managed': False,
+            },
+        ),
+    ]
@@ -0,0 +1,58 @@
+import django.db.models.deletion
+from django.db import migrations, models
+
+# Quantile sketch of the FPS per product and hour, in the style of DDSketch:
+# values fall into logarithmic bins, bin i holding (gamma^(i-1), gamma^i] with
+# gamma = 1.02 / 0.98, and each row counts the events of one bin. Any value
+# reported for a bin is within 2% of every value in it, so every quantile is too.
+# Counts add up, so hours merge into any range by summing per bin; values up to
+# 0.01 share one bin. services/Percentiles.py merges the bins and reads p50-p99.
+fpsSketch_aggregate_table = """
+CREATE MATERIALIZED VIEW fpsSketch
+WITH (timescaledb.continuous) AS
+SELECT
+    time_bucket('1 hour', time) AS bucket,
+    product_id,
+    ceil(ln(greatest("FPS", 0.01)) / ln(1.02 / 0.98))::int AS bin,
+    count(*) AS count
+    FROM qualityevent
+    GROUP BY product_id, bucket, bin;
+"""
+
+fpsSketch_refresh_policy = """
+SELECT add_continuous_aggregate_policy('fpsSketch',
+    start_offset => INTERVAL '7 days',
+    end_offset => INTERVAL '1 hour',
+    schedule_interval => INTERVAL '15 minutes');
+"""
+
+fpsSketch_conditions = """
+ALTER MATERIALIZED VIEW fpsSketch
+SET (timescaledb.materialized_only = false);
+"""
+
+
+class Migration(migrations.Migration):
+    initial = False
+    atomic = False
+
+    dependencies = [('analytics', '0022_ActiveUserSketch')]
+
+    operations = [
+        migrations.RunSQL(fpsSketch_aggregate_table, reverse_sql="DROP MATERIALIZED VIEW fpsSketch;"),
+        migrations.RunSQL(fpsSketch_refresh_policy),
+        migrations.RunSQL(fpsSketch_conditions),
+        migrations.CreateModel(
+            name='FPSSketch',
+            fields=[
+                ('bucket', models.DateTimeField(primary_key=True, serialize=False)),
+                ('product', models.ForeignKey(db_column='product_id', on_delete=django.db.models.deletion.DO_NOTHING, to='analytics.product')),
+                ('bin', models.IntegerField()),
+                ('count', models.BigIntegerField()),
+            ],
+            options={
+                'db_table': 'fpssketch',
+                'managed': False,
+            },
+        ),
+    ]
@@ -0,0 +1,54 @@
+import django.db.models.deletion
+from django.db import migrations, models
+
+# Quantile sketch of the memory usage per product and hour, with the bins of
+# fpsSketch (migration 0023), see services/Percentiles.py.
+memoryUsageSketch_aggregate_table = """
+CREATE MATERIALIZED VIEW memoryUsageSketch
+WITH (timescaledb.continuous) AS
+SELECT
+    time_bucket('1 hour', time) AS bucket,
+    product_id,
+    ceil(ln(greatest("memoryUsage", 0.01)) / ln(1.02 / 0.98))::int AS bin,
+    count(*) AS count
+    FROM qualityevent
+    GROUP BY product_id, bucket, bin;
+"""
+
+memoryUsageSketch_refresh_policy = """
+SELECT add_continuous_aggregate_policy('memoryUsageSketch',
+    start_offset => INTERVAL '7 days',
+    end_offset => INTERVAL '1 hour',
+    schedule_interval => INTERVAL '15 minutes');
+"""
+
+memoryUsageSketch_conditions = """
+ALTER MATERIALIZED VIEW memoryUsageSketch
+SET (timescaledb.materialized_only = false);
+"""
+
+
+class Migration(migrations.Migration):
+    initial = False
+    atomic = False
+
+    dependencies = [('analytics', '0023_FPSSketch')]
+
+    operations = [
+        migrations.RunSQL(memoryUsageSketch_aggregate_table, reverse_sql="DROP MATERIALIZED VIEW memoryUsageSketch;"),
+        migrations.RunSQL(memoryUsageSketch_refresh_policy),
+        migrations.RunSQL(memoryUsageSketch_conditions),
+        migrations.CreateModel(
+            name='MemoryUsageSketch',
+            fields=[
+                ('bucket', models.DateTimeField(primary_key=True, serialize=False)),
+                ('product', models.ForeignKey(db_column='product_id', on_delete=django.db.models.deletion.DO_NOTHING, to='analytics.product')),
+                ('bin', models.IntegerField()),
+                ('count', models.BigIntegerField()),
+            ],
+            options={
+                'db_table': 'memoryusagesketch',
+                'managed': False,
+            },
+        ),
+    ]
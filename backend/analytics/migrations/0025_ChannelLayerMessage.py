@@ -0,0 +1,25 @@
+from django.db import migrations
+
+# Messages of the Postgres channel layer (services/PostgresChannelLayer.py) too
+# large for a NOTIFY payload; the notification carries the id. Rows are only
+# needed until the listening processes have read them, so the table is unlogged
+# and the layer deletes what is older than its expiry.
+channel_layer_message = """
+CREATE UNLOGGED TABLE channel_layer_message (
+    id BIGSERIAL PRIMARY KEY,
+    created TIMESTAMPTZ NOT NULL DEFAULT now(),
+    payload TEXT NOT NULL
+);
+CREATE INDEX channel_layer_message_created_idx ON channel_layer_message (created);
+"""
+
+
+class Migration(migrations.Migration):
+    initial = False
+    atomic = False
+
+    dependencies = [('analytics', '0024_MemoryUsageSketch')]
+
+    operations = [
+        migrations.RunSQL(channel_layer_message, reverse_sql="DROP TABLE channel_layer_message;"),
+    ]
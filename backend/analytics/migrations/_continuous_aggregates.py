@@ -0,0 +1,88 @@
+"""
+Helpers for migrations that have to change columns read by the continuous
+aggregates. Postgres refuses to alter the type of a column a view depends on,
+so those migrations drop the aggregates first and recreate them afterwards from
+the SQL of the migrations that introduced them (0002-0014, 0022-0024), or of a later
+migration that redefined them.
+"""
+import importlib
+
+from django.db import migrations
+
+AGGREGATE_MIGRATIONS = [
+    '0002_GameEventHourlyCount',
+    '0003_DailyActiveUsers',
+    '0004_AverageFPS',
+    '0005_AverageMemoryUsage',
+    '0006_AverageSessionDuration',
+    '0007_TotalRevenuePerCurrency',
+    '0008_ARPPU',
+    '0009_LevelCompletionRate',
+    '0010_AverageTriesPerLevel',
+    '0011_NetResourceFlow',
+    '0012_ResourceSinkRatio',
+    '0013_CrashRate',
+    '0014_TopErrorTypes',
+    '0022_ActiveUserSketch',
+    '0023_FPSSketch',
+    '0024_MemoryUsageSketch',
+]
+
+# Migrations that replace the definitions of some of the aggregates above, in
+# order. They define <name>_aggregate_table (plus optional _refresh_policy,
+# _conditions and a _drop statement for aggregates that are not a single view);
+# each part is one SQL string or a list of them.
+REDEFINING_MIGRATIONS = [
+    '0020_EventTypeHypertables',
+]
+
+
+def _definition(module, name):
+    statements = []
+    for part in ('aggregate_table', 'refresh_policy', 'conditions'):
+        sql = getattr(module, f'{name}_{part}', [])
+        # a list runs statement by statement; a continuous aggregate cannot be
+        # created in the same transaction as anything else
+        statements += sql if isinstance(sql, list) else [sql]
+    drop = getattr(module, f'{name}_drop', f"DROP MATERIALIZED VIEW IF EXISTS {name};")
+    return statements, drop
+
+
+def aggregate_definitions(until=None):
+    """
+    Yields (name, create statements, drop statement) for every aggregate as
+    defined once migration `until` has been applied (default: the latest).
+    """
+    definitions = {}
+    for module_name in AGGREGATE_MIGRATIONS:
+        if until is not None and module_name > until:
+            continue
+        module = importlib.import_module(f'analytics.migrations.{module_name}')
+        name = next(attr[:-len('_aggregate_table')] for attr in vars(module) if attr.endswith('_aggregate_table'))
+        definitions[name] = _definition(module, name)
+    for module_name in REDEFINING_MIGRATIONS:
+        if until is not None and module_name > until:
+            break
+        module = importlib.import_module(f'analytics.migrations.{module_name}')
+        for attr in list(vars(module)):
+            if attr.endswith('_aggregate_table'):
+                name = attr[:-len('_aggregate_table')]
+                definitions[name] = _definition(module, name)
+    for name, (statements, drop) in definitions.items():
+        yield name, statements, drop
+
+
+def drop_continuous_aggregates(until=None):
+    return [
+        migrations.RunSQL(drop, reverse_sql=statements)
+        for name, statements, drop in reversed(list(aggregate_definitions(until)))
+    ]
+
+
+def create_continuous_aggregates(until=None):
+    # CREATE MATERIALIZED VIEW ... WITH (timescaledb.continuous) materializes the
+    # existing data, so the recreated aggregates do not need a manual refresh.
+    return [
+        migrations.RunSQL(statements, reverse_sql=drop)
+        for name, statements, drop in aggregate_definitions(until)
+    ]
@@ -2,6 +2,7 @@ from django.db import models
 from django.contrib.auth.models import AbstractUser
 from django.db.models import Q, F, CheckConstraint
 from django.contrib.postgres.fields import ArrayField
+from django.core.validators import MinValueValidator
 import os, hashlib, base64
 from django.utils.crypto import get_random_string
 
@@ -18,6 +19,9 @@ class Product(models.Model):
     description = models.TextField(max_length=500, blank=True, null=True)
     thumbnail = models.ImageField(upload_to='thumbnails/', blank=True, null=True)
     owner = models.ForeignKey(CustomUser, related_name='products', on_delete=models.CASCADE)
+    # days raw events are kept, None = EVENT_RETENTION_DAYS; the continuous aggregates
+    # re-read the last 7 days on every refresh, so shorter values would erase them
+    event_retention_days = models.PositiveIntegerField(null=True, blank=True, validators=[MinValueValidator(8)])
 
     def save(self, *args, **kwargs):
         if self.thumbnail and not self.thumbnail.name.startswith('thumbnails/'):
@@ -70,7 +74,7 @@ class Queue(models.Model):
 # session management
 
 class Client(models.Model):
-    id = models.IntegerField(primary_key=True)
+    id = models.BigIntegerField(primary_key=True)
     token = models.ForeignKey(Token, related_name='clients', on_delete=models.CASCADE)
 
 
@@ -98,31 +102,48 @@ class GameEvent(models.Model):
     client = models.ForeignKey(Client, related_name="events", on_delete=models.CASCADE)
     session = models.ForeignKey(Session, related_name="events", on_delete=models.CASCADE)
     product = models.ForeignKey(Product, related_name="events", on_delete=models.CASCADE)
+    client_event_id = models.UUIDField(null=True, blank=True)
 
     class Meta:
         managed = False
         db_table = 'gameevent'
 # Events
 
-class SessionStartEvent(models.Model):
-    game_event = models.IntegerField()
-    platform = models.TextField(max_length=100, null=False)
-    
+class TypedEvent(models.Model):
+    """
+    Per event type hypertable (migration 0020). Each row repeats the time,
+    client, session and product of its gameevent row, so the continuous
+    aggregates read one hypertable instead of joining gameevent.
+    """
+    game_event = models.BigIntegerField(primary_key=True)
+    time = models.DateTimeField()
+    client = models.ForeignKey(Client, related_name='+', on_delete=models.CASCADE)
+    session = models.ForeignKey(Session, related_name='+', on_delete=models.CASCADE)
+    product = models.ForeignKey(Product, related_name='+', on_delete=models.CASCADE)
 
+    class Meta:
+        abstract = True
+        managed = False
 
 
+class SessionStartEvent(TypedEvent):
+    platform = models.TextField(max_length=100, null=False)
 
-class BussinessEvent(models.Model):
-    game_event = models.IntegerField()
+    class Meta(TypedEvent.Meta):
+        db_table = 'sessionstartevent'
+
+
+class BussinessEvent(TypedEvent):
     cartType = models.CharField(max_length=max_name_length)
     itemType = models.CharField(max_length=max_name_length)
     itemId = models.CharField(max_length=max_name_length)
     amount = models.IntegerField()
-    game_event = models.IntegerField()
     currency  = models.CharField(max_length=max_name_length)
 
-class ErrorEvent(models.Model):
-    game_event = models.IntegerField()
+    class Meta(TypedEvent.Meta):
+        db_table = 'bussinessevent'
+
+class ErrorEvent(TypedEvent):
     message = models.TextField()
     severity = models.CharField(max_length=10, choices=[('Info', 'Info'),
                                                         ('Debug', 'Debug'),
@@ -130,32 +151,43 @@ class ErrorEvent(models.Model):
                                                         ('Error', 'Error'),
                                                         ('Critical', 'Critical')])
 
+    class Meta(TypedEvent.Meta):
+        db_table = 'errorevent'
+
 
-class ProgeressionEvent(models.Model):
-    game_event = models.IntegerField()
+class ProgeressionEvent(TypedEvent):
     progressionStatus = models.CharField(max_length=max_name_length)
     progression01 = models.CharField(max_length=max_name_length)
     progression02 = models.CharField(max_length=max_name_length)
     progression03 = models.CharField(max_length=max_name_length)
     value = models.FloatField()
 
+    class Meta(TypedEvent.Meta):
+        db_table = 'progeressionevent'
 
-class QualityEvent(models.Model):
-    game_event = models.IntegerField()
+
+class QualityEvent(TypedEvent):
     FPS = models.FloatField()
     memoryUsage = models.FloatField()
 
+    class Meta(TypedEvent.Meta):
+        db_table = 'qualityevent'
+
 
-class ResourceEvent(models.Model):
-    game_event = models.IntegerField()
+class ResourceEvent(TypedEvent):
     flowType = models.CharField(max_length=max_name_length)
     itemType = models.CharField(max_length=max_name_length)
     itemId = models.CharField(max_length=max_name_length)
     amount = models.IntegerField()
     resourceCurrency = models.CharField(max_length=max_name_length)
 
-class SessionEndEvent(models.Model):
-    game_event = models.IntegerField()
+    class Meta(TypedEvent.Meta):
+        db_table = 'resourceevent'
+
+class SessionEndEvent(TypedEvent):
+
+    class Meta(TypedEvent.Meta):
+        db_table = 'sessionendevent'
 
 
 # Materialized Views
@@ -283,3 +315,38 @@ class TopErrorTypes(models.Model):
     class Meta:
         managed = False
         db_table = 'toperrortypes'
+
+
+class ActiveUserSketch(models.Model):
+    # one row per product, day and HyperLogLog register, see services/ActiveUsers.py
+    bucket = models.DateTimeField(primary_key=True)
+    product = models.ForeignKey('Product', db_column='product_id', on_delete=models.DO_NOTHING)
+    register = models.IntegerField()
+    rank = models.IntegerField()
+
+    class Meta:
+        managed = False
+        db_table = 'activeusersketch'
+
+
+class FPSSketch(models.Model):
+    # events per product, hour and logarithmic FPS bin, see services/Percentiles.py
+    bucket = models.DateTimeField(primary_key=True)
+    product = models.ForeignKey('Product', db_column='product_id', on_delete=models.DO_NOTHING)
+    bin = models.IntegerField()
+    count = models.BigIntegerField()
+
+    class Meta:
+        managed = False
+        db_table = 'fpssketch'
+
+
+class MemoryUsageSketch(models.Model):
+    bucket = models.DateTimeField(primary_key=True)
+    product = models.ForeignKey('Product', db_column='product_id', on_delete=models.DO_NOTHING)
+    bin = models.IntegerField()
+    count = models.BigIntegerField()
+
+    class Meta:
+        managed = False
+        db_table = 'memoryusagesketch'
@@ -134,7 +134,7 @@ class SessionStartEventSerializer(serializers.ModelSerializer):
 
     class Meta:
         model = SessionStartEvent
-        fields = ['id', 'game_event', 'platform', 'client', 'session', 'time', 'product']
+        fields = ['game_event', 'platform', 'client', 'session', 'time', 'product']
         read_only_fields = ['game_event']
 
     def create(self, validated_data):
@@ -158,6 +158,10 @@ class SessionStartEventSerializer(serializers.ModelSerializer):
 
         session_start_event = SessionStartEvent.objects.create(
             game_event=game_event.id,
+            time=time,
+            client=client,
+            session=session,
+            product=product,
             platform=platform
         )
         return session_start_event
@@ -171,7 +175,7 @@ class BussinessEventSerializer(serializers.ModelSerializer):
 
     class Meta(GameEventSerializer.Meta):
         model = BussinessEvent
-        fields = ['id', 'game_event', 'client', 'session', 'time', 'product'] + ['cartType', 'itemType', 'itemId','amount', 'currency']
+        fields = ['game_event', 'client', 'session', 'time', 'product'] + ['cartType', 'itemType', 'itemId','amount', 'currency']
         read_only_fields = ['game_event']                                                                        
 
     def create(self, validated_data):
@@ -199,6 +203,10 @@ class BussinessEventSerializer(serializers.ModelSerializer):
 
         business_event = BussinessEvent.objects.create(
             game_event=game_event.id,
+            time=time,
+            client=client,
+            session=session,
+            product=product,
             cartType=cartType,
             itemType=itemType,
             itemId=itemId,
@@ -216,7 +224,7 @@ class ErrorEventSerializer(serializers.ModelSerializer):
     
     class Meta(GameEventSerializer.Meta):
         model = ErrorEvent
-        fields = ['id', 'game_event', 'client', 'session', 'time', 'product'] + ['message', 'severity']
+        fields = ['game_event', 'client', 'session', 'time', 'product'] + ['message', 'severity']
         read_only_fields = ['game_event']
 
     def create(self, validated_data):
@@ -241,6 +249,10 @@ class ErrorEventSerializer(serializers.ModelSerializer):
 
         business_event = ErrorEvent.objects.create(
             game_event=game_event.id,
+            time=time,
+            client=client,
+            session=session,
+            product=product,
             message=message,
             severity=severity
         )
@@ -256,7 +268,7 @@ class ProgeressionEventSerializer(serializers.ModelSerializer):
     
     class Meta(GameEventSerializer.Meta):
         model = ProgeressionEvent
-        fields = ['id', 'game_event', 'client', 'session', 'time', 'product'] + ['progressionStatus', 'progression01','progression02', 'progression03', 'value']
+        fields = ['game_event', 'client', 'session', 'time', 'product'] + ['progressionStatus', 'progression01','progression02', 'progression03', 'value']
         read_only_fields = ['game_event']                                                                       
                                                                                 
 
@@ -285,6 +297,10 @@ class ProgeressionEventSerializer(serializers.ModelSerializer):
 
         business_event = ProgeressionEvent.objects.create(
             game_event=game_event.id,
+            time=time,
+            client=client,
+            session=session,
+            product=product,
             progressionStatus=progressionStatus,
             progression01=progression01,
             progression02=progression02,
@@ -303,7 +319,7 @@ class QualityEventSerializer(serializers.ModelSerializer):
     
     class Meta(GameEventSerializer.Meta):
         model = QualityEvent
-        fields = ['id', 'game_event', 'client', 'session', 'time', 'product'] + ['FPS', 'memoryUsage']
+        fields = ['game_event', 'client', 'session', 'time', 'product'] + ['FPS', 'memoryUsage']
         read_only_fields = ['game_event']
         
     def create(self, validated_data):
@@ -328,6 +344,10 @@ class QualityEventSerializer(serializers.ModelSerializer):
 
         business_event = QualityEvent.objects.create(
             game_event=game_event.id,
+            time=time,
+            client=client,
+            session=session,
+            product=product,
             FPS=FPS,
             memoryUsage=memoryUsage
         )
@@ -343,7 +363,7 @@ class ResourceEventSerializer(serializers.ModelSerializer):
     
     class Meta(GameEventSerializer.Meta):
         model = ResourceEvent
-        fields = GameEventSerializer.Meta.fields + ['flowType', 'itemType', 'itemId', 'amount', 'resourceCurrency']
+        fields = ['game_event', 'client', 'session', 'time', 'product'] + ['flowType', 'itemType', 'itemId', 'amount', 'resourceCurrency']
         read_only_fields = ['game_event']
 
     def create(self, validated_data):
@@ -371,6 +391,10 @@ class ResourceEventSerializer(serializers.ModelSerializer):
 
         business_event = ResourceEvent.objects.create(
             game_event=game_event.id,
+            time=time,
+            client=client,
+            session=session,
+            product=product,
             flowType=flowType,
             itemType=itemType,
             itemId=itemId,
@@ -386,7 +410,7 @@ class SessionEndEventSerializer(serializers.ModelSerializer):
 
     class Meta:
         model = SessionEndEvent
-        fields = ['id', 'game_event', 'client', 'session', 'time']
+        fields = ['game_event', 'client', 'session', 'time']
         read_only_fields = ['game_event']
 
     def create(self, validated_data):
@@ -397,5 +421,9 @@ class SessionEndEventSerializer(serializers.ModelSerializer):
         game_event = GameEvent.objects.create(client=client, session=session, time=time)
         session_end_event = SessionEndEvent.objects.create(
             game_event=game_event.id,
+            time=time,
+            client=client,
+            session=session,
+            product_id=game_event.product_id,
         )
         return session_end_event
@@ -0,0 +1,416 @@
+import asyncio
+import logging
+import re
+import time
+from collections import Counter, defaultdict
+
+import aio_pika
+from django.conf import settings
+
+from ..models import Client, Queue, Session, Token
+from .EventCodec import encode_event
+from .EventEnvelope import is_envelope, rejected_envelope, unpack_envelope
+from .EventHandlers import EVENT_HANDLERS
+from .EventSchemas import EventValidationError
+from .EventDedup import event_dedup
+from .EventWriter import (
+    EVENT_MODELS, ON_DUPLICATE_EVENT, TYPED_EVENT_FIELDS, build_gameevent_insert, build_insert_statements,
+    build_subtype_insert, is_duplicate_event, kept_ids,
+)
+from .IdAllocator import RESERVE_BLOCK_SQL, AsyncSequenceBlockAllocator
+from . import IngestMetrics as metrics
+from .IngestMetrics import log_event
+from .LiveAggregates import live_kpis
+from .SessionCache import SessionInfo, session_cache
+from .StagingWriter import staging_columns, staging_table
+
+# asyncio counterpart of IngestionStep used by the ingest_async command: the same
+# handlers and schemas, with asyncpg for Postgres and any AMQP client whose
+# messages have body, routing_key, headers, content_type, content_encoding and
+# coroutine ack()/reject() (aio-pika's IncomingMessage does).
+
+
+# asyncpg sends the number of bind parameters of a statement as a 16-bit integer
+MAX_BIND_PARAMS = 32767
+GAMEEVENT_COLUMNS = 6
+
+
+def insert_chunks(event_type, rows, ids):
+    """
+    (rows, ids) slices of at most as many rows as fit in one insert of
+    gameevent or of the subtype table, whichever has more columns.
+    """
+    _, fields = EVENT_MODELS[event_type]
+    size = MAX_BIND_PARAMS // max(GAMEEVENT_COLUMNS, len(TYPED_EVENT_FIELDS) + len(fields))
+    for start in range(0, len(rows), size):
+        yield rows[start:start + size], ids[start:start + size]
+
+
+def dollar_params(sql):
+    """Rewrites the %s placeholders used with psycopg2 into asyncpg's $1, $2, ..."""
+    counter = iter(range(1, 1 << 16))
+    return re.sub(r'%s', lambda _: f'${next(counter)}', sql)
+
+
+class AsyncEventStore:
+    """Session lookups, session updates and event writes over an asyncpg pool."""
+
+    def __init__(self, pool):
+        self.pool = pool
+        self.event_ids = AsyncSequenceBlockAllocator('gameevent_id_seq', self.reserve_block)
+
+    async def reserve_block(self, sequence):
+        row = await self.pool.fetchrow(dollar_params(RESERVE_BLOCK_SQL), sequence, sequence)
+        return row[0], row[1]
+
+    async def session_info(self, session_id):
+        info = session_cache.peek(session_id)
+        if info is not None:
+            return info
+        row = await self.pool.fetchrow(
+            f'''
+            SELECT s.client_id, s.token_id, t."Product_id" FROM {Session._meta.db_table} s
+            JOIN {Token._meta.db_table} t ON t.id = s.token_id WHERE s.id = $1
+            ''',
+            session_id
+        )
+        if row is None:
+            raise Session.DoesNotExist(f"Session with id '{session_id}' not found.")
+        info = SessionInfo(*row)
+        session_cache.put(session_id, info)
+        return info
+
+    async def client_token(self, client_id):
+        row = await self.pool.fetchrow(
+            f'''
+            SELECT c.token_id, t."Product_id" FROM {Client._meta.db_table} c
+            JOIN {Token._meta.db_table} t ON t.id = c.token_id WHERE c.id = $1
+            ''',
+            client_id
+        )
+        if row is None:
+            raise Client.DoesNotExist(f"Client with id '{client_id}' not found.")
+        return row[0], row[1]
+
+    async def create_session(self, record):
+        await self.pool.execute(
+            f'''
+            INSERT INTO {Session._meta.db_table} (id, token_id, client_id, start_time, platform)
+            VALUES ($1, $2, $3, $4, $5) ON CONFLICT (id) DO NOTHING
+            ''',
+            record['session'], record['token'], record['client'], record['time'], record['platform']
+        )
+
+    async def end_session(self, session_id, end_time):
+        await self.pool.execute(
+            f"UPDATE {Session._meta.db_table} SET end_time = $2, duration = $2 - start_time WHERE id = $1",
+            session_id, end_time
+        )
+
+    async def write_events(self, event_type, rows):
+        return await self.write_event_groups({event_type: rows})
+
+    async def write_event_groups(self, groups):
+        """
+        Writes {event type: [rows]} in one transaction. Returns the ids, None for
+        duplicates of earlier events that were left out (see write_events).
+        """
+        groups = {event_type: rows for event_type, rows in groups.items() if rows}
+        if not groups:
+            return []
+        ids = await self.event_ids.allocate(sum(len(rows) for rows in groups.values()))
+        staging = settings.INGEST_MODE == 'staging'
+        skip_duplicates = not staging and sum(event_dedup.suspects(event_type, rows) for event_type, rows in groups.items()) > 0
+        started = time.perf_counter()
+        try:
+            kept = await self._write_groups(groups, ids, staging, skip_duplicates)
+        except Exception as e:
+            if skip_duplicates or not is_duplicate_event(e):
+                raise
+            for event_type in groups:
+                event_dedup.missed(event_type)
+            kept = await self._write_groups(groups, ids, staging, skip_duplicates=True)
+        seconds = time.perf_counter() - started
+
+        offset = 0
+        for event_type, rows in groups.items():
+            group_ids = kept[offset:offset + len(rows)]
+            offset += len(rows)
+            new = [row for row, game_event_id in zip(rows, group_ids) if game_event_id is not None]
+            if skip_duplicates:
+                event_dedup.confirmed(event_type, len(rows) - len(new))
+            metrics.written(event_type, new, seconds)
+            if settings.LIVE_KPI_INTERVAL:
+                live_kpis.record(event_type, new)
+        return kept
+
+    async def _write_groups(self, groups, ids, staging, skip_duplicates):
+        kept = []
+        async with self.pool.acquire() as connection:
+            async with connection.transaction():
+                offset = 0
+                for event_type, rows in groups.items():
+                    group_ids = ids[offset:offset + len(rows)]
+                    offset += len(rows)
+                    if staging:
+                        await self._stage(connection, event_type, rows, group_ids)
+                        kept += group_ids
+                    else:
+                        kept += await self._insert(connection, event_type, rows, group_ids, skip_duplicates)
+        return kept
+
+    async def _stage(self, connection, event_type, rows, ids):
+        _, fields = EVENT_MODELS[event_type]
+        await connection.copy_records_to_table(
+            staging_table(event_type),
+            columns=[name for name, _ in staging_columns(event_type)],
+            records=[
+                (game_event_id, row['time'], row['client'], row['session'], row['product'], *[row[field] for field in fields], row.get('event_id'))
+                for game_event_id, row in zip(ids, rows)
+            ],
+        )
+
+    async def _insert(self, connection, event_type, rows, ids, skip_duplicates):
+        kept = []
+        for chunk_rows, chunk_ids in insert_chunks(event_type, rows, ids):
+            kept += await self._insert_chunk(connection, event_type, chunk_rows, chunk_ids, skip_duplicates)
+        return kept
+
+    async def _insert_chunk(self, connection, event_type, rows, ids, skip_duplicates):
+        if not skip_duplicates:
+            for sql, params in build_insert_statements(event_type, rows, ids):
+                await connection.execute(dollar_params(sql), *params)
+            return ids
+        sql, params = build_gameevent_insert(rows, ids)
+        inserted = {row[0] for row in await connection.fetch(dollar_params(sql + ON_DUPLICATE_EVENT), *params)}
+        kept = kept_ids(ids, inserted)
+        new = [(game_event_id, row) for game_event_id, row in zip(kept, rows) if game_event_id is not None]
+        if new:
+            sql, params = build_subtype_insert(event_type, [row for _, row in new], [game_event_id for game_event_id, _ in new])
+            await connection.execute(dollar_params(sql), *params)
+        return kept
+
+    async def event_queues(self):
+        """[(queue name, product id)] from the Queue table."""
+        rows = await self.pool.fetch(
+            f'''
+            SELECT q.fullname, t."Product_id" FROM {Queue._meta.db_table} q
+            JOIN {Token._meta.db_table} t ON t.id = q.token_id
+            '''
+        )
+        return [(row[0], row[1]) for row in rows]
+
+
+class AsyncEventBatcher:
+    """EventBatcher for the asyncio daemon; messages are acked one by one after the commit."""
+
+    def __init__(self, event_type, size, interval_ms, writer, failed):
+        self.event_type = event_type
+        self.size = size
+        self.interval = interval_ms / 1000
+        self.writer = writer
+        self.failed = failed
+        self.pending = []
+        self.oldest = None
+
+    async def add(self, row, message):
+        if not self.pending:
+            self.oldest = time.monotonic()
+        self.pending.append((row, message))
+        if len(self.pending) >= self.size:
+            await self.flush()
+
+    async def flush_due(self):
+        if self.pending and time.monotonic() - self.oldest >= self.interval:
+            await self.flush()
+
+    async def flush(self):
+        if not self.pending:
+            return
+        batch, self.pending = self.pending, []
+
+        try:
+            await self.writer(self.event_type, [row for row, _ in batch])
+        except Exception as e:
+            log_event(logging.WARNING, "batch failed, retrying one by one", event_type=self.event_type, size=len(batch), error=str(e))
+            for row, message in batch:
+                try:
+                    await self.writer(self.event_type, [row])
+                except Exception as e:
+                    log_event(logging.WARNING, "event failed", event_type=self.event_type, session=row.get('session'), error=str(e))
+                    await self.failed(message, e)
+                else:
+                    await message.ack()
+            return
+
+        for _, message in batch:
+            await message.ack()
+
+
+class AsyncFailurePolicy:
+    """FailurePolicy for aio-pika channels."""
+
+    def __init__(self, channel, policy):
+        self.channel = channel
+        self.policy = policy  # a FailurePolicy, used for plan() only
+        self.declared = set()
+
+    async def failed(self, message, error, retry=True):
+        target, headers = self.policy.plan(message.routing_key, message.headers, error, retry)
+        try:
+            await self.publish(target, aio_pika.Message(
+                message.body, headers=headers, content_type=message.content_type,
+                content_encoding=message.content_encoding, delivery_mode=aio_pika.DeliveryMode.PERSISTENT,
+            ))
+        except Exception as e:
+            log_event(logging.ERROR, "could not republish, requeued", queue=message.routing_key, error=str(e))
+            await message.reject(requeue=True)
+            return
+        await message.ack()
+
+    async def quarantine_part(self, message, data, error):
+        """FailurePolicy.quarantine_part: parks `data` as JSON, the caller settles `message`."""
+        target, headers = self.policy.plan(message.routing_key, message.headers, error, retry=False)
+        body, content_encoding = encode_event(data)
+        try:
+            await self.publish(target, aio_pika.Message(
+                body, headers=headers, content_type='application/json',
+                content_encoding=content_encoding, delivery_mode=aio_pika.DeliveryMode.PERSISTENT,
+            ))
+        except Exception as e:
+            log_event(logging.ERROR, "could not quarantine envelope entries", queue=message.routing_key, error=str(e))
+
+    async def publish(self, target, outgoing):
+        if target.name not in self.declared:
+            await self.channel.declare_queue(target.name, durable=True, arguments=target.queue_arguments)
+            self.declared.add(target.name)
+        await self.channel.default_exchange.publish(outgoing, routing_key=target.name)
+
+
+class AsyncIngestor:
+    """
+    Runs handler stages for many messages at once. At most `concurrency`
+    messages are in flight (decoded but not yet handed to a batcher); drain()
+    waits for them and flushes every batcher so all messages are settled.
+    """
+
+    def __init__(self, store, failures, concurrency, batch_settings, handlers=EVENT_HANDLERS):
+        self.store = store
+        self.failures = failures
+        self.handlers = handlers
+        self.slots = asyncio.Semaphore(concurrency)
+        self.tasks = set()
+        self.stats = defaultdict(Counter)
+        self.products = {}  # queue name -> product id, for metric labels
+        self.batchers = {}
+        for event_type in handlers:
+            config = batch_settings(event_type)
+            self.batchers[event_type] = AsyncEventBatcher(event_type, config['size'], config['interval_ms'], store.write_events, self.fail)
+
+    async def on_message(self, message):
+        await self.slots.acquire()
+        task = asyncio.create_task(self.process(message))
+        self.tasks.add(task)
+        task.add_done_callback(self._done)
+
+    def _done(self, task):
+        self.tasks.discard(task)
+        self.slots.release()
+
+    async def fail(self, message, error, retry=True):
+        parts = message.routing_key.split('.')
+        metrics.failed(parts[2] if len(parts) > 2 else '', self.products.get(message.routing_key), 'error' if retry else 'invalid')
+        if self.failures is None:
+            await message.reject(requeue=False)
+            return
+        await self.failures.failed(message, error, retry=retry)
+
+    async def process(self, message):
+        parts = message.routing_key.split('.')
+        event_type = parts[2] if len(parts) > 2 else None
+        handler = self.handlers.get(event_type)
+        if handler is None:
+            log_event(logging.WARNING, "no handler", queue=message.routing_key)
+            await message.reject(requeue=False)
+            return
+
+        self.stats[event_type]['received'] += 1
+        product_id = self.products.get(message.routing_key)
+        metrics.received(event_type, product_id)
+        started = time.perf_counter()
+        try:
+            await self.handle(handler, event_type, message)
+        finally:
+            metrics.handled(event_type, product_id, time.perf_counter() - started)
+
+    async def handle(self, handler, event_type, message):
+        stats = self.stats[event_type]
+        try:
+            data = handler.decode(message.body, message.content_type, message.content_encoding)
+        except ValueError as e:
+            stats['invalid'] += 1
+            log_event(logging.WARNING, "undecodable message", event_type=event_type, error=str(e), body=message.body[:200])
+            await self.fail(message, e, retry=False)
+            return
+
+        batcher = self.batchers[event_type]
+        try:
+            if is_envelope(data):
+                await self.process_envelope(data, event_type, message)
+                return
+            record = await handler.validate_async(data, self.store)
+            await handler.persist_async(record, lambda row: batcher.add(row, message), self.store)
+        except EventValidationError as e:
+            stats['invalid'] += 1
+            log_event(logging.INFO, "invalid event", event_type=event_type, errors=e.errors)
+            await self.fail(message, e.errors, retry=False)
+            return
+        except Exception as e:
+            stats['failed'] += 1
+            log_event(logging.WARNING, "event failed", event_type=event_type, error=str(e), body=message.body[:200])
+            await self.fail(message, e)
+            return
+        stats['accepted'] += 1
+
+    async def process_envelope(self, data, queue_type, message):
+        """
+        IngestionStep.handle_envelope for the daemon. The rows are written in one
+        transaction; session updates of end_session entries run just before it.
+        """
+        self.stats[queue_type]['envelopes'] += 1
+        entries, invalid = unpack_envelope(data, queue_type, self.handlers)
+        groups = {}
+        for index, event_type, entry in entries:
+            handler = self.handlers[event_type]
+            try:
+                record = await handler.validate_async(entry, self.store)
+            except EventValidationError as e:
+                invalid.append((index, e.errors))
+                continue
+            rows = groups.setdefault(event_type, [])
+
+            async def collect(row, rows=rows):
+                rows.append(row)
+            await handler.persist_async(record, collect, self.store)
+
+        await self.store.write_event_groups(groups)
+
+        for event_type, rows in groups.items():
+            self.stats[event_type]['accepted'] += len(rows)
+        if invalid:
+            self.stats[queue_type]['invalid'] += len(invalid)
+            metrics.failed(queue_type, self.products.get(message.routing_key), 'invalid', len(invalid))
+            if self.failures is not None:
+                rejected = rejected_envelope(data, invalid)
+                await self.failures.quarantine_part(message, rejected, rejected['errors'])
+        await message.ack()
+
+    async def flush_due(self):
+        for batcher in self.batchers.values():
+            await batcher.flush_due()
+
+    async def drain(self):
+        while self.tasks:
+            await asyncio.gather(*list(self.tasks), return_exceptions=True)
+        for batcher in self.batchers.values():
+            await batcher.flush()
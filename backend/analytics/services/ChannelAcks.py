@@ -0,0 +1,44 @@
+from collections import OrderedDict
+
+
+class ChannelAcks:
+    """
+    Settles the messages of one AMQP channel that is shared by several event
+    types. A multiple-ack covers every earlier delivery tag on the channel, so
+    acks are held back until all earlier deliveries are settled and then sent
+    as a single multiple-ack on the newest of them. Rejects go out immediately.
+    """
+
+    def __init__(self):
+        self.outstanding = OrderedDict()  # delivery tag -> message, in delivery order
+        self.done = set()
+
+    def track(self, message):
+        self.outstanding[message.delivery_tag] = message
+
+    def ack(self, message):
+        self.ack_many([message])
+
+    def ack_many(self, messages):
+        for message in messages:
+            if message.delivery_tag in self.outstanding:
+                self.done.add(message.delivery_tag)
+            else:
+                message.ack()
+        self._release()
+
+    def reject(self, message, requeue=False):
+        self.outstanding.pop(message.delivery_tag, None)
+        message.reject(requeue=requeue)
+        self._release()
+
+    def _release(self):
+        last = None
+        while self.outstanding:
+            tag = next(iter(self.outstanding))
+            if tag not in self.done:
+                break
+            self.done.discard(tag)
+            last = self.outstanding.pop(tag)
+        if last is not None:
+            last.ack(multiple=True)
@@ -0,0 +1,139 @@
+from collections import namedtuple
+from datetime import timedelta
+
+from django.db import connection
+
+from .TimescalePolicies import event_hypertables
+
+# Chunk sizing for the event hypertables. Inserts and the aggregate refreshes
+# touch the newest chunk of every hypertable (one per space partition), so those
+# chunks and their indexes should stay in memory: Timescale's guideline is 25%
+# of the memory available for caching. The interval is chosen from the peak
+# ingest rate so that the active chunks of all event hypertables together fit in
+# that budget; it is the same for all of them, which keeps chunk boundaries (and
+# so compression and retention) aligned. Space partitions only split the same
+# rows into more chunks; on a single disk they add planning and open-chunk
+# overhead, so one partition is recommended per disk or tablespace, and only
+# while every partition still gets MIN_PARTITION_ROWS rows per chunk.
+
+MEMORY_FRACTION = 0.25
+MIN_PARTITION_ROWS = 1_000_000
+DEFAULT_ROW_BYTES = 200
+NICE_INTERVALS = [
+    timedelta(hours=hours) for hours in (1, 2, 3, 4, 6, 8, 12, 24, 48, 72, 168)
+]
+
+TableProfile = namedtuple('TableProfile', 'table rows bytes peak_rows_per_hour products interval partitions')
+
+
+def nice_interval(seconds):
+    """The longest of NICE_INTERVALS not above `seconds`, clamped to 1 hour .. 7 days."""
+    fitting = [interval for interval in NICE_INTERVALS if interval.total_seconds() <= seconds]
+    return fitting[-1] if fitting else NICE_INTERVALS[0]
+
+
+def row_bytes(profile):
+    """Bytes per row including indexes, from the table's current size."""
+    return profile.bytes / profile.rows if profile.rows and profile.bytes else DEFAULT_ROW_BYTES
+
+
+def recommend_chunk_interval(profiles, memory_bytes, memory_fraction=MEMORY_FRACTION):
+    """Interval whose active chunks, for all `profiles` at their peak rate, fit the memory budget."""
+    bytes_per_hour = sum(profile.peak_rows_per_hour * row_bytes(profile) for profile in profiles)
+    if not bytes_per_hour:
+        return NICE_INTERVALS[-1]
+    return nice_interval(memory_bytes * memory_fraction / bytes_per_hour * 3600)
+
+
+def recommend_partitions(rows_per_chunk, products, disks=1):
+    return max(1, min(disks, products, rows_per_chunk // MIN_PARTITION_ROWS))
+
+
+def effective_cache_bytes():
+    """effective_cache_size in bytes: Postgres' estimate of the memory available for caching."""
+    with connection.cursor() as cursor:
+        cursor.execute("SELECT pg_size_bytes(current_setting('effective_cache_size'))")
+        return cursor.fetchone()[0]
+
+
+def table_profile(table, days):
+    """Size, peak hourly ingest over the last `days`, active products and current chunk settings of `table`."""
+    with connection.cursor() as cursor:
+        cursor.execute("SELECT approximate_row_count(%s), hypertable_size(%s)", [table, table])
+        rows, size = cursor.fetchone()
+        cursor.execute(
+            f"""
+            SELECT COALESCE(max(events), 0), (SELECT count(DISTINCT product_id) FROM {table} WHERE time > now() - make_interval(days => %s))
+            FROM (
+                SELECT count(*) AS events FROM {table}
+                WHERE time > now() - make_interval(days => %s)
+                GROUP BY time_bucket('1 hour', time)
+            ) hours
+            """,
+            [days, days]
+        )
+        peak, products = cursor.fetchone()
+        cursor.execute(
+            """
+            SELECT max(time_interval) FILTER (WHERE column_name = 'time'), max(num_partitions) FILTER (WHERE column_name = 'product_id')
+            FROM timescaledb_information.dimensions WHERE hypertable_name = %s
+            """,
+            [table]
+        )
+        interval, partitions = cursor.fetchone()
+    return TableProfile(table, rows, size, peak, products, interval, partitions or 1)
+
+
+def product_volumes(table, days, limit=10):
+    """[(product id, events, peak events per hour)] of the busiest products over the last `days`."""
+    with connection.cursor() as cursor:
+        cursor.execute(
+            f"""
+            SELECT product_id, sum(events), max(events) FROM (
+                SELECT product_id, count(*) AS events FROM {table}
+                WHERE time > now() - make_interval(days => %s)
+                GROUP BY product_id, time_bucket('1 hour', time)
+            ) hours
+            GROUP BY product_id ORDER BY 2 DESC LIMIT %s
+            """,
+            [days, limit]
+        )
+        return cursor.fetchall()
+
+
+def recommend(tables=None, days=7, memory_bytes=None, disks=1):
+    """Returns (profiles, recommended interval, {table: recommended partitions}, memory bytes used)."""
+    profiles = [table_profile(table, days) for table in tables or event_hypertables()]
+    memory_bytes = memory_bytes or effective_cache_bytes()
+    interval = recommend_chunk_interval(profiles, memory_bytes)
+    hours = interval.total_seconds() / 3600
+    partitions = {
+        profile.table: recommend_partitions(int(profile.peak_rows_per_hour * hours), profile.products, disks)
+        for profile in profiles
+    }
+    return profiles, interval, partitions, memory_bytes
+
+
+def apply_chunk_settings(table, interval=None, partitions=None):
+    """New chunks of `table` use `interval` and `partitions`; existing chunks keep theirs."""
+    with connection.cursor() as cursor:
+        if interval is not None:
+            cursor.execute("SELECT set_chunk_time_interval(%s, %s::interval)", [table, interval])
+        if partitions is not None:
+            cursor.execute("SELECT set_number_partitions(%s, %s, 'product_id')", [table, partitions])
+
+
+def chunk_history(table, bucket='1 day', days=30):
+    """[(bucket start, chunks, total bytes, largest chunk bytes)] of the chunks of `table` by range start."""
+    with connection.cursor() as cursor:
+        cursor.execute(
+            """
+            SELECT time_bucket(%s::interval, c.range_start) AS started, count(*), sum(s.total_bytes), max(s.total_bytes)
+            FROM timescaledb_information.chunks c
+            JOIN chunks_detailed_size(%s) s ON s.chunk_schema = c.chunk_schema AND s.chunk_name = c.chunk_name
+            WHERE c.hypertable_name = %s AND c.range_start > now() - make_interval(days => %s)
+            GROUP BY started ORDER BY started
+            """,
+            [bucket, table, table, days]
+        )
+        return cursor.fetchall()
@@ -0,0 +1,82 @@
+import logging
+import time
+
+from .EventWriter import write_events
+from .IngestMetrics import log_event
+
+
+class EventBatcher:
+    """
+    Collects validated events of one type together with their AMQP messages and
+    writes them with write_events once `size` events are pending or the oldest
+    pending event is `interval_ms` old.
+
+    All messages handed to a batcher must come from the same channel: after a
+    successful commit the batch is settled with a single multiple-ack on the
+    newest delivery tag, or through `acks` (a ChannelAcks) when other batchers
+    share the channel. Rows that still fail on their own are passed to
+    `failed(message, error)` when given, and rejected otherwise.
+    """
+
+    def __init__(self, event_type, size, interval_ms, writer=write_events, acks=None, failed=None):
+        self.event_type = event_type
+        self.size = size
+        self.interval = interval_ms / 1000
+        self.writer = writer
+        self.acks = acks
+        self.failed = failed
+        self.pending = []
+        self.oldest = None
+
+    def add(self, row, message):
+        if not self.pending:
+            self.oldest = time.monotonic()
+        self.pending.append((row, message))
+        if len(self.pending) >= self.size:
+            self.flush()
+
+    def flush_due(self):
+        if self.pending and time.monotonic() - self.oldest >= self.interval:
+            self.flush()
+
+    def flush(self):
+        if not self.pending:
+            return
+        batch, self.pending = self.pending, []
+
+        try:
+            self.writer(self.event_type, [row for row, _ in batch])
+        except Exception as e:
+            log_event(logging.WARNING, "batch failed, retrying one by one", event_type=self.event_type, size=len(batch), error=str(e))
+            self._flush_one_by_one(batch)
+            return
+
+        if self.acks is not None:
+            self.acks.ack_many([message for _, message in batch])
+        else:
+            batch[-1][1].ack(multiple=True)
+
+    def _flush_one_by_one(self, batch):
+        for row, message in batch:
+            try:
+                self.writer(self.event_type, [row])
+            except Exception as e:
+                log_event(logging.WARNING, "event failed", event_type=self.event_type, session=row.get('session'), error=str(e))
+                if self.failed is not None:
+                    self.failed(message, e)
+                else:
+                    self._reject(message)
+            else:
+                self._ack(message)
+
+    def _ack(self, message):
+        if self.acks is not None:
+            self.acks.ack(message)
+        else:
+            message.ack()
+
+    def _reject(self, message):
+        if self.acks is not None:
+            self.acks.reject(message)
+        else:
+            message.reject(requeue=False)
@@ -0,0 +1,57 @@
+import json
+
+import msgpack
+import zstandard
+
+# Message bodies are decoded once, straight from the raw AMQP body, by content
+# type and content encoding:
+#
+#   application/json (or none)       JSON text; a JSON string holding JSON (older
+#                                    SDKs double-encode) is unwrapped once more
+#   application/msgpack              MessagePack map; timestamps may be strings
+#                                    or the msgpack timestamp extension
+#   content-encoding: zstd           zstd frame around either of the above
+
+JSON_TYPES = {None, '', 'application/json', 'text/plain'}
+MSGPACK_TYPES = {'application/msgpack', 'application/x-msgpack'}
+
+_zstd = zstandard.ZstdDecompressor()
+
+
+class DecodeError(ValueError):
+    pass
+
+
+def decode_event(body, content_type=None, content_encoding=None):
+    if content_encoding == 'zstd':
+        try:
+            body = _zstd.decompress(body)
+        except zstandard.ZstdError as e:
+            raise DecodeError(f"bad zstd body: {e}")
+
+    if content_type in MSGPACK_TYPES:
+        try:
+            data = msgpack.unpackb(body, raw=False, timestamp=3)
+        except (ValueError, msgpack.UnpackException) as e:
+            raise DecodeError(f"bad msgpack body: {e}")
+    elif content_type in JSON_TYPES:
+        data = json.loads(body)
+        if isinstance(data, str):
+            data = json.loads(data)
+    else:
+        raise DecodeError(f"unsupported content type {content_type!r}")
+
+    if not isinstance(data, dict):
+        raise DecodeError(f"expected an object, got {type(data).__name__}")
+    return data
+
+
+def encode_event(data, content_type='application/json', compress=False):
+    """Encodes an event the way the SDKs publish it; returns (body, content_encoding)."""
+    if content_type in MSGPACK_TYPES:
+        body = msgpack.packb(data, datetime=True)
+    else:
+        body = json.dumps(data, default=str).encode()
+    if compress:
+        return zstandard.ZstdCompressor().compress(body), 'zstd'
+    return body, 'utf-8' if content_type not in MSGPACK_TYPES else 'binary'
@@ -0,0 +1,96 @@
+import hashlib
+import math
+import struct
+import threading
+import time
+
+from django.conf import settings
+
+from . import IngestMetrics as metrics
+
+# Events may carry a client-generated `event_id` (a UUID). gameevent has a
+# partial unique index on (client_event_id, time, product_id), so a redelivered
+# event can never be stored twice, but inserting with ON CONFLICT ... RETURNING
+# and then filtering the subtype rows costs an extra round trip. Writers ask the
+# deduplicator first: a batch without possible duplicates takes the plain insert,
+# and only batches with a filter hit take the conflict-aware path. After a worker
+# restart the filter is empty; a duplicate it misses shows up as a unique
+# violation, and the writer repeats the batch on the conflict-aware path.
+
+
+class RotatingBloomFilter:
+    """
+    Remembers keys for between one and two windows with two Bloom filters: new
+    keys go into the current one, lookups check both, and the current one becomes
+    the previous one every `window` seconds or once `capacity` keys were added.
+    """
+
+    def __init__(self, capacity, error_rate, window, clock=time.monotonic):
+        self.capacity = capacity
+        self.size = max(8, math.ceil(-capacity * math.log(error_rate) / math.log(2) ** 2))
+        self.hashes = max(1, round(self.size / capacity * math.log(2)))
+        self.window = window
+        self.clock = clock
+        self.current = bytearray((self.size + 7) // 8)
+        self.previous = bytearray(len(self.current))
+        self.added = 0
+        self.rotated_at = clock()
+
+    def _positions(self, key):
+        first, second = struct.unpack('<QQ', hashlib.blake2b(key.encode(), digest_size=16).digest())
+        return [(first + i * second) % self.size for i in range(self.hashes)]
+
+    def rotate(self):
+        self.previous, self.current = self.current, bytearray(len(self.current))
+        self.added = 0
+        self.rotated_at = self.clock()
+
+    def check_and_add(self, key):
+        """True if `key` may have been added before (false positives possible)."""
+        if self.added >= self.capacity or self.clock() - self.rotated_at >= self.window:
+            self.rotate()
+        positions = self._positions(key)
+        current, previous = self.current, self.previous
+        seen_now = seen_before = True
+        for position in positions:
+            byte, bit = position >> 3, 1 << (position & 7)
+            if not current[byte] & bit:
+                seen_now = False
+                current[byte] |= bit
+            if not previous[byte] & bit:
+                seen_before = False
+        if not seen_now:
+            self.added += 1
+        return seen_now or seen_before
+
+
+class EventDeduplicator:
+    def __init__(self, capacity, error_rate, window):
+        self.filter = RotatingBloomFilter(capacity, error_rate, window)
+        self.lock = threading.Lock()
+
+    def suspects(self, event_type, rows):
+        """Adds the rows' event ids to the filter; returns how many may be duplicates."""
+        checked = suspected = 0
+        with self.lock:
+            for row in rows:
+                event_id = row.get('event_id')
+                if event_id is None:
+                    continue
+                checked += 1
+                if self.filter.check_and_add(event_id):
+                    suspected += 1
+        if checked:
+            metrics.dedup_checked(event_type, checked, suspected)
+        return suspected
+
+    def missed(self, event_type):
+        """A duplicate got past the filter and was caught by the unique index."""
+        metrics.dedup_missed(event_type)
+
+    def confirmed(self, event_type, duplicates, stage='insert'):
+        if duplicates:
+            metrics.dedup_duplicates(event_type, duplicates, stage)
+
+
+event_dedup = EventDeduplicator(settings.INGEST_DEDUP_CAPACITY, settings.INGEST_DEDUP_ERROR_RATE, settings.INGEST_DEDUP_WINDOW)
@@ -0,0 +1,63 @@
+from .EventHandlers import require_session
+from .EventSchemas import INVALID_CHOICE, EventValidationError
+
+# A batch envelope carries several events of one session in a single message:
+#
+#   {"session": 42, "client": 7, "events": [
+#       {"type": "quality_event", "time": "...", "FPS": 58.5, "memoryUsage": 812.0},
+#       {"time": "...", "FPS": 57.0, "memoryUsage": 815.5},
+#       {"type": "end_session", "time": "..."}]}
+#
+# Entries inherit session and client from the envelope; "type" defaults to the
+# event type of the queue the envelope arrived on. start_session cannot be
+# batched, the session has to exist before its envelopes are accepted.
+#
+# Failure rules: an envelope without a session or events, an unknown session,
+# or a failed write fails as a whole (retried, then dead-lettered). Entries
+# with an unknown type or that fail their schema are left out, all remaining
+# entries are written in one transaction, and the rejected entries are parked
+# in the dead-letter queue as an envelope of their own (see rejected_envelope).
+
+EMPTY_LIST = 'This list may not be empty.'
+NOT_A_DICT = 'Invalid data. Expected a dictionary, but got {type}.'
+
+
+def is_envelope(data):
+    return isinstance(data.get('events'), list)
+
+
+def unpack_envelope(data, default_type, handlers):
+    """
+    Returns ([(index, event_type, entry data)], [(index, errors)]) for the
+    entries of an envelope, with session and client filled in.
+    """
+    session_id = require_session(data)
+    if not data['events']:
+        raise EventValidationError({'events': [EMPTY_LIST]})
+
+    common = {'session': session_id}
+    if 'client' in data:
+        common['client'] = data['client']
+
+    entries, invalid = [], []
+    for index, entry in enumerate(data['events']):
+        if not isinstance(entry, dict):
+            invalid.append((index, {'non_field_errors': [NOT_A_DICT.format(type=type(entry).__name__)]}))
+            continue
+        entry = dict(entry)
+        event_type = entry.pop('type', default_type)
+        if event_type not in handlers or event_type == 'start_session':
+            invalid.append((index, {'type': [INVALID_CHOICE.format(input=event_type)]}))
+            continue
+        entry.update(common)
+        entries.append((index, event_type, entry))
+    return entries, invalid
+
+
+def rejected_envelope(data, invalid):
+    """The envelope's rejected entries with their errors, keyed by original index."""
+    invalid = sorted(invalid, key=lambda item: item[0])
+    rejected = {key: value for key, value in data.items() if key != 'events'}
+    rejected['events'] = [data['events'][index] for index, _ in invalid]
+    rejected['errors'] = {str(index): errors for index, errors in invalid}
+    return rejected
@@ -0,0 +1,187 @@
+import logging
+import uuid
+
+from django.db.models import F
+
+from ..models import Client, Session
+from .EventCodec import decode_event
+from .EventSchemas import EVENT_SCHEMAS, REQUIRED, EventValidationError, FieldError, parse_integer
+from .IngestMetrics import log_event
+from .SessionCache import SessionInfo, session_cache
+
+# queue name suffix -> handler instance, filled by @register_handler
+EVENT_HANDLERS = {}
+
+
+def register_handler(handler_class):
+    EVENT_HANDLERS[handler_class.event_type] = handler_class()
+    return handler_class
+
+
+# namespace of the event ids given to session starts sent without one, so that a
+# redelivered start of the same session is dropped as a duplicate (EventDedup.py)
+SESSION_START_NAMESPACE = uuid.UUID('4f3c1a52-9d0e-4c57-b8f2-6e1d7a0c9b34')
+
+
+def session_start_id(session_id):
+    return str(uuid.uuid5(SESSION_START_NAMESPACE, str(session_id)))
+
+
+def require_id(data, name):
+    """
+    The integer id `name` of an event, parsed before it is looked up so that a
+    malformed one is rejected as invalid instead of failing the lookup.
+    """
+    value = data.get(name)
+    if not value:
+        raise EventValidationError({name: [REQUIRED]})
+    try:
+        return parse_integer(value)
+    except FieldError as e:
+        raise EventValidationError({name: [str(e)]})
+
+
+def require_session(data):
+    return require_id(data, 'session')
+
+
+class EventHandler:
+    """
+    Ingest stages of one event type, run in order by the ingestion step:
+
+    decode(body, ...) -> data   parse the raw message body (JSON or msgpack,
+                                optionally zstd, see services/EventCodec.py)
+    validate(data) -> record    resolve the session and check the event schema;
+                                raises EventValidationError for bad events
+    persist(record, write)      side effects of the event, then write(record)
+                                hands the row to the step's writer or batcher
+
+    validate_async and persist_async are the same stages for the asyncio
+    daemon (ingest_async), doing their I/O through an AsyncEventStore.
+    """
+    event_type = None
+    label = None
+
+    def decode(self, body, content_type=None, content_encoding=None):
+        return decode_event(body, content_type, content_encoding)
+
+    def check(self, data, product_id):
+        data['product'] = product_id
+        return EVENT_SCHEMAS[self.event_type].validate(data)
+
+    def validate(self, data):
+        session_id = require_session(data)
+        try:
+            session_info = session_cache.get(session_id)
+        except Session.DoesNotExist:
+            raise ValueError(f"Session with id '{session_id}' not found.")
+        return self.check(data, session_info.product_id)
+
+    def persist(self, record, write):
+        write(record)
+
+    async def validate_async(self, data, store):
+        session_id = require_session(data)
+        try:
+            session_info = await store.session_info(session_id)
+        except Session.DoesNotExist:
+            raise ValueError(f"Session with id '{session_id}' not found.")
+        return self.check(data, session_info.product_id)
+
+    async def persist_async(self, record, write, store):
+        await write(record)
+
+
+@register_handler
+class StartSessionHandler(EventHandler):
+    event_type = 'start_session'
+    label = 'Start Session Event'
+
+    def validate(self, data):
+        require_session(data)
+        client_obj = Client.objects.select_related('token').get(id=require_id(data, 'client'))
+        record = self.check(data, client_obj.token.Product_id)
+        record['token'] = client_obj.token_id
+        return self.identified(record)
+
+    def identified(self, record):
+        if record['event_id'] is None:
+            record['event_id'] = session_start_id(record['session'])
+        return record
+
+    def persist(self, record, write):
+        # a redelivered or retried start finds its session already there; the
+        # event write then drops the start event as a duplicate and acks it
+        session_obj, created = Session.objects.get_or_create(
+            id=record['session'],
+            defaults={
+                'token_id': record['token'],
+                'client_id': record['client'],
+                'start_time': record['time'],
+                'platform': record['platform'],
+            },
+        )
+        session_cache.put(session_obj.id, SessionInfo(record['client'], record['token'], record['product']))
+        if created:
+            log_event(logging.DEBUG, "session created", session=session_obj.id)
+        write(record)
+
+    async def validate_async(self, data, store):
+        require_session(data)
+        token_id, product_id = await store.client_token(require_id(data, 'client'))
+        record = self.check(data, product_id)
+        record['token'] = token_id
+        return self.identified(record)
+
+    async def persist_async(self, record, write, store):
+        await store.create_session(record)
+        session_cache.put(record['session'], SessionInfo(record['client'], record['token'], record['product']))
+        await write(record)
+
+
+@register_handler
+class EndSessionHandler(EventHandler):
+    event_type = 'end_session'
+    label = 'End Session Event'
+
+    def persist(self, record, write):
+        session_id, end_time = record['session'], record['time']
+        Session.objects.filter(id=session_id).update(end_time=end_time, duration=end_time - F('start_time'))
+        session_cache.invalidate(session_id)
+        log_event(logging.DEBUG, "session ended", session=session_id, end_time=end_time)
+        write(record)
+
+    async def persist_async(self, record, write, store):
+        await store.end_session(record['session'], record['time'])
+        session_cache.invalidate(record['session'])
+        await write(record)
+
+
+@register_handler
+class BussinessEventHandler(EventHandler):
+    event_type = 'business_event'
+    label = 'Bussiness Event'
+
+
+@register_handler
+class ErrorEventHandler(EventHandler):
+    event_type = 'error_event'
+    label = 'Error Event'
+
+
+@register_handler
+class ProgeressionEventHandler(EventHandler):
+    event_type = 'progression_event'
+    label = 'Progeression Event'
+
+
+@register_handler
+class QualityEventHandler(EventHandler):
+    event_type = 'quality_event'
+    label = 'Quality Event'
+
+
+@register_handler
+class ResourceEventHandler(EventHandler):
+    event_type = 'resource_event'
+    label = 'Resource Event'
@@ -0,0 +1,180 @@
+import re
+import uuid
+from datetime import datetime, timezone as dt_timezone
+
+from django.db import models
+from django.utils import timezone
+from django.utils.dateparse import parse_datetime
+
+from .EventWriter import EVENT_MODELS
+
+# Error messages mirror the ones DRF reports, so per-field errors look the same
+# whether an event was rejected here or by the API serializers.
+REQUIRED = 'This field is required.'
+NULL = 'This field may not be null.'
+INVALID_STRING = 'Not a valid string.'
+BLANK = 'This field may not be blank.'
+MAX_LENGTH = 'Ensure this field has no more than {max_length} characters.'
+INVALID_INTEGER = 'A valid integer is required.'
+INVALID_NUMBER = 'A valid number is required.'
+INVALID_DATETIME = 'Datetime has wrong format. Use one of these formats instead: YYYY-MM-DDThh:mm[:ss[.uuuuuu]][+HH:MM|-HH:MM|Z].'
+INVALID_CHOICE = '"{input}" is not a valid choice.'
+INVALID_UUID = 'Must be a valid UUID.'
+
+_decimal_zeros = re.compile(r'\.0*\s*$')
+
+
+class EventValidationError(Exception):
+    def __init__(self, errors):
+        super().__init__(errors)
+        self.errors = errors
+
+
+class FieldError(Exception):
+    pass
+
+
+def parse_integer(value):
+    if isinstance(value, bool):
+        raise FieldError(INVALID_INTEGER)
+    if isinstance(value, int):
+        return value
+    if isinstance(value, float) and value.is_integer():
+        return int(value)
+    if isinstance(value, str) and len(value) <= 1000:
+        try:
+            return int(_decimal_zeros.sub('', value))
+        except ValueError:
+            pass
+    raise FieldError(INVALID_INTEGER)
+
+
+def parse_float(value):
+    if isinstance(value, bool):
+        raise FieldError(INVALID_NUMBER)
+    if isinstance(value, float):
+        return value
+    if isinstance(value, (int, str)):
+        try:
+            return float(value)
+        except (ValueError, OverflowError):
+            pass
+    raise FieldError(INVALID_NUMBER)
+
+
+def parse_time(value):
+    if isinstance(value, datetime):
+        parsed = value
+    elif isinstance(value, str):
+        try:
+            parsed = parse_datetime(value)
+        except ValueError:
+            parsed = None
+    else:
+        parsed = None
+    if parsed is None:
+        raise FieldError(INVALID_DATETIME)
+    if timezone.is_naive(parsed):
+        parsed = timezone.make_aware(parsed, dt_timezone.utc)
+    return parsed
+
+
+def parse_uuid(value):
+    if isinstance(value, uuid.UUID):
+        return str(value)
+    if isinstance(value, str):
+        try:
+            return str(uuid.UUID(value))
+        except ValueError:
+            pass
+    raise FieldError(INVALID_UUID)
+
+
+def string_parser(max_length=None, choices=None):
+    def parse(value):
+        if isinstance(value, bool) or not isinstance(value, (str, int, float)):
+            raise FieldError(INVALID_STRING)
+        value = str(value).strip()
+        if value == '':
+            raise FieldError(BLANK)
+        if choices is not None and value not in choices:
+            raise FieldError(INVALID_CHOICE.format(input=value))
+        if max_length is not None and len(value) > max_length:
+            raise FieldError(MAX_LENGTH.format(max_length=max_length))
+        return value
+    return parse
+
+
+def parser_for_model_field(field):
+    if field.choices:
+        return string_parser(field.max_length, {choice for choice, _ in field.choices})
+    if isinstance(field, (models.IntegerField, models.BigIntegerField)):
+        return parse_integer
+    if isinstance(field, models.FloatField):
+        return parse_float
+    if isinstance(field, models.CharField):
+        return string_parser(field.max_length)
+    if isinstance(field, models.TextField):
+        # TextField.max_length is only a form hint, as with the serializers
+        return string_parser()
+    raise TypeError(f"no ingest parser for {field.__class__.__name__} '{field.name}'")
+
+
+class EventSchema:
+    """
+    Validates a decoded event payload into a plain dict record without touching
+    the ORM. Parsers are resolved once from the subtype model fields, so the
+    per-event cost is one loop over a fixed list of (name, parser) pairs.
+    """
+    common_fields = [
+        ('client', parse_integer),
+        ('session', parse_integer),
+        ('product', parse_integer),
+        ('time', parse_time),
+    ]
+    # client-generated id for deduplicating redelivered events (services/EventDedup.py)
+    optional_fields = [
+        ('event_id', parse_uuid),
+    ]
+
+    def __init__(self, event_type, model, field_names):
+        self.event_type = event_type
+        self.fields = self.common_fields + [
+            (name, parser_for_model_field(model._meta.get_field(name))) for name in field_names
+        ]
+
+    def validate(self, data):
+        if not isinstance(data, dict):
+            raise EventValidationError({'non_field_errors': ['Invalid data. Expected a dictionary.']})
+
+        record = {}
+        errors = {}
+        for name, parse in self.fields:
+            value = data.get(name)
+            if value is None:
+                errors[name] = [REQUIRED if name not in data else NULL]
+                continue
+            try:
+                record[name] = parse(value)
+            except FieldError as e:
+                errors[name] = [str(e)]
+
+        for name, parse in self.optional_fields:
+            value = data.get(name)
+            if value is None:
+                record[name] = None
+                continue
+            try:
+                record[name] = parse(value)
+            except FieldError as e:
+                errors[name] = [str(e)]
+
+        if errors:
+            raise EventValidationError(errors)
+        return record
+
+
+EVENT_SCHEMAS = {
+    event_type: EventSchema(event_type, model, field_names)
+    for event_type, (model, field_names) in EVENT_MODELS.items()
+}
@@ -0,0 +1,125 @@
+from django.db import IntegrityError, connection, transaction
+
+from ..models import SessionStartEvent, SessionEndEvent, BussinessEvent, ErrorEvent, ProgeressionEvent, QualityEvent, ResourceEvent
+from .EventDedup import event_dedup
+from .IdAllocator import event_ids
+
+# queue name suffix -> (subtype model, subtype fields copied from the validated event)
+EVENT_MODELS = {
+    'start_session': (SessionStartEvent, ['platform']),
+    'end_session': (SessionEndEvent, []),
+    'business_event': (BussinessEvent, ['cartType', 'itemType', 'itemId', 'amount', 'currency']),
+    'error_event': (ErrorEvent, ['message', 'severity']),
+    'progression_event': (ProgeressionEvent, ['progressionStatus', 'progression01', 'progression02', 'progression03', 'value']),
+    'quality_event': (QualityEvent, ['FPS', 'memoryUsage']),
+    'resource_event': (ResourceEvent, ['flowType', 'itemType', 'itemId', 'amount', 'resourceCurrency']),
+}
+# gameevent columns repeated in every subtype hypertable (migration 0020)
+TYPED_EVENT_FIELDS = ['game_event', 'time', 'client', 'session', 'product']
+
+
+# partial unique index on gameevent (migration 0018); a unique violation on it
+# means a client event_id was written before
+DEDUP_INDEX = 'gameevent_client_event_id_time_product_id_key'
+ON_DUPLICATE_EVENT = " ON CONFLICT (client_event_id, time, product_id) WHERE client_event_id IS NOT NULL DO NOTHING RETURNING id"
+
+
+def _values(columns, count):
+    row = '(' + ', '.join(['%s'] * columns) + ')'
+    return ', '.join([row] * count)
+
+
+def build_gameevent_insert(rows, ids):
+    params = []
+    for game_event_id, row in zip(ids, rows):
+        params += [game_event_id, row['time'], row['client'], row['session'], row['product'], row.get('event_id')]
+    return (
+        f"INSERT INTO gameevent (id, time, client_id, session_id, product_id, client_event_id) VALUES {_values(6, len(rows))}",
+        params,
+    )
+
+
+def build_subtype_insert(event_type, rows, ids):
+    model, fields = EVENT_MODELS[event_type]
+    quote = connection.ops.quote_name
+
+    params = []
+    for game_event_id, row in zip(ids, rows):
+        params += [game_event_id, row['time'], row['client'], row['session'], row['product']]
+        params += [row[field] for field in fields]
+
+    names = TYPED_EVENT_FIELDS + fields
+    columns = ', '.join(quote(model._meta.get_field(name).column) for name in names)
+    return (
+        f"INSERT INTO {quote(model._meta.db_table)} ({columns}) VALUES {_values(len(names), len(rows))}",
+        params,
+    )
+
+
+def build_insert_statements(event_type, rows, ids):
+    """
+    Returns [(sql, params)] inserting `rows` into gameevent and the subtype
+    table with the given pre-allocated gameevent ids.
+    """
+    return [build_gameevent_insert(rows, ids), build_subtype_insert(event_type, rows, ids)]
+
+
+def is_duplicate_event(error):
+    """True for a unique violation on DEDUP_INDEX (also as named on a hypertable chunk)."""
+    cause = getattr(error, '__cause__', None) or error
+    diag = getattr(cause, 'diag', None)
+    constraint = getattr(diag, 'constraint_name', None) or getattr(cause, 'constraint_name', None) or ''
+    return getattr(cause, 'pgcode', getattr(cause, 'sqlstate', None)) == '23505' and constraint.endswith(DEDUP_INDEX)
+
+
+def kept_ids(ids, inserted):
+    """`ids` with None where the gameevent insert skipped a duplicate."""
+    return [game_event_id if game_event_id in inserted else None for game_event_id in ids]
+
+
+def write_events(event_type, rows):
+    """
+    Persist validated events of one type in a single transaction. Ids come from
+    the in-process allocator, so the gameevent and subtype inserts do not depend
+    on each other and are sent to the database in one round trip. Returns the
+    ids, None for duplicates of earlier events that were left out (see
+    services/EventDedup.py).
+    """
+    if not rows:
+        return []
+
+    ids = event_ids.allocate(len(rows))
+    if event_dedup.suspects(event_type, rows):
+        return write_events_skipping_duplicates(event_type, rows, ids)
+
+    statements = build_insert_statements(event_type, rows, ids)
+    try:
+        with transaction.atomic():
+            with connection.cursor() as cursor:
+                cursor.execute(
+                    ';\n'.join(sql for sql, _ in statements),
+                    [param for _, params in statements for param in params]
+                )
+    except IntegrityError as e:
+        if not is_duplicate_event(e):
+            raise
+        event_dedup.missed(event_type)
+        return write_events_skipping_duplicates(event_type, rows, ids)
+
+    return ids
+
+
+def write_events_skipping_duplicates(event_type, rows, ids):
+    """write_events for batches with possible duplicates: two round trips, duplicates are dropped."""
+    sql, params = build_gameevent_insert(rows, ids)
+    with transaction.atomic():
+        with connection.cursor() as cursor:
+            cursor.execute(sql + ON_DUPLICATE_EVENT, params)
+            inserted = {row[0] for row in cursor.fetchall()}
+            kept = kept_ids(ids, inserted)
+            new = [(game_event_id, row) for game_event_id, row in zip(kept, rows) if game_event_id is not None]
+            if new:
+                cursor.execute(*build_subtype_insert(event_type, [row for _, row in new], [game_event_id for game_event_id, _ in new]))
+
+    event_dedup.confirmed(event_type, len(rows) - len(new))
+    return kept
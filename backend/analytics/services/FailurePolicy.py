@@ -0,0 +1,126 @@
+import logging
+
+from django.conf import settings
+from kombu import Exchange, Queue
+
+from .EventCodec import encode_event
+from .IngestMetrics import log_event
+
+# Failed events are retried through per-queue delay queues: a message waits in
+# <queue>.retry.<attempt> until its TTL expires and RabbitMQ dead-letters it
+# back onto <queue>. After INGEST_MAX_RETRIES attempts, or straight away for
+# events that can never succeed (bad JSON, schema errors), the message is
+# parked in the token's <user>.<token vhost>.dead_letter queue, see the
+# quarantine management command. Delay queues have no x-expires: publishers
+# cache queue declarations, so an expired delay queue would silently swallow
+# retries. RabbitAccountManager.remove_queue deletes them with the event queue.
+
+RETRIES_HEADER = 'x-retries'
+ERROR_HEADER = 'x-error'
+ORIGINAL_QUEUE_HEADER = 'x-original-queue'
+
+
+def token_prefix(queue_name):
+    return '.'.join(queue_name.split('.')[:2])
+
+
+def dead_letter_queue_name(queue_name):
+    return f'{token_prefix(queue_name)}.dead_letter'
+
+
+def dead_letter_queue(queue_name):
+    name = dead_letter_queue_name(queue_name)
+    return Queue(name=name, exchange=Exchange(''), routing_key=name, durable=True)
+
+
+def retry_delay_ms(attempt, base_delay_ms=None):
+    """Delay before retry `attempt` (1-based): base, 2 * base, 4 * base, ..."""
+    base_delay_ms = settings.INGEST_RETRY_BASE_DELAY_MS if base_delay_ms is None else base_delay_ms
+    return base_delay_ms * 2 ** (attempt - 1)
+
+
+def retry_queue(queue_name, attempt, delay_ms):
+    name = f'{queue_name}.retry.{attempt}'
+    return Queue(
+        name=name,
+        exchange=Exchange(''),
+        routing_key=name,
+        durable=True,
+        queue_arguments={
+            'x-message-ttl': delay_ms,
+            'x-dead-letter-exchange': '',
+            'x-dead-letter-routing-key': queue_name,
+        },
+    )
+
+
+class FailurePolicy:
+    """
+    Settles messages whose event could not be persisted: republishes them to a
+    delay queue (transient errors, bounded retries with exponential backoff) or
+    to the token's dead-letter queue, then acks the original delivery.
+    """
+
+    def __init__(self, producer, acks, max_retries=None, base_delay_ms=None):
+        self.producer = producer
+        self.acks = acks
+        self.max_retries = settings.INGEST_MAX_RETRIES if max_retries is None else max_retries
+        self.base_delay_ms = base_delay_ms
+
+    def plan(self, queue_name, headers, error, retry=True):
+        """Returns (target queue, headers) for a failed message from queue_name."""
+        headers = dict(headers or {})
+        headers.pop('x-death', None)
+        attempt = headers.get(RETRIES_HEADER, 0) + 1
+
+        if retry and attempt <= self.max_retries:
+            headers[RETRIES_HEADER] = attempt
+            target = retry_queue(queue_name, attempt, retry_delay_ms(attempt, self.base_delay_ms))
+            log_event(logging.INFO, "retrying", queue=queue_name, attempt=attempt, delay_ms=target.queue_arguments['x-message-ttl'], error=str(error))
+        else:
+            headers[ERROR_HEADER] = str(error)[:1000]
+            headers[ORIGINAL_QUEUE_HEADER] = queue_name
+            target = dead_letter_queue(queue_name)
+            log_event(logging.WARNING, "quarantined", queue=queue_name, dead_letter=target.name, error=str(error)[:200])
+        return target, headers
+
+    def failed(self, message, error, retry=True, queue_name=None):
+        queue_name = queue_name or message.delivery_info['routing_key']
+        target, headers = self.plan(queue_name, message.headers, error, retry)
+
+        try:
+            self.publish(message, target, headers)
+        except Exception as e:
+            log_event(logging.ERROR, "could not republish, requeued", queue=queue_name, error=str(e))
+            self.acks.reject(message, requeue=True)
+            return
+        self.acks.ack(message)
+
+    def quarantine_part(self, message, data, error, queue_name=None):
+        """
+        Parks `data`, the rejected part of `message`, in the dead-letter queue as
+        JSON. The message itself is settled by the caller. `queue_name` is the
+        queue the message came from, by default its routing key.
+        """
+        queue_name = queue_name or message.delivery_info['routing_key']
+        target, headers = self.plan(queue_name, message.headers, error, retry=False)
+        body, content_encoding = encode_event(data)
+        try:
+            self.publish_body(body, 'application/json', content_encoding, target, headers)
+        except Exception as e:
+            log_event(logging.ERROR, "could not quarantine envelope entries", queue=queue_name, error=str(e))
+
+    def publish(self, message, target, headers):
+        self.publish_body(message.body, message.content_type, message.content_encoding, target, headers)
+
+    def publish_body(self, body, content_type, content_encoding, target, headers):
+        self.producer.publish(
+            body,
+            exchange='',
+            routing_key=target.name,
+            declare=[target],
+            headers=headers,
+            content_type=content_type,
+            content_encoding=content_encoding,
+            delivery_mode=2,
+        )
@@ -0,0 +1,40 @@
+from collections import namedtuple
+
+from django.conf import settings
+
+from ..models import Queue, Token
+from .TTLCache import TTLCache
+
+# token, RabbitMQ credentials of the product owner and the token's event queues
+Handshake = namedtuple('Handshake', ['token', 'rb_username', 'rb_password', 'queues'])
+
+
+def load_handshake(token_value):
+    token = Token.objects.select_related('Product__owner').get(value=token_value)
+    owner = token.Product.owner
+    queues = [{"fullname": fullname, "name": name} for fullname, name in Queue.objects.filter(token=token).values_list('fullname', 'name')]
+    return Handshake(token, owner.rb_username, owner.rb_password, queues)
+
+
+class HandshakeCache(TTLCache):
+    """
+    TTLCache keyed by token value holding what TokenView hands to every SDK
+    on startup. Unknown tokens are not cached. GenerateToken and
+    RabbitAccountManager invalidate entries when queues or tokens change, but
+    only in the process that makes the change: the other web workers keep
+    serving the old handshake, including a deleted queue, until their entry
+    is HANDSHAKE_CACHE_TTL seconds old.
+    """
+
+    def invalidate_queue(self, queue_name):
+        """Drops every handshake listing `queue_name`."""
+        with self.lock:
+            stale = [
+                token_value for token_value, (handshake, _) in self.entries.items()
+                if any(queue['fullname'] == queue_name for queue in handshake.queues)
+            ]
+            for token_value in stale:
+                del self.entries[token_value]
+
+
+handshake_cache = HandshakeCache(settings.HANDSHAKE_CACHE_SIZE, settings.HANDSHAKE_CACHE_TTL, loader=load_handshake)
@@ -0,0 +1,76 @@
+import asyncio
+import threading
+
+from django.db import connection
+
+RESERVE_BLOCK_SQL = '''
+    SELECT nextval(%s), increment_by FROM pg_sequences
+    WHERE schemaname = current_schema() AND sequencename = %s
+'''
+
+
+def reserve_block(sequence):
+    """
+    Draws one value from `sequence` and returns (first id, block size). The
+    sequence steps by the block size, so the ids up to the next value are ours.
+    """
+    with connection.cursor() as cursor:
+        cursor.execute(RESERVE_BLOCK_SQL, [sequence, sequence])
+        return cursor.fetchone()
+
+
+class SequenceBlockAllocator:
+    """
+    Hands out 64-bit ids from blocks reserved on a Postgres sequence, so ids can
+    be assigned in the process before the rows are written. Ids are unique but
+    only ordered within a block; ids of a block that is never used up are lost.
+    """
+
+    def __init__(self, sequence, reserve=reserve_block):
+        self.sequence = sequence
+        self.reserve = reserve
+        self.lock = threading.Lock()
+        self.next_id = 0
+        self.block_end = 0
+
+    def allocate(self, count):
+        ids = []
+        with self.lock:
+            while len(ids) < count:
+                if self.next_id >= self.block_end:
+                    start, size = self.reserve(self.sequence)
+                    self.next_id, self.block_end = start, start + size
+                taken = min(count - len(ids), self.block_end - self.next_id)
+                ids.extend(range(self.next_id, self.next_id + taken))
+                self.next_id += taken
+        return ids
+
+    def next(self):
+        return self.allocate(1)[0]
+
+
+class AsyncSequenceBlockAllocator(SequenceBlockAllocator):
+    """SequenceBlockAllocator for asyncio code; `reserve` is a coroutine function."""
+
+    def __init__(self, sequence, reserve):
+        super().__init__(sequence, reserve)
+        self.lock = asyncio.Lock()
+
+    async def allocate(self, count):
+        ids = []
+        async with self.lock:
+            while len(ids) < count:
+                if self.next_id >= self.block_end:
+                    start, size = await self.reserve(self.sequence)
+                    self.next_id, self.block_end = start, start + size
+                taken = min(count - len(ids), self.block_end - self.next_id)
+                ids.extend(range(self.next_id, self.next_id + taken))
+                self.next_id += taken
+        return ids
+
+    async def next(self):
+        return (await self.allocate(1))[0]
+
+
+event_ids = SequenceBlockAllocator('gameevent_id_seq')
+client_ids = SequenceBlockAllocator('analytics_client_id_seq')
@@ -0,0 +1,135 @@
+import logging
+import os
+import random
+import time
+from datetime import datetime, timezone
+
+from django.conf import settings
+from prometheus_client import REGISTRY, CollectorRegistry, Counter, Histogram, start_http_server
+from prometheus_client import multiprocess
+
+# Prometheus instrumentation and logging of the ingest path, shared by the
+# Celery IngestionStep and the asyncio daemon. Product labels come from the
+# queue a message arrived on (received, failed, handler time) or from the
+# validated row (persisted, lag); database writes can mix products, so write
+# time and batch size are labelled by event type only.
+#
+# With PROMETHEUS_MULTIPROC_DIR set (see start.sh) every process writes its
+# samples to that directory and metrics_registry() aggregates all of them, so
+# /api/metrics/ on the ASGI app also reports the worker's ingest metrics.
+
+logger = logging.getLogger('analytics.ingest')
+
+LABELS = ['event_type', 'product']
+
+MESSAGES_RECEIVED = Counter('ingest_messages_received', "AMQP messages received", LABELS)
+EVENTS_PERSISTED = Counter('ingest_events_persisted', "Events written to the database", LABELS)
+EVENTS_FAILED = Counter('ingest_events_failed', "Events not persisted; reason is invalid (quarantined) or error (retried)", LABELS + ['reason'])
+HANDLER_SECONDS = Histogram('ingest_handler_seconds', "Decode, validate and persist time of one message", LABELS)
+WRITE_SECONDS = Histogram('ingest_db_write_seconds', "Duration of one database write", ['event_type'])
+BATCH_SIZE = Histogram(
+    'ingest_batch_size', "Rows per database write", ['event_type'],
+    buckets=(1, 5, 10, 25, 50, 100, 200, 500, 1000, 2500, 5000, 10000),
+)
+EVENT_LAG = Histogram(
+    'ingest_event_lag_seconds', "Persist time minus the event's time field", LABELS,
+    buckets=(0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 300, 900, 3600, 86400),
+)
+DEDUP_CHECKED = Counter('ingest_dedup_checked', "Events with an event_id checked against the dedup filter", ['event_type'])
+DEDUP_SUSPECTED = Counter('ingest_dedup_suspected', "Dedup filter hits (possible duplicates)", ['event_type'])
+DEDUP_MISSED = Counter('ingest_dedup_missed', "Batches with a duplicate the filter missed, caught by the unique index", ['event_type'])
+DEDUP_DUPLICATES = Counter('ingest_dedup_duplicates', "Duplicate events dropped; stage is insert or merge", ['event_type', 'stage'])
+
+_server_started = False
+
+
+def product_label(product_id):
+    return '' if product_id is None else str(product_id)
+
+
+def received(event_type, product_id):
+    MESSAGES_RECEIVED.labels(event_type, product_label(product_id)).inc()
+
+
+def failed(event_type, product_id, reason, count=1):
+    EVENTS_FAILED.labels(event_type, product_label(product_id), reason).inc(count)
+
+
+def handled(event_type, product_id, seconds):
+    HANDLER_SECONDS.labels(event_type, product_label(product_id)).observe(seconds)
+
+
+def written(event_type, rows, seconds):
+    """Records one successful write of `rows` that took `seconds`."""
+    WRITE_SECONDS.labels(event_type).observe(seconds)
+    BATCH_SIZE.labels(event_type).observe(len(rows))
+    now = datetime.now(timezone.utc)
+    persisted = {}
+    for row in rows:
+        product = product_label(row.get('product'))
+        persisted[product] = persisted.get(product, 0) + 1
+        event_time = row.get('time')
+        if isinstance(event_time, datetime):
+            EVENT_LAG.labels(event_type, product).observe(max((now - event_time).total_seconds(), 0))
+    for product, count in persisted.items():
+        EVENTS_PERSISTED.labels(event_type, product).inc(count)
+
+
+def timed_writer(writer):
+    """
+    Wraps an event_writer() so every successful write is recorded. Writers
+    return one id per row, None for duplicates that were dropped.
+    """
+    def write(event_type, rows):
+        started = time.perf_counter()
+        ids = writer(event_type, rows)
+        seconds = time.perf_counter() - started
+        written(event_type, [row for row, game_event_id in zip(rows, ids or rows) if game_event_id is not None], seconds)
+        return ids
+    return write
+
+
+def dedup_checked(event_type, checked, suspected):
+    DEDUP_CHECKED.labels(event_type).inc(checked)
+    if suspected:
+        DEDUP_SUSPECTED.labels(event_type).inc(suspected)
+
+
+def dedup_missed(event_type):
+    DEDUP_MISSED.labels(event_type).inc()
+
+
+def dedup_duplicates(event_type, count, stage):
+    DEDUP_DUPLICATES.labels(event_type, stage).inc(count)
+
+
+def metrics_registry():
+    if 'PROMETHEUS_MULTIPROC_DIR' not in os.environ:
+        return REGISTRY
+    registry = CollectorRegistry()
+    multiprocess.MultiProcessCollector(registry)
+    return registry
+
+
+def start_metrics_server():
+    """Serves /metrics on INGEST_METRICS_PORT (0 = off) once per process."""
+    global _server_started
+    if _server_started or not settings.INGEST_METRICS_PORT:
+        return
+    start_http_server(settings.INGEST_METRICS_PORT, registry=metrics_registry())
+    _server_started = True
+    log_event(logging.INFO, "ingest metrics listening", port=settings.INGEST_METRICS_PORT, sampled=False)
+
+
+def log_event(level, message, sampled=True, **fields):
+    """
+    Structured ingest log line, `message key=value ...`. Nothing is formatted
+    below the logger's level, and INFO and DEBUG lines are kept only for an
+    INGEST_LOG_SAMPLE_RATE fraction of calls unless `sampled` is False, as for
+    rare lines such as queue changes.
+    """
+    if not logger.isEnabledFor(level):
+        return
+    if sampled and level <= logging.INFO and random.random() >= settings.INGEST_LOG_SAMPLE_RATE:
+        return
+    logger.log(level, "%s %s", message, ' '.join(f'{key}={value!r}' for key, value in fields.items()))
@@ -0,0 +1,76 @@
+from collections import namedtuple
+from datetime import timedelta
+
+from django.utils.dateparse import parse_datetime
+from django.utils.timezone import make_aware
+
+from ..models import (
+    ARPPU, AverageFPS, AverageMemoryUsage, AverageSessionDuration, AverageTriesPerLevel, CrashRate, DailyActiveUsers,
+    GameEventHourlyCount, LevelCompletionRate, NetResourceFlow, ResourceSinkRatio, TopErrorTypes, TotalRevenuePerCurrency,
+)
+
+# The hourly continuous aggregates as SSE streams (KPIStreamConsumer). A stream
+# sends the rows of a product from start_time (default: its first bucket) to
+# end_time (default: the latest), each as {"bucket", "product_id", <dimension
+# columns>, <value columns>}, then, unless end_time is in the past, the recent
+# rows again whenever they change. Rows are identified by their bucket and
+# dimensions. Only the last `window` of buckets is polled, as the realtime
+# aggregates no longer change older ones.
+
+KPIStream = namedtuple('KPIStream', 'model values dimensions window')
+RECENT = timedelta(hours=2)
+
+KPI_STREAMS = {
+    'EventCount': KPIStream(GameEventHourlyCount, ('event_count',), (), RECENT),
+    'DailyActiveUsers': KPIStream(DailyActiveUsers, ('active_users',), (), RECENT),
+    'AverageFPS': KPIStream(AverageFPS, ('average_fps',), (), RECENT),
+    'AverageMemoryUsage': KPIStream(AverageMemoryUsage, ('average_memory_usage',), (), RECENT),
+    'AverageSessionDuration': KPIStream(AverageSessionDuration, ('average_session_duration',), (), RECENT),
+    'TotalRevenuePerCurrency': KPIStream(TotalRevenuePerCurrency, ('total_amount',), ('currency',), RECENT),
+    'ARPPU': KPIStream(ARPPU, ('arppu',), (), RECENT),
+    'LevelCompletionRate': KPIStream(LevelCompletionRate, ('completion_rate',), ('progression01',), RECENT),
+    'AverageTriesPerLevel': KPIStream(AverageTriesPerLevel, ('avg_tries',), ('progression01',), RECENT),
+    'NetResourceFlow': KPIStream(NetResourceFlow, ('net_flow',), ('itemType',), RECENT),
+    'ResourceSinkRatio': KPIStream(ResourceSinkRatio, ('sink_ratio',), ('itemType',), RECENT),
+    'CrashRate': KPIStream(CrashRate, ('crash_rate',), (), RECENT),
+    'TopErrorTypes': KPIStream(TopErrorTypes, ('occurrences',), ('message',), RECENT),
+}
+
+
+def row_key(stream):
+    return ('bucket', *stream.dimensions)
+
+
+def _parse(value):
+    if not value:
+        return None
+    parsed = parse_datetime(value)
+    if parsed is None:
+        raise ValueError(f"{value} is not a datetime")
+    return parsed if parsed.tzinfo else make_aware(parsed)
+
+
+def stream_window(start_time, end_time, now):
+    """
+    (start, end, live) for the start_time/end_time query parameters; start and
+    end are None when not given, live tells whether the range reaches `now`.
+    """
+    start, end = _parse(start_time), _parse(end_time)
+    return start, end, end is None or end >= now
+
+
+def kpi_rows(stream, product_id, start=None, end=None):
+    rows = stream.model.objects.filter(product_id=product_id)
+    if start is not None:
+        rows = rows.filter(bucket__gte=start)
+    if end is not None:
+        rows = rows.filter(bucket__lte=end)
+    columns = (*row_key(stream), *stream.values)
+    return [
+        {'bucket': row[0].isoformat(), 'product_id': product_id, **dict(zip(columns[1:], row[1:]))}
+        for row in rows.order_by('bucket').values_list(*columns)
+    ]
+
+
+def recent_rows(stream, product_id, now):
+    return kpi_rows(stream, product_id, now - stream.window)
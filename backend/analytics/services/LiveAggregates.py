@@ -0,0 +1,220 @@
+import asyncio
+import json
+import secrets
+import threading
+import time
+from collections import namedtuple
+from datetime import datetime, timezone
+
+from asgiref.sync import async_to_sync
+from channels.layers import get_channel_layer
+from django.conf import settings
+from django.db import transaction
+from django.db.models import Sum
+
+from ..models import ActiveUserSketch, AverageFPS, AverageMemoryUsage, FPSSketch, GameEventHourlyCount, MemoryUsageSketch, TotalRevenuePerCurrency
+from .ActiveUsers import DistinctSketch, register_rank
+
+# Second-level KPI updates without waiting for a continuous aggregate refresh.
+# The ingestion workers add every persisted event to in-memory partials per
+# KPI, product and bucket (counts and sums, or sketch registers for active
+# users) and every LIVE_KPI_INTERVAL publish what was added since the last
+# time, one message per KPI and product, to the channel layer group
+# live.<kpi>.<product>. LiveKPIConsumer reads the history of the KPI from its
+# aggregate in the same partial form and merges the deltas into it.
+#
+# A delta message covers the events a worker (`source`) persisted between
+# `since` and `until`, and is sent after they were committed. The consumer
+# skips deltas that ended before its last read of the aggregate. A delta that
+# started before the read is partly in the aggregate already, so the consumer
+# reads its buckets again, which by then hold all of it, and counts the later
+# deltas of that worker on top; events another worker commits while the
+# buckets are read can be counted twice until the next full re-read, every
+# LIVE_KPI_RESYNC. Deltas reach the web processes only through a channel
+# layer shared between processes (CHANNEL_LAYER=postgres).
+
+LiveKPI = namedtuple('LiveKPI', 'event_types bucket merge values history point')
+HOUR = 3600
+DAY = 86400
+
+
+def live_group(kpi, product_id):
+    return f"live.{kpi}.{product_id}"
+
+
+def bucket_start(when, seconds):
+    """Start of the `seconds` long bucket of an aware datetime, as time_bucket aligns it."""
+    epoch = int(when.timestamp())
+    return datetime.fromtimestamp(epoch - epoch % seconds, timezone.utc)
+
+
+def merge_partial(partial, delta, merge):
+    """Adds (merge='sum') or maxes (merge='max') the fields of `delta` into `partial`."""
+    for field, value in delta.items():
+        if field not in partial:
+            partial[field] = value
+        elif merge == 'sum':
+            partial[field] += value
+        elif value > partial[field]:
+            partial[field] = value
+    return partial
+
+
+def _by_bucket(rows):
+    """{bucket iso: partial} from (bucket, field, value) rows."""
+    history = {}
+    for bucket, field, value in rows:
+        history.setdefault(bucket.isoformat(), {})[field] = value
+    return history
+
+
+def _average_history(model, column, sketch_model):
+    # the aggregates keep the average only; the event counts come from the quantile sketches
+    def history(product_id, start):
+        counts = dict(
+            sketch_model.objects.filter(product_id=product_id, bucket__gte=start)
+            .values('bucket').annotate(events=Sum('count')).values_list('bucket', 'events')
+        )
+        averages = model.objects.filter(product_id=product_id, bucket__gte=start).values_list('bucket', column)
+        return {
+            bucket.isoformat(): {'sum': average * counts[bucket], 'count': counts[bucket]}
+            for bucket, average in averages if counts.get(bucket)
+        }
+    return history
+
+
+def _active_user_register(client_id):
+    register, rank = register_rank(client_id)
+    return {str(register): rank}
+
+
+def _average_point(name):
+    def point(bucket, partial):
+        return {'bucket': bucket, name: partial['sum'] / partial['count'] if partial.get('count') else None}
+    return point
+
+
+LIVE_KPIS = {
+    'EventCount': LiveKPI(
+        event_types=None,
+        bucket=HOUR,
+        merge='sum',
+        values=lambda row: {'count': 1},
+        history=lambda product_id, start: _by_bucket(
+            (bucket, 'count', count) for bucket, count in
+            GameEventHourlyCount.objects.filter(product_id=product_id, bucket__gte=start).values_list('bucket', 'event_count')
+        ),
+        point=lambda bucket, partial: {'bucket': bucket, 'event_count': partial.get('count', 0)},
+    ),
+    'AverageFPS': LiveKPI(
+        event_types={'quality_event'},
+        bucket=HOUR,
+        merge='sum',
+        values=lambda row: {'sum': row['FPS'], 'count': 1},
+        history=_average_history(AverageFPS, 'average_fps', FPSSketch),
+        point=_average_point('average_fps'),
+    ),
+    'AverageMemoryUsage': LiveKPI(
+        event_types={'quality_event'},
+        bucket=HOUR,
+        merge='sum',
+        values=lambda row: {'sum': row['memoryUsage'], 'count': 1},
+        history=_average_history(AverageMemoryUsage, 'average_memory_usage', MemoryUsageSketch),
+        point=_average_point('average_memory_usage'),
+    ),
+    'TotalRevenuePerCurrency': LiveKPI(
+        event_types={'business_event'},
+        bucket=HOUR,
+        merge='sum',
+        values=lambda row: {row['currency']: row['amount']},
+        history=lambda product_id, start: _by_bucket(
+            TotalRevenuePerCurrency.objects.filter(product_id=product_id, bucket__gte=start).values_list('bucket', 'currency', 'total_amount')
+        ),
+        point=lambda bucket, partial: {'bucket': bucket, 'total_amount': partial},
+    ),
+    'ActiveUsers': LiveKPI(
+        event_types=None,
+        bucket=DAY,
+        merge='max',
+        values=lambda row: _active_user_register(row['client']),
+        history=lambda product_id, start: _by_bucket(
+            (bucket, str(register), rank) for bucket, register, rank in
+            ActiveUserSketch.objects.filter(product_id=product_id, bucket__gte=start).values_list('bucket', 'register', 'rank')
+        ),
+        point=lambda bucket, partial: {'bucket': bucket, 'active_users': round(sketch_of(partial).estimate())},
+    ),
+}
+
+
+def sketch_of(partial):
+    sketch = DistinctSketch()
+    for register, rank in partial.items():
+        sketch.set(int(register), rank)
+    return sketch
+
+
+class LiveAggregator:
+    """
+    Partials of the LIVE_KPIS for the events persisted by this process since
+    the last drain(), keyed by (kpi, product, bucket start).
+    """
+
+    def __init__(self, kpis=None, clock=time.time):
+        self.kpis = LIVE_KPIS if kpis is None else kpis
+        self.clock = clock
+        self.lock = threading.Lock()
+        self.partials = {}
+        self.since = clock()
+        self.source = secrets.token_hex(6)
+
+    def record(self, event_type, rows):
+        with self.lock:
+            for name, kpi in self.kpis.items():
+                if kpi.event_types is not None and event_type not in kpi.event_types:
+                    continue
+                for row in rows:
+                    key = (name, row['product'], bucket_start(row['time'], kpi.bucket))
+                    merge_partial(self.partials.setdefault(key, {}), kpi.values(row), kpi.merge)
+
+    def recorded(self, writer):
+        """
+        Wraps an event_writer() so the rows it keeps are recorded once their
+        transaction commits. Returns `writer` itself while LIVE_KPI_INTERVAL is 0.
+        """
+        if not settings.LIVE_KPI_INTERVAL:
+            return writer
+
+        def write(event_type, rows):
+            ids = writer(event_type, rows)
+            kept = [row for row, game_event_id in zip(rows, ids or rows) if game_event_id is not None]
+            transaction.on_commit(lambda: self.record(event_type, kept))
+            return ids
+        return write
+
+    def drain(self):
+        """[(group, message)] with the coalesced partials since the last drain."""
+        with self.lock:
+            partials, self.partials = self.partials, {}
+            since, until = self.since, self.clock()
+            self.since = until
+        messages = {}
+        for (name, product_id, bucket), delta in partials.items():
+            message = messages.setdefault((name, product_id), {
+                'kpi': name, 'product_id': product_id, 'source': self.source, 'since': since, 'until': until, 'buckets': [],
+            })
+            message['buckets'].append({'bucket': bucket.isoformat(), 'delta': delta})
+        return [(live_group(name, product_id), json.dumps(message)) for (name, product_id), message in messages.items()]
+
+    def flush(self):
+        async_to_sync(self.flush_async)()
+
+    async def flush_async(self):
+        # sent together, so a channel layer that batches can publish them at once
+        channel_layer = get_channel_layer()
+        await asyncio.gather(*(
+            channel_layer.group_send(group, {"type": "send.sse.message", "text": message})
+            for group, message in self.drain()
+        ))
+
+
+live_kpis = LiveAggregator()
@@ -0,0 +1,109 @@
+import math
+
+from django.db import connection
+
+from ..models import FPSSketch, MemoryUsageSketch
+
+# Percentiles of FPS and memory usage from the quantile sketches of migrations
+# 0023/0024. Both aggregates count the quality events per product, hour and
+# logarithmic bin; bin i holds the values in (GAMMA^(i-1), GAMMA^i], and the
+# value reported for it, 2 GAMMA^i / (GAMMA + 1), is within RELATIVE_ACCURACY
+# of each of them. Counts of the same bin add up, so any range of hours is one
+# GROUP BY bin over the aggregate, a few hundred rows per product and hour at
+# most, and never a scan of qualityevent.
+
+RELATIVE_ACCURACY = 0.02
+GAMMA = (1 + RELATIVE_ACCURACY) / (1 - RELATIVE_ACCURACY)
+LOG_GAMMA = math.log(GAMMA)
+MIN_VALUE = 0.01
+QUANTILES = {'p50': 0.5, 'p90': 0.9, 'p95': 0.95, 'p99': 0.99}
+SKETCH_MODELS = {'fps': FPSSketch, 'memory_usage': MemoryUsageSketch}
+STEPS = {'hour': '1 hour', 'day': '1 day'}
+
+
+def bin_index(value):
+    """Bin of `value`, as computed by the sketch aggregates."""
+    return math.ceil(math.log(max(value, MIN_VALUE)) / LOG_GAMMA)
+
+
+def bin_value(index):
+    return 2 * GAMMA ** index / (GAMMA + 1)
+
+
+class QuantileSketch:
+    __slots__ = ('bins', 'count')
+
+    def __init__(self):
+        self.bins = {}
+        self.count = 0
+
+    def add(self, value):
+        self.add_bin(bin_index(value), 1)
+
+    def add_bin(self, index, count):
+        self.bins[index] = self.bins.get(index, 0) + count
+        self.count += count
+
+    def merge(self, other):
+        for index, count in other.bins.items():
+            self.add_bin(index, count)
+        return self
+
+    def quantile(self, q):
+        if not self.count:
+            return None
+        rank = q * (self.count - 1)
+        seen = 0
+        for index in sorted(self.bins):
+            seen += self.bins[index]
+            if seen > rank:
+                return bin_value(index)
+
+    def quantiles(self):
+        """{'p50': ..., 'p99': ...}, all None without values."""
+        return {name: self.quantile(q) for name, q in QUANTILES.items()}
+
+
+def _sketch_table(metric):
+    if metric not in SKETCH_MODELS:
+        raise ValueError(f"metric has to be one of {', '.join(SKETCH_MODELS)}")
+    return SKETCH_MODELS[metric]._meta.db_table
+
+
+def range_sketch(metric, product_id, start, end):
+    """Merged sketch of `metric` for a product over the hours from start to before end."""
+    with connection.cursor() as cursor:
+        cursor.execute(
+            f"""
+            SELECT bin, sum(count) FROM {_sketch_table(metric)}
+            WHERE product_id = %s AND bucket >= %s AND bucket < %s
+            GROUP BY bin
+            """,
+            [product_id, start, end]
+        )
+        sketch = QuantileSketch()
+        for index, count in cursor.fetchall():
+            sketch.add_bin(index, int(count))
+    return sketch
+
+
+def percentile_series(metric, product_id, start, end, step='hour'):
+    """[{'bucket', 'count', 'p50', ..., 'p99'}] per `step` (hour or day) from start to before end."""
+    if step not in STEPS:
+        raise ValueError(f"step has to be one of {', '.join(STEPS)}")
+    with connection.cursor() as cursor:
+        cursor.execute(
+            f"""
+            SELECT time_bucket(%s::interval, bucket) AS step, bin, sum(count) FROM {_sketch_table(metric)}
+            WHERE product_id = %s AND bucket >= %s AND bucket < %s
+            GROUP BY step, bin ORDER BY step
+            """,
+            [STEPS[step], product_id, start, end]
+        )
+        sketches = {}
+        for bucket, index, count in cursor.fetchall():
+            sketches.setdefault(bucket, QuantileSketch()).add_bin(index, int(count))
+    return [
+        {'bucket': bucket.isoformat(), 'count': sketch.count, **sketch.quantiles()}
+        for bucket, sketch in sketches.items()
+    ]
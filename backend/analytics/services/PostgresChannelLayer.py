@@ -0,0 +1,375 @@
+import asyncio
+import hashlib
+import itertools
+import json
+import logging
+import secrets
+import threading
+import time
+import weakref
+
+import asyncpg
+import psycopg2
+from channels.exceptions import ChannelFull
+from channels.layers import BaseChannelLayer
+from django.conf import settings
+
+# Channel layer on the Postgres instance the app already runs, so a group_send
+# from an ingestion worker or any ASGI process reaches the SSE streams held by
+# every other process. Each process LISTENs on one Postgres channel for its own
+# channels and on one per group they are in: the LISTEN is the membership, so
+# nothing about groups is stored. Sends from one event loop issued while a
+# NOTIFY is in flight go out together with the next one, packed per Postgres
+# channel into payloads below the 8000 byte NOTIFY limit; a message too large
+# for a payload on its own is written to channel_layer_message (migration 0025)
+# and only its id is notified.
+#
+# Messages are encoded as JSON, which covers what the consumers send. As with
+# Redis pub/sub, a notification only reaches sessions listening at the time, so
+# a process misses what is sent while it is reconnecting.
+
+logger = logging.getLogger(__name__)
+
+MAX_PAYLOAD = 7900
+# room for the "[<sequence>," that starts every payload
+PAYLOAD_HEADER = 21
+
+
+def pack_payloads(entries, limit=MAX_PAYLOAD):
+    """
+    [(pg channel, [entry, ...])] for the encoded (pg channel, entry) pairs, in
+    order, with the entries of each list taking at most `limit` bytes as a JSON
+    array. Entries that do not fit on their own have to be stored beforehand.
+    """
+    packed = []
+    open_lists = {}
+    for pg_channel, entry in entries:
+        current = open_lists.get(pg_channel)
+        if current is not None and current[1] + len(entry) + 1 > limit:
+            current = None
+        if current is None:
+            current = open_lists[pg_channel] = [[], 1]
+            packed.append((pg_channel, current[0]))
+        current[0].append(entry)
+        current[1] += len(entry) + 1
+    return packed
+
+
+def database_settings():
+    database = settings.DATABASES['default']
+    return {
+        'host': database['HOST'], 'port': database['PORT'] or None, 'user': database['USER'],
+        'password': database['PASSWORD'], 'database': database['NAME'],
+    }
+
+
+class _Outbox:
+    """Entries waiting for the NOTIFY of one event loop."""
+
+    def __init__(self):
+        self.entries = []
+        self.sent = None
+        self.task = None
+
+
+class _Publisher:
+    """NOTIFYs over one psycopg2 connection per process, usable from any thread and event loop."""
+
+    def __init__(self, database, max_payload, expiry):
+        self.database = database
+        self.max_payload = max_payload
+        self.expiry = expiry
+        self.lock = threading.Lock()
+        self.connection = None
+        self.sequence = itertools.count()
+        self.expired_at = 0
+
+    def notify(self, entries):
+        with self.lock:
+            try:
+                self._notify(entries)
+            except (psycopg2.OperationalError, psycopg2.InterfaceError):
+                # the server went away since the last send; retry once on a new connection
+                self.close()
+                self._notify(entries)
+
+    def _notify(self, entries):
+        if self.connection is None or self.connection.closed:
+            database = dict(self.database)
+            self.connection = psycopg2.connect(dbname=database.pop('database'), **database)
+            self.connection.autocommit = True
+        with self.connection.cursor() as cursor:
+            entries = [self._stored(cursor, pg_channel, entry) for pg_channel, entry in entries]
+            channels, payloads = [], []
+            for pg_channel, packed in pack_payloads(entries, self.max_payload - PAYLOAD_HEADER):
+                # the sequence keeps Postgres from folding identical payloads into one notification
+                channels.append(pg_channel)
+                payloads.append(f"[{next(self.sequence)},{','.join(packed)}]")
+            cursor.execute(
+                "SELECT pg_notify(c, p) FROM unnest(%s::text[], %s::text[]) AS n(c, p)",
+                [channels, payloads]
+            )
+
+    def _stored(self, cursor, pg_channel, entry):
+        if len(entry) + 2 <= self.max_payload - PAYLOAD_HEADER:
+            return pg_channel, entry
+        if time.monotonic() - self.expired_at > self.expiry:
+            self.expired_at = time.monotonic()
+            cursor.execute("DELETE FROM channel_layer_message WHERE created < now() - make_interval(secs => %s)", [self.expiry])
+        cursor.execute("INSERT INTO channel_layer_message (payload) VALUES (%s) RETURNING id", [entry])
+        return pg_channel, json.dumps({'r': cursor.fetchone()[0]})
+
+    def close(self):
+        if self.connection is not None:
+            self.connection.close()
+            self.connection = None
+
+
+class PostgresChannelLayer(BaseChannelLayer):
+    """
+    LISTEN/NOTIFY channel layer. Channels are received on the event loop of the
+    process that created them; sends work from any loop, including the short
+    lived ones of async_to_sync. `expiry` is how long large messages are kept.
+    """
+
+    extensions = ['groups', 'flush']
+
+    def __init__(self, database=None, prefix='channels', max_payload=MAX_PAYLOAD, expiry=60, capacity=100, channel_capacity=None):
+        super().__init__(expiry=expiry, capacity=capacity)
+        self.channel_capacity = self.compile_capacities(channel_capacity or {})
+        self.database = database
+        self.prefix = prefix
+        self.max_payload = max_payload
+        self.process = secrets.token_hex(6)
+        self.channels = {}
+        self.groups = {}
+        self._publisher = None
+        self._outboxes = weakref.WeakKeyDictionary()
+        self._listener = None
+        self._lock = None
+        self._loop = None
+        self._inbox = None
+        self._dispatcher = None
+
+    def process_channel(self, process):
+        return f"{self.prefix}.p.{process}"
+
+    def group_channel(self, group):
+        # group names can be longer than the 63 bytes of a Postgres identifier
+        return f"{self.prefix}.g.{hashlib.sha1(group.encode()).hexdigest()}"
+
+    def owner(self, channel):
+        """Process that receives `channel`, from the name new_channel() gave it."""
+        if '!' not in channel:
+            raise ValueError(f"{channel} is not a process specific channel; only those from new_channel() can be used")
+        return self.non_local_name(channel)[:-1].rpartition('.')[2]
+
+    # sending
+
+    async def send(self, channel, message):
+        assert isinstance(message, dict), "message is not a dict"
+        self.valid_channel_name(channel)
+        process = self.owner(channel)
+        if process == self.process:
+            queue = self.channels.get(channel)
+            if queue is None:
+                return
+            if queue.full():
+                raise ChannelFull(channel)
+            queue.put_nowait(message)
+            return
+        await self._publish(self.process_channel(process), {'c': channel, 'm': message})
+
+    async def group_send(self, group, message):
+        assert isinstance(message, dict), "message is not a dict"
+        self.valid_group_name(group)
+        await self._publish(self.group_channel(group), {'g': group, 'm': message})
+
+    async def _publish(self, pg_channel, entry):
+        loop = asyncio.get_running_loop()
+        outbox = self._outboxes.get(loop)
+        if outbox is None:
+            outbox = self._outboxes[loop] = _Outbox()
+        outbox.entries.append((pg_channel, json.dumps(entry, separators=(',', ':'))))
+        if outbox.sent is None:
+            outbox.sent = loop.create_future()
+        sent = outbox.sent
+        if outbox.task is None:
+            outbox.task = loop.create_task(self._send_outbox(outbox))
+        # the NOTIFY is shared with other senders, so a cancelled caller must not cancel it
+        await asyncio.shield(sent)
+
+    async def _send_outbox(self, outbox):
+        loop = asyncio.get_running_loop()
+        if self._publisher is None:
+            self._publisher = _Publisher(self.database or database_settings(), self.max_payload, self.expiry)
+        try:
+            while outbox.entries:
+                entries, sent = outbox.entries, outbox.sent
+                outbox.entries, outbox.sent = [], None
+                try:
+                    await loop.run_in_executor(None, self._publisher.notify, entries)
+                except Exception as error:
+                    sent.set_exception(error)
+                else:
+                    sent.set_result(None)
+        finally:
+            outbox.task = None
+
+    # receiving
+
+    async def new_channel(self, prefix='specific'):
+        await self._listen()
+        channel = f"{prefix}.{self.process}!{secrets.token_hex(8)}"
+        self.channels[channel] = asyncio.Queue(self.get_capacity(channel))
+        return channel
+
+    async def receive(self, channel):
+        self.valid_channel_name(channel)
+        if self.owner(channel) != self.process:
+            raise ValueError(f"{channel} belongs to another process")
+        await self._listen()
+        queue = self.channels.get(channel)
+        if queue is None:
+            queue = self.channels[channel] = asyncio.Queue(self.get_capacity(channel))
+        try:
+            return await queue.get()
+        except asyncio.CancelledError:
+            # consumers stop receiving when they are done; drop what they left behind
+            if queue.empty():
+                self._forget(channel)
+            raise
+
+    def deliver(self, entry):
+        """Puts the message of a notified entry on the queues of the local channels it is for."""
+        if 'g' in entry:
+            channels = self.groups.get(entry['g'], ())
+        else:
+            channels = (entry['c'],)
+        for channel in channels:
+            queue = self.channels.get(channel)
+            if queue is None:
+                continue
+            if queue.full():
+                logger.warning("channel %s is full, dropping a message", channel)
+                continue
+            queue.put_nowait(entry['m'])
+
+    def _forget(self, channel):
+        self.channels.pop(channel, None)
+        for group in [group for group, members in self.groups.items() if channel in members]:
+            asyncio.get_running_loop().create_task(self.group_discard(group, channel))
+
+    async def _listen(self):
+        if self._listener is not None:
+            return
+        loop = asyncio.get_running_loop()
+        if self._loop is None:
+            self._loop = loop
+            self._lock = asyncio.Lock()
+            self._inbox = asyncio.Queue()
+            self._dispatcher = loop.create_task(self._dispatch())
+        elif self._loop is not loop:
+            raise RuntimeError("channels of this layer are received on one event loop only")
+        async with self._lock:
+            if self._listener is None:
+                await self._connect()
+
+    async def _connect(self):
+        database = self.database or database_settings()
+        connection = await asyncpg.connect(**database)
+        connection.add_termination_listener(self._terminated)
+        await connection.add_listener(self.process_channel(self.process), self._notified)
+        for group in list(self.groups):
+            await connection.add_listener(self.group_channel(group), self._notified)
+        self._listener = connection
+
+    def _terminated(self, connection):
+        if connection is self._listener:
+            logger.warning("channel layer lost its listening connection, reconnecting")
+            self._listener = None
+            self._loop.create_task(self._reconnect())
+
+    async def _reconnect(self):
+        delay = 1
+        while self._listener is None and self._loop is not None:
+            try:
+                await self._listen()
+            except (OSError, asyncpg.PostgresError):
+                logger.warning("channel layer could not reconnect, retrying in %ss", delay)
+                await asyncio.sleep(delay)
+                delay = min(delay * 2, 30)
+
+    def _notified(self, connection, pid, pg_channel, payload):
+        self._inbox.put_nowait(payload)
+
+    async def _dispatch(self):
+        # one task, so messages are delivered in the order they were notified
+        while True:
+            payload = await self._inbox.get()
+            try:
+                for entry in json.loads(payload)[1:]:
+                    if 'r' in entry:
+                        entry = await self._fetch(entry['r'])
+                        if entry is None:
+                            continue
+                    self.deliver(entry)
+            except Exception:
+                logger.exception("could not deliver a notification")
+
+    async def _fetch(self, message_id):
+        async with self._lock:
+            if self._listener is None:
+                return None
+            payload = await self._listener.fetchval("SELECT payload FROM channel_layer_message WHERE id = $1", message_id)
+        if payload is None:
+            logger.warning("message %s expired before it was read", message_id)
+            return None
+        return json.loads(payload)
+
+    # groups
+
+    async def group_add(self, group, channel):
+        self.valid_group_name(group)
+        self.valid_channel_name(channel)
+        if self.owner(channel) != self.process:
+            raise ValueError(f"{channel} belongs to another process; only local channels can join groups")
+        await self._listen()
+        first = group not in self.groups
+        self.groups.setdefault(group, set()).add(channel)
+        if first:
+            async with self._lock:
+                if group in self.groups and self._listener is not None:
+                    await self._listener.add_listener(self.group_channel(group), self._notified)
+
+    async def group_discard(self, group, channel):
+        self.valid_group_name(group)
+        self.valid_channel_name(channel)
+        members = self.groups.get(group)
+        if members is None:
+            return
+        members.discard(channel)
+        if members:
+            return
+        del self.groups[group]
+        async with self._lock:
+            if group not in self.groups and self._listener is not None:
+                await self._listener.remove_listener(self.group_channel(group), self._notified)
+
+    # flush extension
+
+    async def flush(self):
+        self.channels.clear()
+        self.groups.clear()
+        await self.close()
+
+    async def close(self):
+        listener, self._listener = self._listener, None
+        if listener is not None:
+            await listener.close()
+        if self._dispatcher is not None:
+            self._dispatcher.cancel()
+        self._loop = self._lock = self._inbox = self._dispatcher = None
+        if self._publisher is not None:
+            with self._publisher.lock:
+                self._publisher.close()
@@ -1,18 +1,57 @@
 from ..models import Queue as db_queue
 from kombu import Consumer, Exchange, Connection
-from kombu import Queue as celery_queue 
+from kombu import Queue as celery_queue
 
 class QueueCollection:
-    
-    def __init__(self):
+
+    def __init__(self, load=True):
         self.queues = []
-        all_db_queues = db_queue.objects.all()
-        for d_queue in all_db_queues:
-            q_name = d_queue.fullname
-            c_queue = celery_queue(name=q_name, exchange=Exchange(''), routing_key=q_name, durable=True)
-            self.queues.append(c_queue)
-            print(f"Queue '{q_name}' declared")
-        
+        self.products = {}  # queue name -> product id, for sharding
+        if load:
+            self.refresh(verbose=True)
+
+    @staticmethod
+    def make_queue(q_name):
+        return celery_queue(name=q_name, exchange=Exchange(''), routing_key=q_name, durable=True)
+
+    def refresh(self, verbose=False):
+        """Reloads the queue list from the Queue table."""
+        queues = []
+        products = {}
+        all_db_queues = db_queue.objects.values_list('fullname', 'token__Product_id')
+        for q_name, product_id in all_db_queues:
+            queues.append(self.make_queue(q_name))
+            products[q_name] = product_id
+            if verbose:
+                print(f"Queue '{q_name}' declared")
+        self.queues = queues
+        self.products = products
+
+    def add(self, q_name, product_id=None):
+        if product_id is not None:
+            self.products[q_name] = product_id
+        if self.get(q_name) is None:
+            self.queues.append(self.make_queue(q_name))
+        return self.get(q_name)
+
+    def remove(self, q_name):
+        self.queues = [queue for queue in self.queues if queue.name != q_name]
+        self.products.pop(q_name, None)
+
+    def product_of(self, q_name):
+        if self.products.get(q_name) is None:
+            # provisioned after the last refresh
+            product_id = db_queue.objects.filter(fullname=q_name).values_list('token__Product_id', flat=True).first()
+            if product_id is not None:
+                self.products[q_name] = product_id
+        return self.products.get(q_name)
+
+    def get(self, q_name):
+        for queue in self.queues:
+            if queue.name == q_name:
+                return queue
+        return None
+
     def get_queues(self, predicate = None):
         result = []
         if(predicate == None):
@@ -22,4 +61,3 @@ class QueueCollection:
                 result.append(queue)
 
         return result
-        
\ No newline at end of file
@@ -0,0 +1,119 @@
+import asyncio
+import json
+import logging
+
+from asgiref.sync import sync_to_async
+
+# Shared polling for the SSE KPI streams of one ASGI process. Streams of the
+# same KPI and product subscribe to the same key; the first subscriber starts
+# one poller for it, which runs the poll every `interval` (the shortest any
+# current subscriber asked for), encodes each update once as an SSE frame and
+# hands the same bytes to every subscriber. The poller stops when the last
+# subscriber leaves, so the query rate depends on the open (KPI, product)
+# pairs, not on the number of viewers.
+
+logger = logging.getLogger(__name__)
+
+MIN_INTERVAL = 1.0
+SUBSCRIBER_BUFFER = 100
+
+
+def sse_frame(payload):
+    return f"data: {json.dumps(payload)}\n\n".encode()
+
+
+class Subscription:
+    """Frames of one key for one stream; iterate it to receive them."""
+
+    def __init__(self, key, interval):
+        self.key = key
+        self.interval = interval
+        self.frames = asyncio.Queue(maxsize=SUBSCRIBER_BUFFER)
+
+    def push(self, frame):
+        # a stream that cannot keep up loses its oldest frames, not the others' updates
+        if self.frames.full():
+            self.frames.get_nowait()
+        self.frames.put_nowait(frame)
+
+    def __aiter__(self):
+        return self
+
+    async def __anext__(self):
+        return await self.frames.get()
+
+
+class _Poller:
+    def __init__(self, poll):
+        self.poll = poll
+        self.subscribers = set()
+        self.task = None
+
+
+class KPIHub:
+    def __init__(self, min_interval=MIN_INTERVAL):
+        self.min_interval = min_interval
+        self.pollers = {}
+        self.polls = 0
+
+    def subscribe(self, key, make_poll, interval):
+        """
+        Subscribes to `key`, starting its poller with make_poll() if nobody
+        else is subscribed. The poll is a synchronous callable (it runs in a
+        thread, so it may use the ORM) returning the payloads to send.
+        """
+        poller = self.pollers.get(key)
+        if poller is None:
+            poller = self.pollers[key] = _Poller(make_poll())
+            poller.task = asyncio.create_task(self._run(key, poller))
+        subscription = Subscription(key, max(interval, self.min_interval))
+        poller.subscribers.add(subscription)
+        return subscription
+
+    def unsubscribe(self, subscription):
+        poller = self.pollers.get(subscription.key)
+        if poller is None:
+            return
+        poller.subscribers.discard(subscription)
+        if not poller.subscribers:
+            poller.task.cancel()
+            del self.pollers[subscription.key]
+
+    async def _run(self, key, poller):
+        while poller.subscribers:
+            await asyncio.sleep(min(subscription.interval for subscription in poller.subscribers))
+            self.polls += 1
+            try:
+                payloads = await sync_to_async(poller.poll)()
+            except Exception:
+                logger.exception("polling %s failed", key)
+                continue
+            for payload in payloads:
+                frame = sse_frame(payload)
+                for subscription in list(poller.subscribers):
+                    subscription.push(frame)
+
+
+class ChangedPoll:
+    """
+    Poll calling fetch() for the recent points of a series and returning those
+    that differ from the same point in the previous fetch. Points are identified
+    by the field `key`, or by a tuple of fields.
+    """
+
+    def __init__(self, fetch, key='bucket'):
+        self.fetch = fetch
+        self.key = (key,) if isinstance(key, str) else tuple(key)
+        self.sent = {}
+
+    def identify(self, point):
+        return tuple(point[field] for field in self.key)
+
+    def __call__(self):
+        points = self.fetch()
+        changed = [point for point in points if self.sent.get(self.identify(point)) != point]
+        self.sent = {self.identify(point): point for point in points}
+        return changed
+
+
+kpi_hub = KPIHub()
@@ -0,0 +1,29 @@
+from collections import namedtuple
+
+from django.conf import settings
+
+from ..models import Session
+from .TTLCache import TTLCache
+
+SessionInfo = namedtuple('SessionInfo', ['client_id', 'token_id', 'product_id'])
+
+
+def load_session_info(session_id):
+    row = Session.objects.filter(id=session_id).values_list('client_id', 'token_id', 'token__Product_id').first()
+    if row is None:
+        raise Session.DoesNotExist(f"Session with id '{session_id}' not found.")
+    return SessionInfo(*row)
+
+
+class SessionCache(TTLCache):
+    """
+    TTLCache mapping a session id to the (client id, token id, product id) of
+    that session. Misses are loaded with a single query; the ingest consumers
+    fill entries when a session starts and invalidate them when it ends.
+    """
+
+    def __init__(self, maxsize, ttl, loader=load_session_info):
+        super().__init__(maxsize, ttl, loader)
+
+
+session_cache = SessionCache(settings.INGEST_SESSION_CACHE_SIZE, settings.INGEST_SESSION_CACHE_TTL)
@@ -0,0 +1,34 @@
+from django.conf import settings
+
+# Product-affinity sharding of the ingestion workers. Every queue belongs to a
+# product (through its token) and each product is owned by exactly one shard,
+# chosen with jump consistent hashing (Lamping & Veach, 2014): going from n to
+# n + 1 shards moves only the ~1/(n + 1) of products that land on the new shard,
+# and nothing moves between the existing ones. Shards are numbered 0..n-1, so
+# workers should be added or removed at the end of the range.
+
+
+def jump_hash(key, buckets):
+    """Maps an integer key to a bucket in [0, buckets)."""
+    key &= 0xFFFFFFFFFFFFFFFF
+    b, j = -1, 0
+    while j < buckets:
+        b = j
+        key = (key * 2862933555777941757 + 1) & 0xFFFFFFFFFFFFFFFF
+        j = int((b + 1) * ((1 << 31) / ((key >> 33) + 1)))
+    return b
+
+
+def shard_for(product_id, shard_count=None):
+    shard_count = settings.INGEST_SHARD_COUNT if shard_count is None else shard_count
+    return jump_hash(product_id, shard_count)
+
+
+def owns(product_id, shard_index=None, shard_count=None):
+    shard_index = settings.INGEST_SHARD_INDEX if shard_index is None else shard_index
+    shard_count = settings.INGEST_SHARD_COUNT if shard_count is None else shard_count
+    if shard_count <= 1:
+        return True
+    if product_id is None:
+        return False
+    return shard_for(product_id, shard_count) == shard_index
@@ -0,0 +1,209 @@
+import io
+import struct
+import uuid
+from datetime import datetime, timezone
+
+from django.conf import settings
+from django.db import connection, models, transaction
+
+from .EventDedup import event_dedup
+from .EventWriter import EVENT_MODELS, write_events
+from .IdAllocator import event_ids
+
+# Optional ingest mode (INGEST_MODE=staging): consumers append events to UNLOGGED
+# staging tables with binary COPY and a scheduled job moves them into gameevent
+# and the subtype tables. Unlogged tables skip WAL, so rows that are staged but
+# not merged yet are lost if Postgres itself crashes; a crashed merge job loses
+# nothing, because a batch is deleted from staging in the same transaction that
+# inserts it into the target tables. The merge drops duplicates of client event
+# ids with ON CONFLICT, so staged rows skip the dedup filter of the direct writer.
+
+COMMON_COLUMNS = [('id', 'bigint'), ('time', 'timestamptz'), ('client_id', 'bigint'), ('session_id', 'bigint'), ('product_id', 'bigint')]
+# added by migration 0018, so it comes after the subtype columns
+EVENT_ID_COLUMN = ('client_event_id', 'uuid')
+
+PG_EPOCH = datetime(2000, 1, 1, tzinfo=timezone.utc)
+COPY_HEADER = b'PGCOPY\n\xff\r\n\x00' + struct.pack('!ii', 0, 0)
+COPY_TRAILER = struct.pack('!h', -1)
+
+
+def staging_table(event_type):
+    return f'ingest_staging_{event_type}'
+
+
+def staging_type(field):
+    if isinstance(field, models.FloatField):
+        return 'double precision'
+    if isinstance(field, models.IntegerField):
+        return 'integer'
+    return 'text'
+
+
+def staging_columns(event_type):
+    model, fields = EVENT_MODELS[event_type]
+    return COMMON_COLUMNS + [(model._meta.get_field(name).column, staging_type(model._meta.get_field(name))) for name in fields] + [EVENT_ID_COLUMN]
+
+
+def _encode_text(value):
+    data = value.encode('utf-8')
+    return struct.pack('!i', len(data)) + data
+
+
+def _encode_timestamptz(value):
+    delta = value - PG_EPOCH
+    return struct.pack('!iq', 8, (delta.days * 86400 + delta.seconds) * 1_000_000 + delta.microseconds)
+
+
+BINARY_ENCODERS = {
+    'bigint': lambda value: struct.pack('!iq', 8, value),
+    'integer': lambda value: struct.pack('!ii', 4, value),
+    'double precision': lambda value: struct.pack('!id', 8, value),
+    'text': _encode_text,
+    'timestamptz': _encode_timestamptz,
+    'uuid': lambda value: struct.pack('!i', 16) + uuid.UUID(value).bytes,
+}
+NULL = struct.pack('!i', -1)
+
+
+def encode_copy_binary(column_types, rows):
+    """Encodes rows (sequences matching column_types) in Postgres binary COPY format."""
+    encoders = [BINARY_ENCODERS[column_type] for column_type in column_types]
+    tuple_header = struct.pack('!h', len(encoders))
+    buffer = io.BytesIO()
+    buffer.write(COPY_HEADER)
+    for row in rows:
+        buffer.write(tuple_header)
+        for encode, value in zip(encoders, row):
+            buffer.write(NULL if value is None else encode(value))
+    buffer.write(COPY_TRAILER)
+    buffer.seek(0)
+    return buffer
+
+
+def write_staged_events(event_type, rows):
+    if not rows:
+        return []
+
+    _, fields = EVENT_MODELS[event_type]
+    columns = staging_columns(event_type)
+    ids = event_ids.allocate(len(rows))
+    copy_rows = (
+        [game_event_id, row['time'], row['client'], row['session'], row['product']] + [row[field] for field in fields] + [row.get('event_id')]
+        for game_event_id, row in zip(ids, rows)
+    )
+    data = encode_copy_binary([column_type for _, column_type in columns], copy_rows)
+    column_list = ', '.join(connection.ops.quote_name(name) for name, _ in columns)
+
+    with connection.cursor() as cursor:
+        cursor.copy_expert(f"COPY {staging_table(event_type)} ({column_list}) FROM STDIN WITH (FORMAT binary)", data)
+
+    return ids
+
+
+def event_writer():
+    return write_staged_events if settings.INGEST_MODE == 'staging' else write_events
+
+
+def merge_staged_events(event_type, batch_size):
+    """
+    Moves up to batch_size of the oldest staged rows of one event type into
+    gameevent and its subtype table, sorted by time, in one transaction, and
+    records the merge in ingest_merge_watermark. Returns the number of rows.
+
+    Rows are claimed by deleting them (FOR UPDATE SKIP LOCKED) rather than by
+    comparing against the watermark: seq values are drawn at insert time, so a
+    lower seq can still commit after a higher one has been merged.
+    """
+    table = staging_table(event_type)
+    batch = f'merge_batch_{event_type}'
+    model, fields = EVENT_MODELS[event_type]
+    quote = connection.ops.quote_name
+    subtype_columns = ''.join(', ' + quote(model._meta.get_field(name).column) for name in fields)
+
+    with transaction.atomic():
+        with connection.cursor() as cursor:
+            cursor.execute(f"CREATE TEMPORARY TABLE IF NOT EXISTS {batch} (LIKE {table}) ON COMMIT DELETE ROWS")
+            cursor.execute(f"TRUNCATE {batch}")
+            cursor.execute(
+                f'''
+                WITH claimed AS (
+                    DELETE FROM {table} WHERE seq IN (
+                        SELECT seq FROM {table} ORDER BY seq LIMIT %s FOR UPDATE SKIP LOCKED
+                    ) RETURNING *
+                )
+                INSERT INTO {batch} SELECT * FROM claimed
+                ''',
+                [batch_size]
+            )
+            merged = cursor.rowcount
+            if not merged:
+                return 0
+
+            cursor.execute(
+                f'''
+                WITH inserted AS (
+                    INSERT INTO gameevent (id, time, client_id, session_id, product_id, client_event_id)
+                    SELECT id, time, client_id, session_id, product_id, client_event_id FROM {batch} ORDER BY time
+                    ON CONFLICT (client_event_id, time, product_id) WHERE client_event_id IS NOT NULL DO NOTHING
+                    RETURNING id
+                )
+                INSERT INTO {quote(model._meta.db_table)} (game_event, time, client_id, session_id, product_id{subtype_columns})
+                SELECT id, time, client_id, session_id, product_id{subtype_columns} FROM {batch} JOIN inserted USING (id) ORDER BY time
+                '''
+            )
+            duplicates = merged - cursor.rowcount
+            cursor.execute(
+                f'''
+                INSERT INTO ingest_merge_watermark (staging_table, last_seq, merged_rows, merged_at)
+                SELECT %s, max(seq), count(*), now() FROM {batch}
+                ON CONFLICT (staging_table) DO UPDATE SET
+                    last_seq = GREATEST(ingest_merge_watermark.last_seq, EXCLUDED.last_seq),
+                    merged_rows = ingest_merge_watermark.merged_rows + EXCLUDED.merged_rows,
+                    merged_at = EXCLUDED.merged_at
+                ''',
+                [table]
+            )
+    event_dedup.confirmed(event_type, duplicates, stage='merge')
+    return merged
+
+
+def merge_all_staged_events(batch_size=None, max_batches=None):
+    """Merges every event type until its staging table is drained (or max_batches per type)."""
+    batch_size = batch_size or settings.INGEST_STAGING_MERGE_BATCH
+    totals = {}
+    for event_type in EVENT_MODELS:
+        total = batches = 0
+        while max_batches is None or batches < max_batches:
+            merged = merge_staged_events(event_type, batch_size)
+            total += merged
+            batches += 1
+            if merged < batch_size:
+                break
+        totals[event_type] = total
+    return totals
+
+
+def staging_backlog():
+    """Per event type: staged rows, oldest staged event time, last merged seq, rows merged so far."""
+    backlog = {}
+    with connection.cursor() as cursor:
+        for event_type in EVENT_MODELS:
+            table = staging_table(event_type)
+            cursor.execute(
+                f'''
+                SELECT (SELECT count(*) FROM {table}), (SELECT min(time) FROM {table}),
+                       w.last_seq, w.merged_rows, w.merged_at
+                FROM (SELECT 1) one
+                LEFT JOIN ingest_merge_watermark w ON w.staging_table = %s
+                ''',
+                [table]
+            )
+            rows, oldest, last_seq, merged_rows, merged_at = cursor.fetchone()
+            backlog[event_type] = {
+                'rows': rows,
+                'oldest_event_time': oldest,
+                'last_merged_seq': last_seq,
+                'merged_rows': merged_rows or 0,
+                'last_merged_at': merged_at,
+            }
+    return backlog
@@ -0,0 +1,171 @@
+import json
+import time
+
+from django.conf import settings
+from django.db import DatabaseError, connection
+
+from ..models import Product
+from .EventWriter import EVENT_MODELS
+
+# Compression and retention of the raw event hypertables (migration 0021).
+# Timescale's retention policy drops whole chunks and a chunk holds events of
+# many products, so chunks are only dropped past the longest retention of any
+# product; the analytics_delete_expired_events job deletes the rows of products
+# with a shorter one. The continuous aggregates re-read the last
+# AGGREGATE_REFRESH_DAYS on every refresh and keep everything older, so raw
+# events may go once they are past that window.
+
+AGGREGATE_REFRESH_DAYS = 7
+RETENTION_JOB = 'analytics_delete_expired_events'
+RETENTION_JOB_INTERVAL = '1 day'
+
+
+def event_hypertables():
+    return ['gameevent'] + [model._meta.db_table for model, _ in EVENT_MODELS.values()]
+
+
+def product_retention_days(default_days):
+    """Retention in days of every product, None for products that keep their events."""
+    return [days or default_days or None for days in Product.objects.values_list('event_retention_days', flat=True)]
+
+
+def chunk_retention_days(retention_days):
+    """Age after which whole chunks can be dropped, None while any product keeps its events."""
+    if not retention_days or None in retention_days:
+        return None
+    return max(retention_days)
+
+
+def validate_retention_days(days):
+    if days and days <= AGGREGATE_REFRESH_DAYS:
+        raise ValueError(f"raw events have to be kept for more than {AGGREGATE_REFRESH_DAYS} days, the continuous aggregates re-read them")
+
+
+def apply_policies(compress_after_days=None, default_retention_days=None):
+    """
+    (Re)creates the compression and chunk retention policies of every event
+    hypertable and the per-product retention job. Returns what was applied.
+    """
+    compress_after_days = settings.EVENT_COMPRESS_AFTER_DAYS if compress_after_days is None else compress_after_days
+    default_retention_days = settings.EVENT_RETENTION_DAYS if default_retention_days is None else default_retention_days
+    if compress_after_days < 1:
+        raise ValueError("chunks can be compressed after 1 day at the earliest")
+    validate_retention_days(default_retention_days)
+
+    hypertables = event_hypertables()
+    chunk_days = chunk_retention_days(product_retention_days(default_retention_days))
+    with connection.cursor() as cursor:
+        for table in hypertables:
+            cursor.execute("SELECT remove_compression_policy(%s, if_exists => true)", [table])
+            cursor.execute("SELECT add_compression_policy(%s, compress_after => make_interval(days => %s))", [table, compress_after_days])
+            cursor.execute("SELECT remove_retention_policy(%s, if_exists => true)", [table])
+            if chunk_days:
+                cursor.execute("SELECT add_retention_policy(%s, drop_after => make_interval(days => %s))", [table, chunk_days])
+        cursor.execute("SELECT delete_job(job_id) FROM timescaledb_information.jobs WHERE proc_name = %s", [RETENTION_JOB])
+        cursor.execute(
+            "SELECT add_job(%s, %s::interval, config => %s::jsonb)",
+            [RETENTION_JOB, RETENTION_JOB_INTERVAL, json.dumps({'hypertables': hypertables, 'default_days': default_retention_days})]
+        )
+    return {
+        'compress_after_days': compress_after_days,
+        'default_retention_days': default_retention_days,
+        'chunk_retention_days': chunk_days,
+    }
+
+
+def set_product_retention(product_id, days):
+    """Sets (None: clears) a product's raw event retention and re-applies the policies."""
+    validate_retention_days(days)
+    if not Product.objects.filter(id=product_id).update(event_retention_days=days):
+        raise Product.DoesNotExist(f"no product {product_id}")
+    return apply_policies()
+
+
+def policy_report():
+    """Per event hypertable: chunk counts, sizes, compression ratio and policies."""
+    report = {}
+    with connection.cursor() as cursor:
+        for table in event_hypertables():
+            cursor.execute(
+                """
+                SELECT count(*), count(*) FILTER (WHERE is_compressed), min(range_start), max(range_end)
+                FROM timescaledb_information.chunks WHERE hypertable_name = %s
+                """,
+                [table]
+            )
+            chunks, compressed, oldest, newest = cursor.fetchone()
+            cursor.execute(
+                "SELECT hypertable_size(%s), sum(before_compression_total_bytes), sum(after_compression_total_bytes) FROM hypertable_compression_stats(%s)",
+                [table, table]
+            )
+            size, before, after = cursor.fetchone()
+            cursor.execute(
+                "SELECT proc_name, schedule_interval, config FROM timescaledb_information.jobs WHERE hypertable_name = %s ORDER BY proc_name",
+                [table]
+            )
+            report[table] = {
+                'chunks': chunks,
+                'compressed_chunks': compressed,
+                'oldest_chunk': oldest,
+                'newest_chunk': newest,
+                'total_bytes': size,
+                'compression_ratio': before / after if after else None,
+                'policies': cursor.fetchall(),
+            }
+    return report
+
+
+def retention_job():
+    """(schedule interval, config, last run status, last run time) of the per-product retention job."""
+    with connection.cursor() as cursor:
+        cursor.execute(
+            """
+            SELECT j.schedule_interval, j.config, s.last_run_status, s.last_run_started_at
+            FROM timescaledb_information.jobs j
+            LEFT JOIN timescaledb_information.job_stats s ON s.job_id = j.job_id
+            WHERE j.proc_name = %s
+            """,
+            [RETENTION_JOB]
+        )
+        return cursor.fetchone()
+
+
+def verify_refresh_policies(compress_first=True):
+    """
+    Runs every continuous aggregate refresh job now, after running the
+    compression jobs (compress_first), and returns per aggregate its source
+    hypertable, how many of its chunks are compressed, the run time and the
+    error, if any.
+    """
+    results = []
+    with connection.cursor() as cursor:
+        if compress_first:
+            cursor.execute("SELECT job_id FROM timescaledb_information.jobs WHERE proc_name = 'policy_compression'")
+            for (job_id,) in cursor.fetchall():
+                cursor.execute("CALL run_job(%s)", [job_id])
+        cursor.execute(
+            """
+            SELECT j.job_id, a.view_name, a.hypertable_name,
+                   (SELECT count(*) FROM timescaledb_information.chunks c
+                    WHERE c.hypertable_name = a.hypertable_name AND c.is_compressed)
+            FROM timescaledb_information.jobs j
+            JOIN timescaledb_information.continuous_aggregates a ON a.materialization_hypertable_name = j.hypertable_name
+            WHERE j.proc_name = 'policy_refresh_continuous_aggregate'
+            ORDER BY a.view_name
+            """
+        )
+        for job_id, view, hypertable, compressed in cursor.fetchall():
+            started = time.perf_counter()
+            try:
+                cursor.execute("CALL run_job(%s)", [job_id])
+                error = None
+            except DatabaseError as e:
+                error = str(e).strip()
+            results.append({
+                'aggregate': view,
+                'hypertable': hypertable,
+                'compressed_chunks': compressed,
+                'seconds': time.perf_counter() - started,
+                'error': error,
+            })
+    return results
@@ -12,7 +12,6 @@ def generate_secure_password(length=12):
 
 def send_update_to_group(message, group):
     channel_layer = get_channel_layer()
-    print(channel_layer)
     async_to_sync(channel_layer.group_send)(
     group,
     {
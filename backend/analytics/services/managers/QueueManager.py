@@ -2,6 +2,7 @@ from ..queue_type import queue_type
 import requests
 from requests.auth import HTTPBasicAuth
 from ..Utilities import generate_secure_password, secure_hash_base64
+from ..HandshakeCache import handshake_cache
 from backend.celery import add_queue, delete_queue
 from django.conf import settings 
 
@@ -129,7 +130,7 @@ class RabbitAccountManager:
             raise ValueError("Unexpected response")
 
     @staticmethod
-    def add_queue(username, VHOST, queue_name: str, queue_type: queue_type):
+    def add_queue(username, VHOST, queue_name: str, queue_type: queue_type, product_id=None):
         queue_name = f"{username}.{VHOST}.{queue_name}.{queue_type.name}"  
         #queue_name = secure_hash_base64(queue_name)
         print(f"{settings.RABBITMQ_API_URL}/queues/{settings.RABBITMQ_VHOST}/{queue_name}")
@@ -146,7 +147,7 @@ class RabbitAccountManager:
         if create_queue_response.status_code == 201 or create_queue_response.status_code == 204:
             print(f"Queue '{queue_name}' created successfully.")
             print("firing add queue task")
-            add_queue.delay(queue_name)
+            add_queue.delay(queue_name, product_id)
             return queue_name
         elif create_queue_response.status_code == 400:
             print(f"Bad request while creating queue: {create_queue_response.text}")
@@ -166,6 +167,13 @@ class RabbitAccountManager:
 
         if delete_response.status_code in [204, 200]:
             print(f"Queue '{full_queue_name}' deleted successfully from vhost '{VHOST}'.")
+            for attempt in range(1, settings.INGEST_MAX_RETRIES + 1):
+                requests.delete(
+                    f"{settings.RABBITMQ_API_URL}/queues/{VHOST}/{full_queue_name}.retry.{attempt}",
+                    auth=HTTPBasicAuth(settings.ADMIN_USER, settings.ADMIN_PASS),
+                    timeout=10
+                )
+            handshake_cache.invalidate_queue(full_queue_name)
             print("firing delete queue task")
             delete_queue.delay(queue_name)
         elif delete_response.status_code == 404:
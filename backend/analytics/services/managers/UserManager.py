@@ -2,6 +2,7 @@ from .QueueManager import RabbitAccountManager
 from ..queue_type import queue_type
 from ...models import CustomUser, Token, Queue
 from ..Utilities import generate_secure_password
+from ..HandshakeCache import handshake_cache
 
 def GenerateToken(token_name, username, product, queues):
     token_vhost = RabbitAccountManager.create_vhost(f"{username}_{token_name}")
@@ -16,7 +17,7 @@ def GenerateToken(token_name, username, product, queues):
 
     queue_fullnames = []
     for queue in queues:
-        fullname = RabbitAccountManager.add_queue(username, token_vhost, queue["queue_name"], queue_type[queue["queue_type"]])
+        fullname = RabbitAccountManager.add_queue(username, token_vhost, queue["queue_name"], queue_type[queue["queue_type"]], product.id)
         q = Queue.objects.create(
             fullname=fullname,
             name=queue["queue_name"],
@@ -27,6 +28,8 @@ def GenerateToken(token_name, username, product, queues):
         q.save()
         queue_fullnames.append(fullname)
 
+    # a handshake during the loop above may have cached a partial queue list
+    handshake_cache.invalidate(token.value)
     return token
 
 
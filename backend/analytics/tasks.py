@@ -1,4 +1,15 @@
 # app_name/tasks.py
 
+import logging
+
 from celery import shared_task
 
+from analytics.services.IngestMetrics import log_event
+from analytics.services.StagingWriter import merge_all_staged_events
+
+
+@shared_task(ignore_result=True)
+def merge_staging(max_batches=50):
+    merged = merge_all_staged_events(max_batches=max_batches)
+    if any(merged.values()):
+        log_event(logging.INFO, "merged staged events", merged=merged)
@@ -1,3 +1,1209 @@
-from django.test import TestCase
+import asyncio
+import json
+import logging
+import random
+import struct
+import time
+from collections import Counter
+from unittest import mock
+from datetime import date, datetime, timedelta, timezone
+
+from asgiref.testing import ApplicationCommunicator
+from channels.exceptions import ChannelFull
+from django.test import SimpleTestCase, override_settings
+from django.utils.timezone import make_aware
+from prometheus_client import REGISTRY
+from rest_framework.test import APIRequestFactory, force_authenticate
+
+from analytics.celery_consumers import IngestionStep
+from analytics.consumers import HubStreamConsumer, KPIStreamConsumer, LiveKPIConsumer
+from analytics.services.ActiveUsers import REGISTERS, DistinctSketch, register_rank, rolling_active_users
+from analytics.services.AsyncIngest import AsyncEventStore, AsyncIngestor, dollar_params
+from analytics.services.ChannelAcks import ChannelAcks
+from analytics.services.ChunkTuning import TableProfile, nice_interval, recommend_chunk_interval, recommend_partitions
+from analytics.services.EventBatcher import EventBatcher
+from analytics.services.EventDedup import EventDeduplicator, RotatingBloomFilter
+from analytics.services.EventWriter import build_subtype_insert, is_duplicate_event
+from analytics.services.EventCodec import DecodeError, decode_event, encode_event
+from analytics.migrations._continuous_aggregates import aggregate_definitions
+from analytics.routing import sse_urlpatterns
+from analytics.views import PercentilesView, TokenView, parse_moment
+from analytics.models import Client, Session, Token
+from analytics.services.EventHandlers import EVENT_HANDLERS, EventHandler
+from analytics.services.EventSchemas import EVENT_SCHEMAS, EventValidationError
+from analytics.services.FailurePolicy import FailurePolicy, retry_delay_ms
+from analytics.services.LiveAggregates import LIVE_KPIS, LiveAggregator, bucket_start, merge_partial
+from analytics.services.Percentiles import MIN_VALUE, RELATIVE_ACCURACY, QuantileSketch, bin_index
+from analytics.services.PostgresChannelLayer import PostgresChannelLayer, pack_payloads
+from analytics.services.QueueCollection import QueueCollection
+from analytics.services import IngestMetrics
+from analytics.services.HandshakeCache import Handshake, HandshakeCache
+from analytics.services.KPIStreams import KPI_STREAMS, row_key, stream_window
+from analytics.services.IdAllocator import AsyncSequenceBlockAllocator, SequenceBlockAllocator
+from analytics.services.SessionCache import SessionCache, SessionInfo
+from analytics.services.Sharding import jump_hash, owns
+from analytics.services.SSEHub import ChangedPoll, KPIHub, kpi_hub, sse_frame
+from analytics.services.StagingWriter import encode_copy_binary, staging_columns
+from analytics.services.TimescalePolicies import chunk_retention_days, event_hypertables, validate_retention_days
+
+
+class FakeMessage:
+    def __init__(self, delivery_tag, routing_key=None, headers=None):
+        self.delivery_tag = delivery_tag
+        self.delivery_info = {'routing_key': routing_key}
+        self.headers = headers or {}
+        self.body = b'{}'
+        self.content_type = 'application/json'
+        self.content_encoding = 'utf-8'
+        self.state = None
+
+    def ack(self, multiple=False):
+        self.state = 'ACK_MULTIPLE' if multiple else 'ACK'
+
+    def reject(self, requeue=False):
+        self.state = 'REQUEUE' if requeue else 'REJECT'
+
+
+IN_MEMORY_LAYER = {"default": {"BACKEND": "channels.layers.InMemoryChannelLayer"}}
+
+
+def sse_scope(path, query=b'', **route):
+    return {
+        'type': 'http', 'http_version': '1.1', 'method': 'GET', 'path': path, 'query_string': query,
+        'headers': [], 'url_route': {'args': (), 'kwargs': route},
+    }
+
+
+async def open_stream(app, scope):
+    """Sends the request and returns (communicator, status) once the headers are in."""
+    communicator = ApplicationCommunicator(app, scope)
+    await communicator.send_input({'type': 'http.request', 'body': b''})
+    start = await communicator.receive_output(2)
+    return communicator, start['status']
+
+
+async def next_frame(communicator):
+    message = await communicator.receive_output(2)
+    return json.loads(message['body'].decode()[len('data: '):])
+
+
+async def close_stream(communicator):
+    await communicator.send_input({'type': 'http.disconnect'})
+    await communicator.wait(2)
+
+
+class CountingStreamConsumer(HubStreamConsumer):
+    async def handle(self, body):
+        await self.send_headers(headers=[(b"Content-Type", b"text/event-stream")])
+        await self.send_body(sse_frame([]), more_body=True)
+        values = iter(range(100))
+        await self.stream_from_hub(('Counting', 1), lambda: lambda: [{'value': next(values)}], 0.01)
+
+
+class EventBatcherTests(SimpleTestCase):
+    def setUp(self):
+        self.written = []
+
+    def writer(self, event_type, rows):
+        self.written.append((event_type, list(rows)))
+
+    def test_flushes_when_size_reached(self):
+        batcher = EventBatcher('quality_event', size=3, interval_ms=60_000, writer=self.writer)
+        messages = [FakeMessage(tag) for tag in range(3)]
+        for i, message in enumerate(messages):
+            batcher.add({'n': i}, message)
+
+        self.assertEqual(self.written, [('quality_event', [{'n': 0}, {'n': 1}, {'n': 2}])])
+        self.assertEqual([m.state for m in messages], [None, None, 'ACK_MULTIPLE'])
+        self.assertEqual(batcher.pending, [])
+
+    def test_flush_due_waits_for_interval(self):
+        batcher = EventBatcher('quality_event', size=100, interval_ms=0, writer=self.writer)
+        batcher.flush_due()
+        self.assertEqual(self.written, [])
+
+        batcher.add({'n': 0}, FakeMessage(0))
+        batcher.flush_due()
+        self.assertEqual(len(self.written), 1)
+
+        batcher.interval = 60
+        batcher.add({'n': 1}, FakeMessage(1))
+        batcher.flush_due()
+        self.assertEqual(len(self.written), 1)
+
+    def test_failed_batch_is_retried_one_by_one(self):
+        def writer(event_type, rows):
+            if any(row.get('bad') for row in rows):
+                raise ValueError('bad row')
+            self.written.append(rows)
+
+        batcher = EventBatcher('quality_event', size=3, interval_ms=60_000, writer=writer)
+        messages = [FakeMessage(tag) for tag in range(3)]
+        batcher.add({'n': 0}, messages[0])
+        batcher.add({'bad': True}, messages[1])
+        batcher.add({'n': 2}, messages[2])
+
+        self.assertEqual(self.written, [[{'n': 0}], [{'n': 2}]])
+        self.assertEqual([m.state for m in messages], ['ACK', 'REJECT', 'ACK'])
+
+
+class SessionCacheTests(SimpleTestCase):
+    def setUp(self):
+        self.loads = []
+
+    def loader(self, session_id):
+        self.loads.append(session_id)
+        return SessionInfo(session_id * 10, session_id * 100, session_id * 1000)
+
+    def test_miss_then_hit(self):
+        cache = SessionCache(maxsize=10, ttl=60, loader=self.loader)
+        self.assertEqual(cache.get(1), SessionInfo(10, 100, 1000))
+        self.assertEqual(cache.get(1), SessionInfo(10, 100, 1000))
+        self.assertEqual(self.loads, [1])
+        self.assertEqual(cache.stats()['hits'], 1)
+        self.assertEqual(cache.stats()['misses'], 1)
+
+    def test_put_avoids_lookup_and_invalidate_forces_one(self):
+        cache = SessionCache(maxsize=10, ttl=60, loader=self.loader)
+        cache.put(7, SessionInfo(1, 2, 3))
+        self.assertEqual(cache.get(7), SessionInfo(1, 2, 3))
+        cache.invalidate(7)
+        self.assertEqual(cache.get(7), SessionInfo(70, 700, 7000))
+        self.assertEqual(self.loads, [7])
+
+    def test_expired_entries_are_reloaded(self):
+        cache = SessionCache(maxsize=10, ttl=0, loader=self.loader)
+        cache.get(1)
+        cache.get(1)
+        self.assertEqual(self.loads, [1, 1])
+
+    def test_least_recently_used_entry_is_evicted(self):
+        cache = SessionCache(maxsize=2, ttl=60, loader=self.loader)
+        cache.get(1)
+        cache.get(2)
+        cache.get(1)
+        cache.get(3)
+        self.assertEqual(list(cache.entries), [1, 3])
+
+
+class EventSchemaTests(SimpleTestCase):
+    def payload(self, **extra):
+        data = {'client': 3, 'session': '12', 'product': 5, 'time': '2025-06-01T10:00:00Z'}
+        data.update(extra)
+        return data
+
+    def test_valid_event_becomes_plain_record(self):
+        record = EVENT_SCHEMAS['quality_event'].validate(self.payload(FPS='59.5', memoryUsage=512))
+        self.assertEqual(record['session'], 12)
+        self.assertEqual(record['FPS'], 59.5)
+        self.assertEqual(record['memoryUsage'], 512.0)
+        self.assertEqual(record['time'].isoformat(), '2025-06-01T10:00:00+00:00')
+
+    def test_errors_are_reported_per_field(self):
+        with self.assertRaises(EventValidationError) as ctx:
+            EVENT_SCHEMAS['business_event'].validate(self.payload(
+                time='yesterday', cartType='', itemType='gems', itemId=None, amount='ten', currency='USD'))
+        errors = ctx.exception.errors
+        self.assertEqual(set(errors), {'time', 'cartType', 'itemId', 'amount'})
+        self.assertEqual(errors['cartType'], ['This field may not be blank.'])
+        self.assertEqual(errors['itemId'], ['This field may not be null.'])
+        self.assertEqual(errors['amount'], ['A valid integer is required.'])
+
+    def test_missing_fields_and_choices(self):
+        with self.assertRaises(EventValidationError) as ctx:
+            EVENT_SCHEMAS['error_event'].validate(self.payload(severity='Fatal'))
+        self.assertEqual(ctx.exception.errors, {
+            'message': ['This field is required.'],
+            'severity': ['"Fatal" is not a valid choice.'],
+        })
+
+    def test_event_id_is_optional(self):
+        schema = EVENT_SCHEMAS['quality_event']
+        self.assertIsNone(schema.validate(self.payload(FPS=60, memoryUsage=1))['event_id'])
+        record = schema.validate(self.payload(FPS=60, memoryUsage=1, event_id='6F9619FF-8B86-D011-B42D-00C04FC964FF'))
+        self.assertEqual(record['event_id'], '6f9619ff-8b86-d011-b42d-00c04fc964ff')
+        with self.assertRaises(EventValidationError) as ctx:
+            schema.validate(self.payload(FPS=60, memoryUsage=1, event_id='42'))
+        self.assertEqual(ctx.exception.errors, {'event_id': ['Must be a valid UUID.']})
+
+
+class SequenceBlockAllocatorTests(SimpleTestCase):
+    def test_ids_are_taken_from_reserved_blocks(self):
+        starts = iter([1000, 5000])
+        reserved = []
+
+        def reserve(sequence):
+            reserved.append(sequence)
+            return next(starts), 4
+
+        allocator = SequenceBlockAllocator('gameevent_id_seq', reserve=reserve)
+        self.assertEqual(allocator.allocate(3), [1000, 1001, 1002])
+        self.assertEqual(allocator.allocate(3), [1003, 5000, 5001])
+        self.assertEqual(allocator.next(), 5002)
+        self.assertEqual(reserved, ['gameevent_id_seq', 'gameevent_id_seq'])
+
+    def test_clients_get_ids_from_the_allocated_blocks(self):
+        starts = iter([100, 500])
+        reserved = []
+
+        def reserve(sequence):
+            reserved.append(sequence)
+            return next(starts), 2
+
+        token = Token(id=7)
+        with mock.patch('analytics.views.client_ids', SequenceBlockAllocator('analytics_client_id_seq', reserve=reserve)), \
+                mock.patch.object(Client.objects, 'create', side_effect=lambda **fields: Client(**fields)):
+            clients = [TokenView().create_client(token) for _ in range(3)]
+        self.assertEqual([client.id for client in clients], [100, 101, 500])
+        self.assertEqual({client.token_id for client in clients}, {7})
+        self.assertEqual(reserved, ['analytics_client_id_seq'] * 2)
+
+class StagingWriterTests(SimpleTestCase):
+    def test_staging_columns_match_the_staging_tables(self):
+        self.assertEqual(staging_columns('quality_event')[5:], [('FPS', 'double precision'), ('memoryUsage', 'double precision'), ('client_event_id', 'uuid')])
+        self.assertEqual(staging_columns('business_event')[8], ('amount', 'integer'))
+
+    def test_binary_copy_encoding(self):
+        when = datetime(2000, 1, 1, 0, 0, 1, tzinfo=timezone.utc)
+        data = encode_copy_binary(['bigint', 'timestamptz', 'text', 'double precision'], [(7, when, 'hi', None)]).getvalue()
+        self.assertTrue(data.startswith(b'PGCOPY\n\xff\r\n\x00'))
+        self.assertEqual(data[19:], b''.join([
+            struct.pack('!h', 4),
+            struct.pack('!iq', 8, 7),
+            struct.pack('!iq', 8, 1_000_000),
+            struct.pack('!i', 2) + b'hi',
+            struct.pack('!i', -1),
+            struct.pack('!h', -1),
+        ]))
+
+
+class EventTypeHypertableTests(SimpleTestCase):
+    def test_subtype_rows_carry_the_gameevent_columns(self):
+        when = datetime(2025, 1, 1, tzinfo=timezone.utc)
+        sql, params = build_subtype_insert('quality_event', [{'time': when, 'client': 1, 'session': 2, 'product': 3, 'FPS': 60.0, 'memoryUsage': 512.0}], [9])
+        self.assertEqual(sql, 'INSERT INTO "qualityevent" ("game_event", "time", "client_id", "session_id", "product_id", "FPS", "memoryUsage") VALUES (%s, %s, %s, %s, %s, %s, %s)')
+        self.assertEqual(params, [9, when, 1, 2, 3, 60.0, 512.0])
+
+    def test_aggregates_no_longer_join_subtype_tables(self):
+        before = {name: statements for name, statements, _ in aggregate_definitions(until='0019_ClientBigIntIds')}
+        after = {name: (statements, drop) for name, statements, drop in aggregate_definitions()}
+        self.assertEqual(list(after), list(before) + ['activeUserSketch', 'fpsSketch', 'memoryUsageSketch'])
+        self.assertIn('JOIN analytics_qualityevent', before['averageFPS'][0])
+        for name, (statements, _) in after.items():
+            self.assertNotIn('game_event', ''.join(statements), name)
+        self.assertEqual(after['crashRate'][1][0], "DROP VIEW IF EXISTS crashRate;")
+        self.assertEqual(after['averageFPS'][1], "DROP MATERIALIZED VIEW IF EXISTS averageFPS;")
+
+
+class ActiveUserSketchTests(SimpleTestCase):
+    def sketch(self, clients):
+        sketch = DistinctSketch()
+        for client in clients:
+            sketch.add(client)
+        return sketch
+
+    def test_hash_matches_the_aggregate(self):
+        # md5('42') = a1d0c6e83f027327..., top 10 bits 1010000111, then 01... -> rank 2
+        self.assertEqual(register_rank(42), (0b1010000111, 2))
+
+    def test_merged_sketches_count_the_union(self):
+        merged = self.sketch(range(0, 30_000)).merge(self.sketch(range(20_000, 50_000)))
+        self.assertEqual(merged.registers, self.sketch(range(50_000)).registers)
+        self.assertLess(abs(merged.estimate() - 50_000) / 50_000, 0.1)
+        self.assertAlmostEqual(self.sketch(range(40)).estimate(), 40, delta=1)
+        self.assertEqual(DistinctSketch().estimate(), 0)
+        self.assertEqual(len(DistinctSketch().registers), REGISTERS)
+
+    def test_weekly_and_monthly_users_merge_the_days_before(self):
+        first = date(2025, 3, 1)
+        # 30 clients a day: 20 regulars and 10 new ones
+        sketches = {first + timedelta(days=day): self.sketch([*range(20), *range(100 + 10 * day, 110 + 10 * day)]) for day in range(35)}
+        series = rolling_active_users(sketches, first + timedelta(days=29), first + timedelta(days=34))
+        self.assertEqual([point['day'] for point in series[:2]], ['2025-03-30', '2025-03-31'])
+        self.assertAlmostEqual(series[0]['dau'], 30, delta=1)
+        self.assertAlmostEqual(series[0]['wau'], 90, delta=3)
+        self.assertAlmostEqual(series[0]['mau'], 320, delta=15)
+        self.assertAlmostEqual(series[0]['stickiness'], series[0]['dau'] / series[0]['mau'])
+        self.assertIsNone(rolling_active_users({}, first, first)[0]['stickiness'])
+
+
+class QuantileSketchTests(SimpleTestCase):
+    def test_quantiles_are_within_the_relative_accuracy(self):
+        rng = random.Random(7)
+        # mostly smooth frames with a tail of stutters
+        values = [rng.gauss(60, 4) for _ in range(9_000)] + [rng.uniform(5, 30) for _ in range(1_000)]
+        sketch = QuantileSketch()
+        for value in values:
+            sketch.add(value)
+        values.sort()
+        for q in (0.01, 0.05, 0.5, 0.9, 0.99):
+            exact = values[int(q * (len(values) - 1))]
+            self.assertLessEqual(abs(sketch.quantile(q) - exact) / exact, RELATIVE_ACCURACY + 1e-9, q)
+        self.assertLess(len(sketch.bins), 100)
+
+    def test_merged_hours_equal_one_sketch(self):
+        first, second, both = QuantileSketch(), QuantileSketch(), QuantileSketch()
+        for value in range(1, 500):
+            (first if value % 3 else second).add(value)
+            both.add(value)
+        self.assertEqual(first.merge(second).bins, both.bins)
+        self.assertEqual(both.count, 499)
+        self.assertEqual(bin_index(0), bin_index(MIN_VALUE))
+        self.assertEqual(QuantileSketch().quantiles(), {'p50': None, 'p90': None, 'p95': None, 'p99': None})
+
+
+class PercentilesViewTests(SimpleTestCase):
+    def get(self, **params):
+        request = APIRequestFactory().get('/api/percentiles/', params)
+        force_authenticate(request, user=mock.Mock(is_authenticated=True))
+        return PercentilesView.as_view()(request)
+
+    def test_dates_are_midnight_utc(self):
+        self.assertEqual(parse_moment('2024-05-01'), datetime(2024, 5, 1, tzinfo=timezone.utc))
+        self.assertEqual(parse_moment('2024-05-01T12:30:00+02:00'), datetime(2024, 5, 1, 10, 30, tzinfo=timezone.utc))
+        self.assertIsNone(parse_moment(''))
+
+    def test_unparseable_ranges_are_rejected(self):
+        self.assertEqual(self.get(product_id=1, start='2024-05-01T25:00').status_code, 400)
+        self.assertEqual(self.get(product_id=1, end='May 1st').status_code, 400)
+
+
+class LiveAggregatorTests(SimpleTestCase):
+    def test_deltas_are_coalesced_per_kpi_product_and_bucket(self):
+        now = iter([100.0, 101.0, 102.0])
+        aggregator = LiveAggregator({name: LIVE_KPIS[name] for name in ('EventCount', 'AverageFPS')}, clock=lambda: next(now))
+        when = datetime(2025, 1, 1, 10, 30, tzinfo=timezone.utc)
+        aggregator.record('quality_event', [
+            {'time': when, 'product': 1, 'client': 5, 'FPS': 30.0},
+            {'time': when + timedelta(minutes=10), 'product': 1, 'client': 6, 'FPS': 60.0},
+            {'time': when + timedelta(hours=1), 'product': 2, 'client': 7, 'FPS': 50.0},
+        ])
+        aggregator.record('error_event', [{'time': when, 'product': 1, 'client': 5}])
+
+        messages = {group: json.loads(message) for group, message in aggregator.drain()}
+        self.assertEqual(sorted(messages), ['live.AverageFPS.1', 'live.AverageFPS.2', 'live.EventCount.1', 'live.EventCount.2'])
+        self.assertEqual(messages['live.EventCount.1']['buckets'], [{'bucket': '2025-01-01T10:00:00+00:00', 'delta': {'count': 3}}])
+        self.assertEqual(messages['live.AverageFPS.1']['buckets'][0]['delta'], {'sum': 90.0, 'count': 2})
+        self.assertEqual((messages['live.AverageFPS.2']['since'], messages['live.AverageFPS.2']['until']), (100.0, 101.0))
+        self.assertEqual(aggregator.drain(), [])
+
+    def test_consumers_merge_deltas_into_the_aggregate_history(self):
+        history = {'sum': 600.0, 'count': 10}
+        merge_partial(history, {'sum': 90.0, 'count': 2}, 'sum')
+        self.assertEqual(LIVE_KPIS['AverageFPS'].point('b', history), {'bucket': 'b', 'average_fps': 57.5})
+        registers = merge_partial({'3': 2, '7': 1}, {'3': 1, '9': 4}, 'max')
+        self.assertEqual(registers, {'3': 2, '7': 1, '9': 4})
+        self.assertEqual(LIVE_KPIS['ActiveUsers'].point('b', registers)['active_users'], 3)
+        self.assertEqual(bucket_start(datetime(2025, 1, 1, 23, 59, tzinfo=timezone.utc), 86400), datetime(2025, 1, 1, tzinfo=timezone.utc))
+
+    def test_deltas_overlapping_a_read_of_the_aggregate_read_their_buckets_again(self):
+        bucket = '2025-01-01T10:00:00+00:00'
+        reads = []
+
+        def history(product_id, start):
+            reads.append(start.isoformat())
+            return {bucket: {'count': 8}}
+
+        consumer = LiveKPIConsumer()
+        consumer.kpi = LIVE_KPIS['EventCount']._replace(history=history)
+        consumer.product_id = 1
+        consumer.partials = {bucket: {'count': 5}}
+        consumer.synced_at, consumer.counted = time.time(), {}
+        sent = []
+
+        async def send_points(buckets):
+            sent.append({bucket: dict(consumer.partials[bucket]) for bucket in buckets})
+        consumer.send_points = send_points
+
+        def delta(source, since, until, count):
+            text = json.dumps({'source': source, 'since': consumer.synced_at + since, 'until': consumer.synced_at + until,
+                               'buckets': [{'bucket': bucket, 'delta': {'count': count}}]})
+            return {'type': 'send.sse.message', 'text': text}
+
+        async def run():
+            await consumer.send_sse_message(delta('a', -1, -0.5, 1))  # in the aggregate already
+            await consumer.send_sse_message(delta('a', -0.5, 0.5, 2))  # partly in it
+            await consumer.send_sse_message(delta('a', 0.5, 1.5, 2))
+
+        asyncio.run(run())
+        self.assertEqual(reads, [bucket])
+        self.assertEqual(sent, [{bucket: {'count': 8}}, {bucket: {'count': 10}}])
+
+    @override_settings(CHANNEL_LAYERS=IN_MEMORY_LAYER, LIVE_KPI_INTERVAL=1)
+    def test_recorded_events_reach_open_live_streams(self):
+        now = datetime.now(timezone.utc)
+        bucket = bucket_start(now, 3600).isoformat()
+        kpi = LIVE_KPIS['EventCount']._replace(history=lambda product_id, start: {bucket: {'count': 5}})
+        written = []
+
+        def writer(event_type, rows):
+            written.extend(rows)
+            return [1] * len(rows)
+
+        async def run():
+            communicator, _ = await open_stream(LiveKPIConsumer.as_asgi(), sse_scope('/kpi/sse/live/EventCount', b'product_id=1', kpi='EventCount'))
+            history = await next_frame(communicator)
+            aggregator = LiveAggregator({'EventCount': kpi})
+            write = aggregator.recorded(writer)
+            with mock.patch('analytics.services.LiveAggregates.transaction.on_commit', side_effect=lambda func: func()):
+                write('error_event', [{'time': now, 'product': 1, 'client': 5}, {'time': now, 'product': 2, 'client': 6}])
+            await aggregator.flush_async()
+            update = await next_frame(communicator)
+            await close_stream(communicator)
+            return history, update
+
+        with mock.patch.dict(LIVE_KPIS, {'EventCount': kpi}):
+            history, update = asyncio.run(run())
+        self.assertEqual(len(written), 2)
+        self.assertEqual(history, [{'bucket': bucket, 'event_count': 5, 'product_id': 1}])
+        self.assertEqual(update, [{'bucket': bucket, 'event_count': 6, 'product_id': 1}])
+
+
+class SSEHubTests(SimpleTestCase):
+    def test_one_poll_per_key_however_many_subscribers(self):
+        hub = KPIHub(min_interval=0.01)
+        values = iter(range(100))
+
+        async def run():
+            viewers = [hub.subscribe(('EventCount', 1), lambda: lambda: [{'value': next(values)}], 0.01) for _ in range(10)]
+            other = hub.subscribe(('EventCount', 2), lambda: lambda: [], 0.01)
+            frames = [await viewer.__anext__() for viewer in viewers]
+            polls = hub.polls
+            for viewer in viewers:
+                hub.unsubscribe(viewer)
+            hub.unsubscribe(other)
+            await asyncio.sleep(0.05)
+            return frames, polls
+
+        frames, polls = asyncio.run(run())
+        self.assertEqual(frames, [sse_frame({'value': 0})] * 10)
+        self.assertTrue(all(frame is frames[0] for frame in frames))
+        self.assertLessEqual(polls, 2)
+        self.assertEqual(hub.pollers, {})
+
+    @override_settings(CHANNEL_LAYERS=IN_MEMORY_LAYER)
+    def test_streams_receive_polled_frames_until_the_client_disconnects(self):
+        async def run():
+            communicator, status = await open_stream(CountingStreamConsumer.as_asgi(), sse_scope('/kpi/sse/Counting'))
+            frames = [await next_frame(communicator) for _ in range(3)]
+            subscribed = set(kpi_hub.pollers)
+            await close_stream(communicator)
+            return status, frames, subscribed
+
+        with mock.patch.object(kpi_hub, 'min_interval', 0.01):
+            status, frames, subscribed = asyncio.run(run())
+        self.assertEqual(status, 200)
+        self.assertEqual(frames, [[], {'value': 0}, {'value': 1}])
+        self.assertEqual(subscribed, {('Counting', 1)})
+        self.assertEqual(kpi_hub.pollers, {})
+
+    def test_changed_poll_only_returns_new_or_updated_points(self):
+        series = [[{'bucket': 'a', 'value': 1}], [{'bucket': 'a', 'value': 1}, {'bucket': 'b', 'value': 2}], [{'bucket': 'b', 'value': 3}]]
+        poll = ChangedPoll(iter(series).__next__)
+        self.assertEqual([poll(), poll(), poll()], [series[0], [series[1][1]], series[2]])
+
+
+class KPIStreamTests(SimpleTestCase):
+    def test_every_hourly_aggregate_has_a_routed_stream(self):
+        self.assertEqual(len({stream.model for stream in KPI_STREAMS.values()}), 13)
+        for name, stream in KPI_STREAMS.items():
+            for column in (*stream.dimensions, *stream.values):
+                stream.model._meta.get_field(column)
+            self.assertTrue(any(pattern.resolve(f'kpi/sse/{name}') for pattern in sse_urlpatterns), name)
+
+    def test_ranges_default_to_the_whole_history_and_stream_while_open(self):
+        now = datetime(2025, 1, 10, 12, tzinfo=timezone.utc)
+        self.assertEqual(stream_window(None, None, now), (None, None, True))
+        self.assertEqual(stream_window('2025-01-01T00:00:00+00:00', None, now), (datetime(2025, 1, 1, tzinfo=timezone.utc), None, True))
+        self.assertFalse(stream_window(None, '2025-01-02T00:00:00+00:00', now)[2])
+        self.assertTrue(stream_window(None, '2025-01-11T00:00:00+00:00', now)[2])
+        with self.assertRaises(ValueError):
+            stream_window('yesterday', None, now)
+
+    @override_settings(CHANNEL_LAYERS=IN_MEMORY_LAYER)
+    def test_streams_send_the_range_then_changed_recent_rows(self):
+        history = [{'bucket': 'a', 'product_id': 1, 'currency': 'USD', 'total_amount': 2}]
+        polls = iter([
+            [{'bucket': 'b', 'product_id': 1, 'currency': 'USD', 'total_amount': 5}],
+            [{'bucket': 'b', 'product_id': 1, 'currency': 'USD', 'total_amount': 5}, {'bucket': 'b', 'product_id': 1, 'currency': 'EUR', 'total_amount': 1}],
+        ])
+
+        async def run():
+            scope = sse_scope('/kpi/sse/TotalRevenuePerCurrency', b'product_id=1&start_time=2025-01-01T00:00:00&update_interval=0.01', kpi='TotalRevenuePerCurrency')
+            communicator, _ = await open_stream(KPIStreamConsumer.as_asgi(), scope)
+            frames = [await next_frame(communicator) for _ in range(3)]
+            await close_stream(communicator)
+            return frames
+
+        with mock.patch('analytics.consumers.kpi_rows', return_value=history) as kpi_rows, \
+                mock.patch('analytics.consumers.recent_rows', side_effect=lambda *args: next(polls, [])), \
+                mock.patch.object(kpi_hub, 'min_interval', 0.01):
+            frames = asyncio.run(run())
+        self.assertEqual(kpi_rows.call_args.args[2:], (make_aware(datetime(2025, 1, 1)), None))
+        self.assertEqual(frames, [history, {'bucket': 'b', 'product_id': 1, 'currency': 'USD', 'total_amount': 5}, {'bucket': 'b', 'product_id': 1, 'currency': 'EUR', 'total_amount': 1}])
+
+    def test_rows_with_dimensions_are_updated_one_by_one(self):
+        fetches = iter([
+            [{'bucket': 'b', 'currency': 'USD', 'total_amount': 5}, {'bucket': 'b', 'currency': 'EUR', 'total_amount': 3}],
+            [{'bucket': 'b', 'currency': 'USD', 'total_amount': 5}, {'bucket': 'b', 'currency': 'EUR', 'total_amount': 4}],
+        ])
+        poll = ChangedPoll(fetches.__next__, row_key(KPI_STREAMS['TotalRevenuePerCurrency']))
+        self.assertEqual(len(poll()), 2)
+        self.assertEqual(poll(), [{'bucket': 'b', 'currency': 'EUR', 'total_amount': 4}])
+
+
+class PostgresChannelLayerTests(SimpleTestCase):
+    def test_payloads_are_packed_per_channel_in_order_within_the_limit(self):
+        entries = [('a', '"%d"' % i) for i in range(10)] + [('b', '"b"'), ('a', '"x"')]
+        packed = pack_payloads(entries, limit=20)
+        self.assertEqual([channel for channel, _ in packed], ['a', 'a', 'a', 'b'])
+        self.assertTrue(all(len(f"[{','.join(entries)}]") <= 20 for _, entries in packed))
+        self.assertEqual([entry for channel, entries in packed if channel == 'a' for entry in entries], [entry for channel, entry in entries if channel == 'a'])
+
+    def test_notified_entries_reach_the_local_members(self):
+        layer = PostgresChannelLayer(database={}, capacity=1)
+        first, second = f"specific.{layer.process}!1", f"specific.{layer.process}!2"
+        layer.channels = {first: asyncio.Queue(1), second: asyncio.Queue(1)}
+        layer.groups = {'live.EventCount.1': {first, second}}
+        self.assertEqual(layer.owner(first), layer.process)
+        self.assertLessEqual(len(layer.group_channel('x' * 99)), 63)
+
+        layer.deliver({'g': 'live.EventCount.1', 'm': {'n': 1}})
+        with self.assertLogs('analytics.services.PostgresChannelLayer', 'WARNING'):
+            layer.deliver({'g': 'live.EventCount.1', 'm': {'n': 2}})
+            layer.deliver({'c': second, 'm': {'n': 3}})
+        layer.deliver({'g': 'live.EventCount.2', 'm': {'n': 4}})
+        self.assertEqual([layer.channels[first].get_nowait(), layer.channels[second].get_nowait()], [{'n': 1}, {'n': 1}])
+        self.assertTrue(layer.channels[second].empty())
+
+        asyncio.run(layer.send(first, {'n': 5}))
+        with self.assertRaises(ChannelFull):
+            asyncio.run(layer.send(first, {'n': 6}))
+        with self.assertRaises(ValueError):
+            layer.owner('worker')
+
+
+class TimescalePoliciesTests(SimpleTestCase):
+    def test_chunks_are_dropped_after_the_longest_product_retention(self):
+        self.assertEqual(chunk_retention_days([30, 90, 14]), 90)
+        self.assertIsNone(chunk_retention_days([30, None]))
+        self.assertIsNone(chunk_retention_days([]))
+
+    def test_retention_has_to_outlive_the_aggregate_refresh_window(self):
+        validate_retention_days(8)
+        validate_retention_days(0)
+        with self.assertRaises(ValueError):
+            validate_retention_days(7)
+
+    def test_policies_cover_every_event_hypertable(self):
+        self.assertEqual(event_hypertables()[:2], ['gameevent', 'sessionstartevent'])
+        self.assertEqual(len(event_hypertables()), 8)
+
+
+class ChunkTuningTests(SimpleTestCase):
+    def test_active_chunks_of_all_hypertables_fit_the_memory_budget(self):
+        profiles = [
+            TableProfile('gameevent', 1_000_000, 200_000_000, 100_000, 5, None, 32),
+            TableProfile('qualityevent', 0, None, 100_000, 5, None, 32),
+        ]
+        # 4 GB * 0.25 / (100k rows/h * 200 B + 100k rows/h * 200 B) = 25 h
+        self.assertEqual(recommend_chunk_interval(profiles, 4 * 10**9), timedelta(hours=24))
+        self.assertEqual(recommend_chunk_interval(profiles[:1], 10**15), timedelta(days=7))
+        self.assertEqual(recommend_chunk_interval(profiles, 10**6), timedelta(hours=1))
+        self.assertEqual(nice_interval(5 * 3600), timedelta(hours=4))
+
+    def test_space_partitions_only_for_extra_disks_with_enough_rows(self):
+        self.assertEqual(recommend_partitions(50_000_000, 200, disks=1), 1)
+        self.assertEqual(recommend_partitions(50_000_000, 200, disks=4), 4)
+        self.assertEqual(recommend_partitions(2_500_000, 200, disks=4), 2)
+        self.assertEqual(recommend_partitions(50_000_000, 3, disks=4), 3)
+
+
+class ChannelAcksTests(SimpleTestCase):
+    def test_acks_wait_for_earlier_deliveries(self):
+        acks = ChannelAcks()
+        messages = [FakeMessage(tag) for tag in range(1, 5)]
+        for message in messages:
+            acks.track(message)
+
+        acks.ack_many([messages[1], messages[2]])
+        self.assertEqual([m.state for m in messages], [None, None, None, None])
+
+        acks.reject(messages[3])
+        acks.ack(messages[0])
+        self.assertEqual([m.state for m in messages], [None, None, 'ACK_MULTIPLE', 'REJECT'])
+        self.assertFalse(acks.outstanding)
+
+    def test_batcher_settles_through_shared_acks(self):
+        acks = ChannelAcks()
+        batcher = EventBatcher('quality_event', size=2, interval_ms=60_000, writer=lambda event_type, rows: None, acks=acks)
+        messages = [FakeMessage(tag) for tag in range(1, 4)]
+        for message in messages:
+            acks.track(message)
+
+        batcher.add({}, messages[0])
+        batcher.add({}, messages[2])
+        self.assertEqual([m.state for m in messages], ['ACK_MULTIPLE', None, None])
+
+        acks.ack(messages[1])
+        self.assertEqual([m.state for m in messages], ['ACK_MULTIPLE', None, 'ACK_MULTIPLE'])
+
+
+class IngestionStepTests(SimpleTestCase):
+    class Handler(EventHandler):
+        event_type = 'quality_event'
+        label = 'Quality Event'
+
+        def validate(self, data):
+            if 'FPS' not in data:
+                raise EventValidationError({'FPS': ['This field is required.']})
+            return data
+
+    def setUp(self):
+        self.step = IngestionStep(None)
+        self.step.handlers = {'quality_event': self.Handler()}
+        self.written = []
+        self.step.batchers = {'quality_event': EventBatcher(
+            'quality_event', size=100, interval_ms=60_000,
+            writer=lambda event_type, rows: self.written.append((event_type, rows)), acks=self.step.acks)}
+
+    def deliver(self, tag, body, queue='quality_event'):
+        message = FakeMessage(tag, f'user.analytic.{queue}')
+        self.step.handle_message(body, message)
+        return message
+
+    def test_dispatches_on_queue_suffix(self):
+        ok = self.deliver(1, '{"FPS": 60}')
+        invalid = self.deliver(2, '{}')
+        unknown = self.deliver(3, '{}', queue='mystery_event')
+        broken = self.deliver(4, 'not json')
+        self.step.flush_pending()
+
+        self.assertEqual(self.written, [('quality_event', [{'FPS': 60}])])
+        self.assertEqual([m.state for m in (ok, invalid, unknown, broken)], ['ACK_MULTIPLE', 'REJECT', 'REJECT', 'REJECT'])
+        self.assertEqual(dict(self.step.stats['quality_event']), {'received': 3, 'accepted': 1, 'invalid': 2})
+
+    def test_envelope_writes_valid_entries_and_quarantines_the_rest(self):
+        groups = []
+        self.step.write_groups = groups.append
+        producer = FakeProducer()
+        self.step.failures = FailurePolicy(producer, self.step.acks)
+        body = '{"session": 7, "client": 3, "events": [{"FPS": 60}, {}, {"type": "start_session"}, {"FPS": 58}]}'
+        message = self.deliver(1, body)
+
+        self.assertEqual(groups, [{'quality_event': [
+            {'FPS': 60, 'session': 7, 'client': 3}, {'FPS': 58, 'session': 7, 'client': 3}]}])
+        self.assertEqual(message.state, 'ACK_MULTIPLE')
+        [(name, _, headers)] = producer.published
+        self.assertEqual(name, 'user.analytic.dead_letter')
+        self.assertIn("'1'", headers['x-error'])
+        self.assertIn("'2'", headers['x-error'])
+        self.assertEqual(dict(self.step.stats['quality_event']), {'received': 1, 'envelopes': 1, 'accepted': 2, 'invalid': 2})
+
+    def test_envelope_without_session_is_rejected_whole(self):
+        self.step.write_groups = lambda groups: self.fail("nothing should be written")
+        message = self.deliver(1, '{"events": [{"FPS": 60}]}')
+        self.assertEqual(message.state, 'REJECT')
+
+    def test_queues_are_resolved_by_consumer_tag(self):
+        consumer = FakeConsumer()
+        consumer._active_tags = {'user.analytic.quality_event': '3'}
+        self.step.consumers = [consumer]
+        producer = FakeProducer()
+        self.step.failures = FailurePolicy(producer, self.step.acks)
+        ok, invalid = FakeMessage(1, 'events.topic'), FakeMessage(2, 'events.topic')
+        for message, body in ((ok, '{"FPS": 60}'), (invalid, '{}')):
+            message.delivery_info['consumer_tag'] = '3'
+            self.step.handle_message(body, message)
+        self.step.flush_pending()
+
+        self.assertEqual(self.written, [('quality_event', [{'FPS': 60}])])
+        self.assertEqual([name for name, _, _ in producer.published], ['user.analytic.dead_letter'])
+
+    def test_malformed_ids_are_quarantined_without_retries(self):
+        self.step.handlers = {event_type: EVENT_HANDLERS[event_type] for event_type in ('quality_event', 'start_session')}
+        producer = FakeProducer()
+        self.step.failures = FailurePolicy(producer, self.step.acks)
+        session = self.deliver(1, '{"session": "abc", "client": 3, "FPS": 60, "memoryUsage": 1}')
+        client = self.deliver(2, '{"session": 9, "client": "x", "platform": "android"}', queue='start_session')
+
+        self.assertEqual([name for name, _, _ in producer.published], ['user.analytic.dead_letter'] * 2)
+        self.assertEqual([m.state for m in (session, client)], ['ACK_MULTIPLE'] * 2)
+        self.assertEqual(self.step.stats['quality_event']['invalid'], 1)
+        self.assertEqual(self.step.stats['start_session']['invalid'], 1)
+
+
+class FakeProducer:
+    def __init__(self):
+        self.published = []
+
+    def publish(self, body, routing_key, declare, headers, **kwargs):
+        self.published.append((routing_key, declare[0].queue_arguments, headers))
+
+
+class FailurePolicyTests(SimpleTestCase):
+    queue = 'alice.alice_game_vhost.quality_event.SINGLE_VALUE'
+
+    def setUp(self):
+        self.producer = FakeProducer()
+        self.policy = FailurePolicy(self.producer, ChannelAcks(), max_retries=2, base_delay_ms=100)
+
+    def test_backoff_doubles(self):
+        self.assertEqual([retry_delay_ms(attempt, 100) for attempt in (1, 2, 3)], [100, 200, 400])
+
+    def test_retries_then_quarantines(self):
+        first = FakeMessage(1, self.queue)
+        self.policy.failed(first, ValueError('Session not found'))
+        name, arguments, headers = self.producer.published[-1]
+        self.assertEqual(name, f'{self.queue}.retry.1')
+        self.assertEqual(arguments['x-message-ttl'], 100)
+        self.assertEqual(arguments['x-dead-letter-routing-key'], self.queue)
+        self.assertEqual(headers, {'x-retries': 1})
+        self.assertEqual(first.state, 'ACK')
+
+        self.policy.failed(FakeMessage(2, self.queue, {'x-retries': 1, 'x-death': []}), ValueError('again'))
+        self.assertEqual(self.producer.published[-1][0], f'{self.queue}.retry.2')
+        self.assertEqual(self.producer.published[-1][1]['x-message-ttl'], 200)
+
+        self.policy.failed(FakeMessage(3, self.queue, {'x-retries': 2}), ValueError('still missing'))
+        name, _, headers = self.producer.published[-1]
+        self.assertEqual(name, 'alice.alice_game_vhost.dead_letter')
+        self.assertEqual(headers, {'x-retries': 2, 'x-error': 'still missing', 'x-original-queue': self.queue})
+
+    def test_invalid_events_skip_retries(self):
+        self.policy.failed(FakeMessage(1, self.queue), {'FPS': ['This field is required.']}, retry=False)
+        self.assertEqual(self.producer.published[-1][0], 'alice.alice_game_vhost.dead_letter')
+
+
+class FakeConsumer:
+    def __init__(self):
+        self.queues = {}
+        self.consuming = set()
+
+    def add_queue(self, queue):
+        self.queues[queue.name] = queue
+
+    def consume(self):
+        self.consuming |= set(self.queues)
+
+    def cancel_by_queue(self, queue_name):
+        self.queues.pop(queue_name, None)
+        self.consuming.discard(queue_name)
+
+
+class PassThroughHandler(EventHandler):
+    label = 'Event'
+
+    def validate(self, data):
+        return data
+
+
+class LiveQueueTests(SimpleTestCase):
+    event_types = ['start_session', 'quality_event', 'error_event']
+
+    def setUp(self):
+        self.written = []
+        self.step = IngestionStep(None, queue_collection=QueueCollection(load=False))
+        self.step.consumers = [FakeConsumer()]
+        self.step.batchers = {
+            event_type: EventBatcher(event_type, size=7, interval_ms=60_000, writer=self.writer, acks=self.step.acks)
+            for event_type in self.event_types
+        }
+        self.step.handlers = {event_type: PassThroughHandler() for event_type in self.event_types}
+
+    def writer(self, event_type, rows):
+        self.written.extend(rows)
+
+    def token_queues(self, token):
+        return [f'user{token}.user{token}_game_vhost.{event_type}.SINGLE_VALUE' for event_type in self.event_types]
+
+    def test_tokens_churn_while_events_flow(self):
+        consumer = self.step.consumer
+        tag = 0
+        for token in range(40):
+            for queue_name in self.token_queues(token):
+                self.assertTrue(self.step.add_queue(queue_name))
+            if token % 3 == 0 and token:
+                for queue_name in self.token_queues(token - 1):
+                    self.assertTrue(self.step.remove_queue(queue_name))
+            for queue_name in sorted(consumer.consuming):
+                tag += 1
+                self.step.handle_message(f'{{"n": {tag}}}', FakeMessage(tag, queue_name))
+
+        self.assertFalse(self.step.add_queue(self.token_queues(0)[0]))
+        self.assertFalse(self.step.add_queue('user0.user0_game_vhost.dead_letter'))
+        self.step.flush_pending()
+
+        removed = {queue_name for token in range(2, 40, 3) for queue_name in self.token_queues(token)}
+        self.assertEqual(consumer.consuming, {queue_name for token in range(40) for queue_name in self.token_queues(token)} - removed)
+        self.assertEqual(sorted(row['n'] for row in self.written), list(range(1, tag + 1)))
+        self.assertFalse(self.step.acks.outstanding)
+
+    def test_reconcile_follows_queue_table(self):
+        collection = self.step.queue_collection
+        table = self.token_queues(1) + self.token_queues(2)
+        collection.refresh = lambda: setattr(collection, 'queues', [collection.make_queue(name) for name in table])
+        for queue_name in self.token_queues(0) + self.token_queues(1):
+            self.step.add_queue(queue_name)
+
+        self.step.reconcile()
+        self.assertEqual(self.step.consumer.consuming, set(table))
+        self.assertEqual(self.step.consumed, set(table))
+
+
+class ShardingTests(SimpleTestCase):
+    def test_growing_only_moves_keys_to_the_new_shard(self):
+        for buckets in range(1, 12):
+            for key in range(2000):
+                before, after = jump_hash(key, buckets), jump_hash(key, buckets + 1)
+                self.assertTrue(0 <= before < buckets)
+                self.assertIn(after, (before, buckets))
+
+    def test_keys_spread_evenly(self):
+        counts = Counter(jump_hash(key, 8) for key in range(80_000))
+        self.assertEqual(set(counts), set(range(8)))
+        self.assertLess(max(counts.values()) / min(counts.values()), 1.1)
+
+    @override_settings(INGEST_SHARD_INDEX=1, INGEST_SHARD_COUNT=3)
+    def test_step_consumes_only_its_products(self):
+        collection = QueueCollection(load=False)
+        step = IngestionStep(None, queue_collection=collection)
+        step.consumers = [FakeConsumer()]
+        mine = next(product for product in range(100) if jump_hash(product, 3) == 1)
+        other = next(product for product in range(100) if jump_hash(product, 3) != 1)
+
+        self.assertTrue(owns(mine))
+        self.assertTrue(step.add_queue('a.a_vhost.quality_event.SINGLE_VALUE', mine))
+        self.assertFalse(step.add_queue('b.b_vhost.quality_event.SINGLE_VALUE', other))
+        self.assertEqual(step.consumer.consuming, {'a.a_vhost.quality_event.SINGLE_VALUE'})
+
+
+class AsyncMessage:
+    def __init__(self, body, routing_key):
+        self.body = body
+        self.routing_key = routing_key
+        self.headers = {}
+        self.content_type = 'application/json'
+        self.content_encoding = None
+        self.state = None
+
+    async def ack(self):
+        self.state = 'ACK'
+
+    async def reject(self, requeue=False):
+        self.state = 'REQUEUE' if requeue else 'REJECT'
+
+
+class FakeAsyncStore:
+    def __init__(self):
+        self.written = []
+
+    async def session_info(self, session_id):
+        await asyncio.sleep(0)
+        if session_id != 7:
+            raise Session.DoesNotExist()
+        return SessionInfo(1, 2, 3)
+
+    async def write_events(self, event_type, rows):
+        self.written.append((event_type, rows))
+
+
+class AsyncIngestTests(SimpleTestCase):
+    def test_dollar_params(self):
+        self.assertEqual(dollar_params("INSERT INTO t VALUES (%s, %s), (%s, %s)"), "INSERT INTO t VALUES ($1, $2), ($3, $4)")
+
+    def test_async_allocator_reserves_blocks(self):
+        async def reserve(sequence):
+            return 1000, 2
+
+        async def run():
+            allocator = AsyncSequenceBlockAllocator('gameevent_id_seq', reserve)
+            return await allocator.allocate(3)
+
+        self.assertEqual(asyncio.run(run()), [1000, 1001, 1000])
+
+    def test_envelope_is_written_in_one_call(self):
+        store = FakeAsyncStore()
+        groups = []
+
+        async def write_event_groups(batch):
+            groups.append(batch)
+        store.write_event_groups = write_event_groups
+        ingestor = AsyncIngestor(store, None, 4, lambda event_type: {'size': 100, 'interval_ms': 60_000},
+                                 handlers={'quality_event': EVENT_HANDLERS['quality_event']})
+        message = AsyncMessage(
+            b'{"session": 7, "client": 1, "events": [{"time": "2025-01-01T00:00:00Z", "FPS": 60, "memoryUsage": 1},'
+            b' {"time": "2025-01-01T00:00:01Z", "FPS": 59, "memoryUsage": 1}]}',
+            'user.user_vhost.quality_event.SINGLE_VALUE')
+
+        asyncio.run(ingestor.process(message))
+        [batch] = groups
+        self.assertEqual([row['FPS'] for row in batch['quality_event']], [60, 59])
+        self.assertEqual({row['product'] for row in batch['quality_event']}, {3})
+        self.assertEqual(message.state, 'ACK')
+        self.assertEqual(store.written, [])
+
+    def test_oversized_groups_are_inserted_in_chunks(self):
+        class Connection:
+            def __init__(self):
+                self.statements = []
+
+            async def execute(self, sql, *params):
+                self.statements.append((sql.split()[2], len(params)))
+
+            async def fetch(self, sql, *params):
+                self.statements.append((sql.split()[2], len(params)))
+                return [(params[index],) for index in range(0, len(params), 6)]
+
+        rows = [{'time': None, 'client': 1, 'session': 7, 'product': 3, 'FPS': 60, 'memoryUsage': 1}] * 12000
+        store = AsyncEventStore(None)
+        for skip_duplicates in (False, True):
+            connection = Connection()
+            kept = asyncio.run(store._insert(connection, 'quality_event', rows, list(range(12000)), skip_duplicates))
+            self.assertEqual(kept, list(range(12000)))
+            self.assertTrue(all(params <= 32767 for _, params in connection.statements))
+            self.assertEqual(sum(params for table, params in connection.statements if table == 'gameevent'), 12000 * 6)
+            self.assertEqual(len(connection.statements), 6)
+
+    def test_concurrent_events_are_batched_and_settled(self):
+        store = FakeAsyncStore()
+        queue = 'user.user_vhost.quality_event.SINGLE_VALUE'
+        good = [AsyncMessage(f'{{"session": 7, "client": 1, "time": "2025-01-01T00:00:{i:02d}Z", "FPS": 60, "memoryUsage": 1}}'.encode(), queue) for i in range(10)]
+        orphan = AsyncMessage(b'{"session": 8, "client": 1, "time": "2025-01-01T00:00:00Z", "FPS": 60, "memoryUsage": 1}', queue)
+
+        async def run():
+            ingestor = AsyncIngestor(store, None, 4, lambda event_type: {'size': 4, 'interval_ms': 60_000}, handlers={'quality_event': EVENT_HANDLERS['quality_event']})
+            for message in good + [orphan]:
+                await ingestor.on_message(message)
+            await ingestor.drain()
+            return ingestor.stats['quality_event']
+
+        stats = asyncio.run(run())
+        self.assertEqual([len(rows) for _, rows in store.written], [4, 4, 2])
+        self.assertEqual({message.state for message in good}, {'ACK'})
+        self.assertEqual(orphan.state, 'REJECT')
+        self.assertEqual(dict(stats), {'received': 11, 'accepted': 10, 'failed': 1})
+
+    def test_redelivered_session_starts_are_written_as_duplicates(self):
+        store = FakeAsyncStore()
+        sessions = []
+
+        async def client_token(client_id):
+            return 2, 3
+
+        async def create_session(record):
+            sessions.append(record['session'])
+        store.client_token = client_token
+        store.create_session = create_session
+        queue = 'user.user_vhost.start_session.SINGLE_VALUE'
+        body = b'{"session": 9, "client": 1, "time": "2025-01-01T00:00:00Z", "platform": "android"}'
+        messages = [AsyncMessage(body, queue), AsyncMessage(body, queue)]
+
+        async def run():
+            ingestor = AsyncIngestor(store, None, 4, lambda event_type: {'size': 4, 'interval_ms': 60_000},
+                                     handlers={'start_session': EVENT_HANDLERS['start_session']})
+            for message in messages:
+                await ingestor.on_message(message)
+            await ingestor.drain()
+
+        with mock.patch('analytics.services.EventHandlers.session_cache'):
+            asyncio.run(run())
+        [(_, rows)] = store.written
+        self.assertEqual(sessions, [9, 9])
+        # the same event id, so the event writer keeps only the first start
+        self.assertEqual(len({row['event_id'] for row in rows}), 1)
+        self.assertIsNotNone(rows[0]['event_id'])
+        self.assertEqual({message.state for message in messages}, {'ACK'})
+
+    def test_session_starts_succeed_when_retried(self):
+        store = FakeAsyncStore()
+        sessions, retried = set(), []
+        # the batch write and the one-by-one write of the first delivery fail
+        attempts = iter([ConnectionError("server closed the connection")] * 2)
+
+        async def client_token(client_id):
+            return 2, 3
+
+        async def create_session(record):
+            # the session row is committed before the event write fails
+            sessions.add(record['session'])
+
+        async def write_events(event_type, rows):
+            error = next(attempts, None)
+            if error is not None:
+                raise error
+            store.written.append((event_type, rows))
+
+        class Failures:
+            async def failed(self, message, error, retry=True):
+                retried.append(message)
+                await message.ack()
+
+        store.client_token, store.create_session, store.write_events = client_token, create_session, write_events
+        queue = 'user.user_vhost.start_session.SINGLE_VALUE'
+        body = b'{"session": 9, "client": 1, "time": "2025-01-01T00:00:00Z", "platform": "android"}'
+        first, retry = AsyncMessage(body, queue), AsyncMessage(body, queue)
+
+        async def run():
+            ingestor = AsyncIngestor(store, Failures(), 4, lambda event_type: {'size': 1, 'interval_ms': 60_000},
+                                     handlers={'start_session': EVENT_HANDLERS['start_session']})
+            await ingestor.on_message(first)
+            await ingestor.drain()
+            await ingestor.on_message(retry)
+            await ingestor.drain()
+            return ingestor.stats['start_session']
+
+        with mock.patch('analytics.services.EventHandlers.session_cache'):
+            stats = asyncio.run(run())
+        self.assertEqual(retried, [first])
+        self.assertEqual(retry.state, 'ACK')
+        self.assertEqual(sessions, {9})
+        self.assertEqual([len(rows) for _, rows in store.written], [1])
+        self.assertEqual(stats['accepted'], 2)
+
+
+class EventCodecTests(SimpleTestCase):
+    event = {'client': 1, 'session': 2, 'time': datetime(2025, 1, 1, 12, 0, tzinfo=timezone.utc), 'FPS': 59.5, 'memoryUsage': 512.0}
+
+    def test_json_and_double_encoded_json(self):
+        body = b'{"session": 2, "FPS": 60}'
+        self.assertEqual(decode_event(body, 'application/json'), {'session': 2, 'FPS': 60})
+        self.assertEqual(decode_event(b'"{\\"session\\": 2}"', 'application/json'), {'session': 2})
+
+    def test_msgpack_with_and_without_zstd(self):
+        for compress in (False, True):
+            body, encoding = encode_event(self.event, 'application/msgpack', compress)
+            self.assertEqual(decode_event(body, 'application/msgpack', encoding), self.event)
+
+    def test_decoded_msgpack_validates(self):
+        body, encoding = encode_event(self.event, 'application/msgpack', True)
+        data = decode_event(body, 'application/msgpack', encoding)
+        data['product'] = 3
+        self.assertEqual(EVENT_SCHEMAS['quality_event'].validate(data)['time'], self.event['time'])
+
+    def test_rejects_unknown_or_broken_bodies(self):
+        with self.assertRaises(DecodeError):
+            decode_event(b'<xml/>', 'application/xml')
+        with self.assertRaises(DecodeError):
+            decode_event(b'[1, 2]', 'application/json')
+        with self.assertRaises(ValueError):
+            decode_event(b'\xc1', 'application/msgpack')
+
+
+class IngestMetricsTests(SimpleTestCase):
+    def sample(self, name, **labels):
+        return REGISTRY.get_sample_value(name, labels) or 0
+
+    def test_write_records_persisted_rows_and_lag(self):
+        persisted = self.sample('ingest_events_persisted_total', event_type='quality_event', product='41')
+        lags = self.sample('ingest_event_lag_seconds_count', event_type='quality_event', product='41')
+        slow = self.sample('ingest_event_lag_seconds_bucket', event_type='quality_event', product='41', le='30.0')
+        now = datetime.now(timezone.utc)
+        rows = [{'product': 41, 'time': now}, {'product': 41, 'time': now - timedelta(minutes=2)}]
+
+        IngestMetrics.timed_writer(lambda event_type, rows: None)('quality_event', rows)
+        self.assertEqual(self.sample('ingest_events_persisted_total', event_type='quality_event', product='41') - persisted, 2)
+        self.assertEqual(self.sample('ingest_event_lag_seconds_count', event_type='quality_event', product='41') - lags, 2)
+        self.assertEqual(self.sample('ingest_event_lag_seconds_bucket', event_type='quality_event', product='41', le='30.0') - slow, 1)
+
+    def test_step_counts_received_and_failed_by_product(self):
+        step = IngestionStep(None, queue_collection=QueueCollection(load=False))
+        step.queue_collection.add('u.v.error_event.SINGLE_VALUE', 42)
+        step.handlers = {'error_event': IngestionStepTests.Handler()}
+        received = self.sample('ingest_messages_received_total', event_type='error_event', product='42')
+        invalid = self.sample('ingest_events_failed_total', event_type='error_event', product='42', reason='invalid')
+
+        step.handle_message('{}', FakeMessage(1, 'u.v.error_event.SINGLE_VALUE'))
+        self.assertEqual(self.sample('ingest_messages_received_total', event_type='error_event', product='42') - received, 1)
+        self.assertEqual(self.sample('ingest_events_failed_total', event_type='error_event', product='42', reason='invalid') - invalid, 1)
+
+    @override_settings(INGEST_LOG_SAMPLE_RATE=0)
+    def test_info_logs_are_sampled_but_warnings_are_not(self):
+        with self.assertLogs('analytics.ingest', level='INFO') as logs:
+            IngestMetrics.log_event(logging.INFO, "digested", session=1)
+            IngestMetrics.log_event(logging.WARNING, "event failed", session=1, error='boom')
+        self.assertEqual(logs.output, ["WARNING:analytics.ingest:event failed session=1 error='boom'"])
+
+    @override_settings(INGEST_LOG_SAMPLE_RATE=0)
+    def test_queue_changes_are_logged_unsampled(self):
+        step = IngestionStep(None, queue_collection=QueueCollection(load=False))
+        step.consumers = [FakeConsumer()]
+        with self.assertLogs('analytics.ingest', level='INFO') as logs:
+            step.add_queue('u.v.error_event.SINGLE_VALUE', 42)
+            step.remove_queue('u.v.error_event.SINGLE_VALUE')
+        self.assertEqual(logs.output, [
+            "INFO:analytics.ingest:consuming queue='u.v.error_event.SINGLE_VALUE'",
+            "INFO:analytics.ingest:stopped consuming queue='u.v.error_event.SINGLE_VALUE'",
+        ])
+
+
+class EventDedupTests(SimpleTestCase):
+    def test_keys_are_remembered_for_one_to_two_windows(self):
+        now = [0]
+        bloom = RotatingBloomFilter(capacity=1000, error_rate=0.001, window=10, clock=lambda: now[0])
+        self.assertFalse(bloom.check_and_add('a'))
+        self.assertTrue(bloom.check_and_add('a'))
+        now[0] = 10
+        self.assertFalse(bloom.check_and_add('b'))
+        self.assertTrue(bloom.check_and_add('a'))
+        now[0] = 20
+        bloom.check_and_add('c')
+        now[0] = 30
+        self.assertFalse(bloom.check_and_add('b'))
+
+    def test_false_positive_rate_stays_near_the_target(self):
+        bloom = RotatingBloomFilter(capacity=5000, error_rate=0.01, window=3600)
+        for i in range(5000):
+            bloom.check_and_add(f'seen-{i}')
+        false_positives = sum(bloom.check_and_add(f'new-{i}') for i in range(2000))
+        self.assertLess(false_positives, 60)
+
+    def test_only_rows_with_event_ids_are_checked(self):
+        dedup = EventDeduplicator(capacity=100, error_rate=0.001, window=60)
+        rows = [{'event_id': 'x'}, {'event_id': None}, {'event_id': 'y'}]
+        self.assertEqual(dedup.suspects('quality_event', rows), 0)
+        self.assertEqual(dedup.suspects('quality_event', [{'event_id': 'y'}, {'event_id': 'z'}]), 1)
+
+    def test_unique_violations_on_the_dedup_index_are_recognised(self):
+        class Diag:
+            constraint_name = '_hyper_1_4_chunk_gameevent_client_event_id_time_product_id_key'
+
+        class UniqueViolation(Exception):
+            pgcode = '23505'
+            diag = Diag()
+
+        self.assertTrue(is_duplicate_event(UniqueViolation()))
+        Diag.constraint_name = 'gameevent_pkey'
+        self.assertFalse(is_duplicate_event(UniqueViolation()))
+
+    def test_dropped_duplicates_are_not_counted_as_persisted(self):
+        persisted = REGISTRY.get_sample_value('ingest_events_persisted_total', {'event_type': 'error_event', 'product': '43'}) or 0
+        rows = [{'product': 43, 'time': datetime.now(timezone.utc)} for _ in range(3)]
+        IngestMetrics.timed_writer(lambda event_type, rows: [1, None, 3])('error_event', rows)
+        self.assertEqual(REGISTRY.get_sample_value('ingest_events_persisted_total', {'event_type': 'error_event', 'product': '43'}) - persisted, 2)
+
+
+class HandshakeCacheTests(SimpleTestCase):
+    def setUp(self):
+        self.loads = []
+
+        def loader(token_value):
+            self.loads.append(token_value)
+            queue = f'alice.alice_{token_value}_vhost.quality_event.SINGLE_VALUE'
+            return Handshake(None, 'alice', 'secret', [{'fullname': queue, 'name': 'quality_event'}])
+
+        self.cache = HandshakeCache(maxsize=10, ttl=60, loader=loader)
+
+    def test_handshakes_are_loaded_once(self):
+        first = self.cache.get('t1')
+        self.assertIs(self.cache.get('t1'), first)
+        self.assertEqual(self.loads, ['t1'])
+
+    def test_removed_queue_invalidates_the_handshakes_listing_it(self):
+        self.cache.get('t1')
+        self.cache.get('t2')
+        self.cache.invalidate_queue('alice.alice_t2_vhost.quality_event.SINGLE_VALUE')
+        self.assertEqual(list(self.cache.entries), ['t1'])
+        self.cache.get('t2')
+        self.assertEqual(self.loads, ['t1', 't2', 't2'])
 
-# Create your tests here.
@@ -10,4 +10,7 @@ urlpatterns = [
     path('reset-password/<token>/', PasswordResetConfirmView.as_view(), name='reset_password_confirm'),
     path('sign_in/', SignInAPIView.as_view(), name='sign_in'),
     path('auth-receiver', AuthReceiverAPIView.as_view(), name='auth_receiver'),
+    path('metrics/', MetricsView.as_view(), name='metrics'),
+    path('active-users/', ActiveUsersView.as_view(), name='active_users'),
+    path('percentiles/', PercentilesView.as_view(), name='percentiles'),
 ]
\ No newline at end of file
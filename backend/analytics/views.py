@@ -4,9 +4,8 @@ from rest_framework import status
 from rest_framework.exceptions import AuthenticationFailed, NotFound, PermissionDenied
 from .services.managers.UserManager import GenerateToken
 from .services.managers.QueueManager import RabbitAccountManager
-from .models import Token, Queue, CustomUser, Client, Game
+from .models import Token, CustomUser, Client, Game, Product
 import json
-import random
 import jwt
 import os
 from .serializers import CustomUserSignUpSerializer, LoginSerializer, GameSerializer
@@ -18,6 +17,15 @@ from google.oauth2 import id_token
 from google.auth.transport import requests as google_requests
 from django.shortcuts import render
 from rest_framework_simplejwt.tokens import RefreshToken
+from django.http import HttpResponse
+from django.utils.dateparse import parse_date, parse_datetime
+from django.utils.timezone import make_aware
+from prometheus_client import CONTENT_TYPE_LATEST, generate_latest
+from .services.HandshakeCache import handshake_cache
+from .services.IdAllocator import client_ids
+from .services.IngestMetrics import metrics_registry
+from .services.ActiveUsers import active_user_series, active_users
+from .services.Percentiles import percentile_series, range_sketch
 
 
 # Create your views here.
@@ -311,32 +319,19 @@ class TokenView(APIView):
                 raise NotFound('Token not provided or invalid.') 
 
             try:
-                token_obj = Token.objects.get(value=token_value)
+                handshake = handshake_cache.get(token_value)
             except Token.DoesNotExist:
                 raise AuthenticationFailed('Invalid token.')
 
-            if token_obj.is_expired():
+            if handshake.token.is_expired():
                 raise AuthenticationFailed('Token has expired.')
 
-            user = token_obj.Product.owner
-            queues = Queue.objects.filter(token=token_obj)
-
-            queue_data = [{"fullname": queue.fullname, "name": queue.name} for queue in queues]
-
-            max_attempts = 10
-            for _ in range(max_attempts):
-                random_id = random.randint(1, 100000)
-                if not Client.objects.filter(id=random_id).exists():
-                    break
-            else:
-                return Response({"error": "Could not generate a unique client ID."}, status=500)
-
-            client = Client.objects.create(id=random_id, token=token_obj)
+            client = self.create_client(handshake.token)
 
             return Response({
-                "rb_username": user.rb_username,
-                "rb_password": user.rb_password,
-                "queues": queue_data,
+                "rb_username": handshake.rb_username,
+                "rb_password": handshake.rb_password,
+                "queues": handshake.queues,
                 "cid": client.id
             })
 
@@ -344,6 +339,10 @@ class TokenView(APIView):
             print(e)
             return Response({"error": f"{e}"}, status=status.HTTP_500_INTERNAL_SERVER_ERROR)
 
+    def create_client(self, token_obj):
+        # one insert, ids come from blocks of analytics_client_id_seq reserved per process
+        return Client.objects.create(id=client_ids.next(), token=token_obj)
+
     def post(self, request):
         try:
             data = json.loads(request.body)
@@ -355,3 +354,105 @@ class TokenView(APIView):
         except Exception as e:
             print(e)
             return Response(f"error: {e}", status=status.HTTP_500_INTERNAL_SERVER_ERROR)
+
+
+class MetricsView(APIView):
+    """
+    Prometheus text exposition of the ingest metrics (see services/IngestMetrics.py).
+    Open unless INGEST_METRICS_TOKEN is set, then scrapers send it as a bearer token.
+    """
+    authentication_classes = []
+    permission_classes = [AllowAny]
+
+    def get(self, request):
+        expected = settings.INGEST_METRICS_TOKEN
+        if expected and request.headers.get('Authorization') != f'Bearer {expected}':
+            raise AuthenticationFailed('Invalid metrics token.')
+        return HttpResponse(generate_latest(metrics_registry()), content_type=CONTENT_TYPE_LATEST)
+
+
+class ActiveUsersView(APIView):
+    """
+    DAU, WAU, MAU and stickiness (DAU / MAU) per day of one of the user's products,
+    plus the distinct clients over the whole range, from the active user sketches
+    (services/ActiveUsers.py). ?product_id=&start=&end= with dates, default the last 30 days.
+    """
+    permission_classes = [IsAuthenticated]
+
+    def get(self, request):
+        try:
+            product_id = int(request.query_params.get('product_id', ''))
+            end = parse_date(request.query_params.get('end', '')) or datetime.now(timezone.utc).date()
+            start = parse_date(request.query_params.get('start', '')) or end - timedelta(days=29)
+        except ValueError:
+            return Response({'status': 'error', 'message': 'product_id, start and end are invalid'}, status=status.HTTP_400_BAD_REQUEST)
+        if start > end:
+            return Response({'status': 'error', 'message': 'start is after end'}, status=status.HTTP_400_BAD_REQUEST)
+        if not Product.objects.filter(id=product_id, owner=request.user).exists():
+            raise NotFound('Product not found.')
+
+        try:
+            series = active_user_series(product_id, start, end)
+        except ValueError as e:
+            return Response({'status': 'error', 'message': str(e)}, status=status.HTTP_400_BAD_REQUEST)
+        return Response({
+            'status': 'success',
+            'product_id': product_id,
+            'start': start.isoformat(),
+            'end': end.isoformat(),
+            'active_users': active_users(product_id, start, end),
+            'series': series,
+        })
+
+
+def parse_moment(value):
+    """
+    Aware datetime of a query parameter, None when it is empty. A date alone
+    means its midnight UTC; anything else raises ValueError.
+    """
+    if not value:
+        return None
+    moment = parse_datetime(value)
+    if moment is None:
+        day = parse_date(value)
+        if day is None:
+            raise ValueError(f"{value} is not a date or datetime")
+        return datetime(day.year, day.month, day.day, tzinfo=timezone.utc)
+    return moment if moment.tzinfo else make_aware(moment)
+
+
+class PercentilesView(APIView):
+    """
+    p50/p90/p95/p99 of FPS or memory usage of one of the user's products over
+    the range and per hour or day, from the quantile sketches (services/Percentiles.py).
+    ?product_id=&metric=fps|memory_usage&start=&end=&step=hour|day, default the last 24 hours by hour;
+    start and end are datetimes or dates (midnight UTC).
+    """
+    permission_classes = [IsAuthenticated]
+
+    def get(self, request):
+        try:
+            product_id = int(request.query_params.get('product_id', ''))
+            end = parse_moment(request.query_params.get('end')) or datetime.now(timezone.utc)
+            start = parse_moment(request.query_params.get('start')) or end - timedelta(days=1)
+        except ValueError:
+            return Response({'status': 'error', 'message': 'product_id, start and end are invalid'}, status=status.HTTP_400_BAD_REQUEST)
+        metric = request.query_params.get('metric', 'fps')
+        step = request.query_params.get('step', 'hour')
+        if not Product.objects.filter(id=product_id, owner=request.user).exists():
+            raise NotFound('Product not found.')
+
+        try:
+            series = percentile_series(metric, product_id, start, end, step)
+        except ValueError as e:
+            return Response({'status': 'error', 'message': str(e)}, status=status.HTTP_400_BAD_REQUEST)
+        overall = range_sketch(metric, product_id, start, end)
+        return Response({
+            'status': 'success',
+            'product_id': product_id,
+            'metric': metric,
+            'start': start.isoformat(),
+            'end': end.isoformat(),
+            'overall': {'count': overall.count, **overall.quantiles()},
+            'series': series,
+        })
@@ -1,11 +1,12 @@
-import os, sys, django
-from celery import Celery, bootsteps
-import inspect
+import logging, os, sys, django
+from celery import Celery
 from celery import shared_task
 
 os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'backend.settings')
 django.setup()
 
+from analytics.services.IngestMetrics import log_event
+
 app = Celery('celery')
 
 
@@ -25,29 +26,19 @@ def debug_task(self):
     print(f'Request: {self.request!r}')
 
 @shared_task
-def add_queue(queue_name):
-    # print(f"Adding queue {queue_name}")
-    # app.control.add_consumer(queue_name, reply=True)
-    # print(f"Added queue {queue_name}")
-    pass
+def add_queue(queue_name, product_id=None):
+    # every worker's IngestionStep subscribes (or its shard owner only), see analytics.celery_consumers
+    log_event(logging.INFO, "adding queue", queue=queue_name, product_id=product_id, sampled=False)
+    app.control.broadcast('ingest_add_queue', arguments={'queue_name': queue_name, 'product_id': product_id})
 
 
 @shared_task
 def delete_queue(queue_name):
-    # print(f"deleting queue {queue_name}")
-    # app.control.cancel_consumer(queue_name, reply=True)
-    # print(f"deleted queue {queue_name}")
-    pass
+    log_event(logging.INFO, "deleting queue", queue=queue_name, sampled=False)
+    app.control.broadcast('ingest_remove_queue', arguments={'queue_name': queue_name})
     
 if is_running_under_celery():
-    import analytics.celery_consumers  #
+    from analytics.celery_consumers import IngestionStep
     from django.apps import apps
-    apps.check_apps_ready() 
-    for attr_name in dir(analytics.celery_consumers):
-        attr = getattr(analytics.celery_consumers, attr_name)
-        if (
-            inspect.isclass(attr) 
-            and issubclass(attr, bootsteps.Step)  # Only Celery steps
-            and hasattr(attr, "name")  # Must have a name
-        ):
-            app.steps["consumer"].add(attr)
\ No newline at end of file
+    apps.check_apps_ready()
+    app.steps["consumer"].add(IngestionStep)
@@ -168,6 +168,88 @@ CELERY_TASK_SERIALIZER = 'json'
 CELERY_RESULT_BACKEND = 'rpc://'
 CELERY_TIMEZONE = 'GMT'
 
+# Ingestion batching: collect up to `size` events or `interval_ms` milliseconds
+# per event type before writing them in one transaction.
+INGEST_BATCH_ENABLED = os.getenv("INGEST_BATCH_ENABLED") == "True"
+INGEST_BATCH_DEFAULTS = {
+    "size": int(os.getenv("INGEST_BATCH_SIZE", 200)),
+    "interval_ms": int(os.getenv("INGEST_BATCH_INTERVAL_MS", 250)),
+}
+INGEST_BATCH_OVERRIDES = {
+    "start_session": {"size": 50},
+    "end_session": {"size": 50},
+    "quality_event": {"size": 500},
+}
+
+# session id -> (client, token, product) cache used by the ingestion consumers
+INGEST_SESSION_CACHE_SIZE = int(os.getenv("INGEST_SESSION_CACHE_SIZE", 100000))
+INGEST_SESSION_CACHE_TTL = int(os.getenv("INGEST_SESSION_CACHE_TTL", 3600))
+
+# token value -> TokenView handshake payload (credentials and queue list), per web process
+HANDSHAKE_CACHE_SIZE = int(os.getenv("HANDSHAKE_CACHE_SIZE", 10000))
+HANDSHAKE_CACHE_TTL = int(os.getenv("HANDSHAKE_CACHE_TTL", 300))
+
+# "direct" writes into gameevent and the subtype tables, "staging" appends to the
+# unlogged ingest_staging_* tables that the merge_staging task moves over.
+INGEST_MODE = os.getenv("INGEST_MODE", "direct")
+INGEST_STAGING_MERGE_BATCH = int(os.getenv("INGEST_STAGING_MERGE_BATCH", 10000))
+INGEST_STAGING_MERGE_INTERVAL = float(os.getenv("INGEST_STAGING_MERGE_INTERVAL", 5))
+
+CELERY_BEAT_SCHEDULE = {}
+if INGEST_MODE == "staging":
+    CELERY_BEAT_SCHEDULE["merge-ingest-staging"] = {
+        "task": "analytics.tasks.merge_staging",
+        "schedule": INGEST_STAGING_MERGE_INTERVAL,
+    }
+
+# storage policies of the raw event hypertables, applied by `manage.py timescale_policies
+# apply`: chunks are compressed once older than EVENT_COMPRESS_AFTER_DAYS, raw events
+# are deleted after the product's event_retention_days or EVENT_RETENTION_DAYS
+# (0 = keep); the continuous aggregates are kept either way
+EVENT_COMPRESS_AFTER_DAYS = int(os.getenv("EVENT_COMPRESS_AFTER_DAYS", 8))
+EVENT_RETENTION_DAYS = int(os.getenv("EVENT_RETENTION_DAYS", 0))
+
+# failed events are retried after 1x, 2x, 4x, ... the base delay, then quarantined
+INGEST_MAX_RETRIES = int(os.getenv("INGEST_MAX_RETRIES", 5))
+INGEST_RETRY_BASE_DELAY_MS = int(os.getenv("INGEST_RETRY_BASE_DELAY_MS", 1000))
+
+# seconds between re-reading the Queue table in every ingestion worker; new and
+# deleted queues are normally picked up right away through control commands
+INGEST_QUEUE_RECONCILE_INTERVAL = int(os.getenv("INGEST_QUEUE_RECONCILE_INTERVAL", 60))
+
+# product-affinity sharding: this worker consumes only the queues of products
+# that hash to INGEST_SHARD_INDEX out of INGEST_SHARD_COUNT (1 = no sharding)
+INGEST_SHARD_INDEX = int(os.getenv("INGEST_SHARD_INDEX", 0))
+INGEST_SHARD_COUNT = int(os.getenv("INGEST_SHARD_COUNT", 1))
+
+# dedup of events carrying a client event_id: possible duplicates are remembered
+# for one to two windows (seconds) in a rotating Bloom filter of this capacity
+INGEST_DEDUP_CAPACITY = int(os.getenv("INGEST_DEDUP_CAPACITY", 1000000))
+INGEST_DEDUP_ERROR_RATE = float(os.getenv("INGEST_DEDUP_ERROR_RATE", 0.001))
+INGEST_DEDUP_WINDOW = int(os.getenv("INGEST_DEDUP_WINDOW", 3600))
+
+# ingest instrumentation: Prometheus /metrics port of the ingestion worker (0 = off,
+# the ASGI app always serves /api/metrics/), optional bearer token for both, and
+# the analytics.ingest log level; INFO and DEBUG lines are sampled at the rate below
+INGEST_METRICS_PORT = int(os.getenv("INGEST_METRICS_PORT", 0))
+INGEST_METRICS_TOKEN = os.getenv("INGEST_METRICS_TOKEN")
+INGEST_LOG_LEVEL = os.getenv("INGEST_LOG_LEVEL", "INFO")
+INGEST_LOG_SAMPLE_RATE = float(os.getenv("INGEST_LOG_SAMPLE_RATE", 0.01))
+
+LOGGING = {
+    "version": 1,
+    "disable_existing_loggers": False,
+    "formatters": {
+        "ingest": {"format": "%(asctime)s %(levelname)s %(name)s %(message)s"},
+    },
+    "handlers": {
+        "ingest": {"class": "logging.StreamHandler", "formatter": "ingest"},
+    },
+    "loggers": {
+        "analytics.ingest": {"handlers": ["ingest"], "level": INGEST_LOG_LEVEL, "propagate": False},
+    },
+}
+
 # CHANNEL_LAYERS = {
 #     "default": {
 #         "BACKEND": "channels_redis.core.RedisChannelLayer",
@@ -177,11 +259,36 @@ CELERY_TIMEZONE = 'GMT'
 #     },
 # }
 
-CHANNEL_LAYERS = {
-    "default": {
-        "BACKEND": "channels.layers.InMemoryChannelLayer"
+# memory: groups only reach the consumers of the same process; postgres:
+# LISTEN/NOTIFY on the default database, so groups reach every ASGI and worker
+# process (see services/PostgresChannelLayer.py). Set CHANNEL_LAYER=postgres
+# when ingestion workers run apart from the ASGI server.
+CHANNEL_LAYER = os.getenv("CHANNEL_LAYER", "memory")
+
+if CHANNEL_LAYER == "postgres":
+    CHANNEL_LAYERS = {
+        "default": {
+            "BACKEND": "analytics.services.PostgresChannelLayer.PostgresChannelLayer",
+            "CONFIG": {
+                "expiry": int(os.getenv("CHANNEL_LAYER_EXPIRY", 60)),
+                "capacity": int(os.getenv("CHANNEL_LAYER_CAPACITY", 100)),
+            },
+        }
     }
-}
+else:
+    CHANNEL_LAYERS = {
+        "default": {
+            "BACKEND": "channels.layers.InMemoryChannelLayer"
+        }
+    }
+
+# live KPI deltas: seconds between publishes of the ingestion workers' in-memory
+# partials to the channel layer (0 = off), and seconds after which a live SSE
+# stream re-reads its continuous aggregate (see services/LiveAggregates.py).
+# Off by default on the in-memory layer, which cannot carry the deltas from
+# the workers to the ASGI processes.
+LIVE_KPI_INTERVAL = float(os.getenv("LIVE_KPI_INTERVAL", 1 if CHANNEL_LAYER == "postgres" else 0))
+LIVE_KPI_RESYNC = int(os.getenv("LIVE_KPI_RESYNC", 60))
 
 CORS_ALLOW_ALL_ORIGINS = True
 
@@ -1,7 +1,14 @@
 #!/bin/bash
 python manage.py makemigrations
 python manage.py migrate
+# compression and retention policies follow EVENT_COMPRESS_AFTER_DAYS / EVENT_RETENTION_DAYS
+python manage.py timescale_policies apply
+
+# Celery and Uvicorn share Prometheus samples through this directory, so
+# /api/metrics/ reports the ingestion worker as well; stale files are removed
+export PROMETHEUS_MULTIPROC_DIR=${PROMETHEUS_MULTIPROC_DIR:-/tmp/prometheus}
+rm -rf "$PROMETHEUS_MULTIPROC_DIR" && mkdir -p "$PROMETHEUS_MULTIPROC_DIR"
 
 # Start both Celery and Uvicorn in the background
-celery -A backend worker -l info &
+celery -A backend worker -B -l info &
 uvicorn backend.asgi:application --host 0.0.0.0 --port 8000
\ No newline at end of file